@@ -1,3 +1,25 @@
 #!/bin/bash
-cd /shouldipickitup/
+# Stop here if a step fails - but see indexes.py below
+set -e
+cd /shouldipickitup/lib
+# indexes.py exits 1 when a query would COLLSCAN: the app must not start
+# on a database missing an index. 2 is MongoDB unreachable (or another
+# error): start anyway - the breaker and the snapshot / S.F fallback serve
+# until MongoDB is back, which is what they are for.
+status=0
+./indexes.py || status=$?
+if [ "$status" -eq 1 ]; then
+    echo "indexes.py: query plan check failed - not starting" >&2
+    exit 1
+elif [ "$status" -ne 0 ]; then
+    echo "WARNING: indexes.py exited $status (MongoDB down?) - starting" \
+         "without the index check" >&2
+fi
+# Not fatal - main.py falls back to MongoDB per zip - but never quietly
+zip_index=${ZIP_INDEX_FILE:-/shouldipickitup/data/zip_index.bin}
+if [ ! -s "$zip_index" ]; then
+    echo "WARNING: no zip index at $zip_index - every zip lookup will" \
+         "query MongoDB (lib/create_data.py index builds it)" >&2
+fi
+cd ..
 /usr/local/bin/gunicorn should_flask:app  -c /shouldipickitup/external/gunicorn/gunicorn.conf.py 
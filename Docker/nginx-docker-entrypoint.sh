@@ -0,0 +1,27 @@
+#!/bin/sh
+# nginx reads the zipcode => region map (lib/export_static.py) only when it
+# (re)loads. The crawler swaps the export's 'current' link over to each new
+# build, so reload nginx whenever that link changes - new zips are then
+# served statically without anyone running 'nginx -s reload'.
+
+export_current=/usr/share/nginx/export/current
+interval=${EXPORT_POLL_INTERVAL:-60}
+
+/usr/sbin/nginx -g "daemon off;" &
+nginx_pid=$!
+trap 'kill -TERM $nginx_pid' TERM INT QUIT
+
+seen=$(readlink "$export_current")
+while kill -0 "$nginx_pid" 2>/dev/null; do
+    sleep "$interval" &
+    wait $!
+    build=$(readlink "$export_current")
+    if [ "$build" != "$seen" ]; then
+        # A broken map must not take the running config down with it
+        if /usr/sbin/nginx -t -q && /usr/sbin/nginx -s reload; then
+            echo "Export now $build - nginx reloaded" >&2
+            seen=$build
+        fi
+    fi
+done
+wait "$nginx_pid"
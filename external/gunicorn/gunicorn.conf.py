@@ -1,3 +1,6 @@
+import os
+import shutil
+
 workers = 4
 bind = "0.0.0.0:8000"
 logfile = '-'
@@ -5,3 +8,33 @@ errorlogfile = '-'
 accesslog = '-'
 access_log_format = '%({X-Forwarded-For}i)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 loglevel = 'info'
+
+# Import the app in the master and warm it up there (when_ready) so the
+# workers fork with the zip index, snapshot, templates and warm regions
+# already in memory - shared copy-on-write, no slow first requests.
+preload_app = True
+
+# /metrics adds up every worker's metrics from files in this directory
+# (see lib/metrics.py). Set before the app, and prometheus_client, is
+# imported - with preload_app that is in the master, before on_starting.
+prometheus_dir = os.environ.setdefault(
+    "prometheus_multiproc_dir", "/tmp/shouldipickitup_metrics"
+)
+# Files left by an earlier run would be counted again; the config is read
+# again on HUP, when the files of the live workers must stay.
+if os.environ.get("SHOULDIPICKITUP_METRICS_MASTER") != str(os.getpid()):
+    os.environ["SHOULDIPICKITUP_METRICS_MASTER"] = str(os.getpid())
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir)
+
+
+def when_ready(server):
+    import should_flask
+
+    should_flask.warm_up()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
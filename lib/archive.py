@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+""" archive.py - every page the crawler fetched, to parse again offline
+
+- Changing how pages are parsed (extract.py, titles.py, ...) used to mean
+  crawling the live sites again: hours, rate limited. With CRAWL_ARCHIVE
+  on (see config.py) requestwrap.py keeps every body it fetched, and
+  `crawler.py replay` runs a crawl again from them, without the network.
+
+- Layout under ARCHIVE_DIR:
+
+    blobs/ab/abcdef....gz   - a body, gzipped, named by the sha256 of the
+                              body: a page seen again costs nothing more
+    runs/<run>.jsonl        - the manifest of one crawl, one line per fetch:
+                              {"url", "sha256", "status", "bytes", "fetched"}
+
+- A Replay serves a run's bodies by URL, the last fetch of a URL winning.
+  A URL the run never fetched raises NotArchived - a RequestException, so
+  callers skip it as they would a page that failed to load.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * Archive     - store(url, response) => blob + manifest line
+    * Replay      - response(url) => the archived response of a run
+    * NotArchived - the run did not fetch that URL
+    * latest_run  - the newest run in an archive
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import datetime
+import threading
+
+import requests
+
+
+class NotArchived(requests.exceptions.RequestException):
+    pass
+
+
+def blob_path(root, sha256):
+    return os.path.join(root, "blobs", sha256[:2], sha256 + ".gz")
+
+
+def manifest_path(root, run):
+    return os.path.join(root, "runs", run + ".jsonl")
+
+
+def latest_run(root):
+    """ Return the newest run id in root (run ids sort by time) - or None """
+    try:
+        runs = sorted(os.listdir(os.path.join(root, "runs")))
+    except FileNotFoundError:
+        return None
+    runs = [name[: -len(".jsonl")] for name in runs if name.endswith(".jsonl")]
+    return runs[-1] if runs else None
+
+
+class Archive:
+    """
+    Parameters
+    ----------
+    root : str
+        config.ARCHIVE_DIR
+    run : str
+        Names this crawl's manifest - default: the UTC time it started
+    """
+
+    def __init__(self, root, run=None):
+        self.root = root
+        self.run = run or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        self.stored = 0
+        self.new_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "runs"), exist_ok=True)
+        self._manifest = open(manifest_path(root, self.run), "a")
+
+    def store(self, url, response):
+        """ Keep response's body, if not kept already, and log it in the run """
+        body = response.content
+        sha256 = hashlib.sha256(body).hexdigest()
+        path = blob_path(self.root, sha256)
+        written = 0
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Threads may store the same body at once: write aside, then rename
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp, "wb") as fh:
+                fh.write(body)
+            os.replace(tmp, path)
+            written = os.path.getsize(path)
+        line = json.dumps(
+            {
+                "url": url,
+                "sha256": sha256,
+                "status": response.status_code,
+                "bytes": len(body),
+                "fetched": datetime.datetime.utcnow().isoformat(),
+            }
+        )
+        with self._lock:
+            self._manifest.write(line + "\n")
+            self._manifest.flush()
+            self.stored += 1
+            self.new_bytes += written
+        return sha256
+
+    def close(self):
+        self._manifest.close()
+
+
+class _ArchivedResponse:
+    """ The parts of requests.Response the crawler reads """
+
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def raise_for_status(self):
+        pass
+
+
+class Replay:
+    """
+    Parameters
+    ----------
+    root : str
+        config.ARCHIVE_DIR
+    run : str
+        The run to replay - default: the newest
+    """
+
+    def __init__(self, root, run=None):
+        self.root = root
+        self.run = run or latest_run(root)
+        if self.run is None:
+            raise FileNotFoundError(f"No archived runs in {root}")
+        self.urls = {}
+        with open(manifest_path(root, self.run)) as fh:
+            for line in fh:
+                fetch = json.loads(line)
+                self.urls[fetch["url"]] = fetch
+        self.served = 0
+        self.missing = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def response(self, url):
+        """ Return url's archived response - NotArchived if the run lacks it """
+        fetch = self.urls.get(url)
+        if fetch is None:
+            with self._lock:
+                self.missing += 1
+            raise NotArchived(f"Not in run {self.run}: {url}")
+        with gzip.open(blob_path(self.root, fetch["sha256"]), "rb") as fh:
+            content = fh.read()
+        with self._lock:
+            self.served += 1
+        return _ArchivedResponse(url, fetch["status"], content)
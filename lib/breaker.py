@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+""" breaker.py - circuit breaker for calls to a backend (MongoDB)
+
+- After failure_threshold failures in a row the breaker opens: callers
+  check allow() and skip the backend entirely instead of each waiting out
+  a server selection timeout.
+
+- While open, one background thread per process calls probe() every
+  probe_interval seconds and closes the breaker as soon as it succeeds.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * CircuitOpen    - raised by callers when the breaker says no
+    * CircuitBreaker - the breaker itself
+"""
+
+import os
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Parameters
+    ----------
+    name : str
+        For the logs
+    probe : callable
+        Raises if the backend is still down, anything else means healthy
+    failure_threshold : int
+        Consecutive failures before opening
+    probe_interval : float
+        Seconds between probes while open
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+
+    def __init__(self, name, probe, failure_threshold=3, probe_interval=5.0):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._prober = None
+        self._prober_pid = None
+
+    def allow(self):
+        """ True if the backend should be called """
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.failures:
+            with self._lock:
+                self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.trips += 1
+                logger.error(f"{self.name} breaker open after {self.failures} failures")
+                self._wake.clear()
+                self._start_prober()
+
+    def _start_prober(self):
+        # Threads do not survive fork(): check the pid as well as is_alive()
+        pid = os.getpid()
+        if self._prober is None or self._prober_pid != pid or not self._prober.is_alive():
+            self._prober = threading.Thread(
+                target=self._probe_loop, name=f"{self.name}-probe", daemon=True
+            )
+            self._prober_pid = pid
+            self._prober.start()
+
+    def _probe_loop(self):
+        while self.state == self.OPEN:
+            self._wake.wait(self.probe_interval)
+            try:
+                self.probe()
+            except Exception as e:
+                logger.warning(f"{self.name} still down => {str(e)}")
+            else:
+                self.close()
+
+    def close(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._wake.set()
+        logger.info(f"{self.name} breaker closed - backend healthy again")
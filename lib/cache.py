@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+""" cache.py - small in-process caches for the Flask workers
+
+- This module keeps recently used values in memory so repeat requests do not
+  have to go back to MongoDB.
+
+- This file is meant to be imported as a module.
+
+- It contains the following class:
+    * TTLCache - bounded, thread safe LRU cache whose entries expire
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded LRU cache with a time to live and hit/miss counters.
+
+    Expired entries are not thrown away on read: peek() still hands them
+    back so the caller can revalidate (e.g. compare DateCrawled) and touch()
+    them instead of refetching the whole value.
+
+    Parameters
+    ----------
+    maxsize : int
+        Number of entries kept before the least recently used is evicted
+    ttl : float
+        Seconds an entry is considered fresh
+    """
+
+    def __init__(self, maxsize=512, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the fresh value for key, else default """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key, default=None):
+        """ Return the value for key even if expired, without counting it """
+        with self._lock:
+            entry = self._data.get(key)
+            return default if entry is None else entry[1]
+
+    def put(self, key, value):
+        """ Store value under key and mark it fresh """
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, key):
+        """ Mark an existing entry fresh again (it was revalidated) """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (time.monotonic(), entry[1])
+                self._data.move_to_end(key)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """ Return the counters as a dict - for logging or metrics """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
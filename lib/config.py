@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+""" config.py - runtime settings for the Flask app and the crawler
+
+- This module reads every tunable from the environment once, at import time,
+  so the same image can run locally, under docker-compose or at AWS without
+  editing any source file.
+
+- This file is meant to be imported as a module.
+
+- MongoDB settings:
+    MONGO_URI           - full connection string (wins over MONGO_HOST/PORT)
+    MONGO_HOST          - host name of the mongod (default: localhost)
+    MONGO_PORT          - port of the mongod (default: 27017)
+    MONGO_MAX_POOL_SIZE - max sockets per worker process (default: 10)
+    MONGO_MIN_POOL_SIZE - sockets kept open per worker process (default: 0)
+    MONGO_SERVER_SELECTION_TIMEOUT_MS - (default: 2000)
+    MONGO_CONNECT_TIMEOUT_MS          - (default: 2000)
+    MONGO_SOCKET_TIMEOUT_MS           - (default: 5000)
+    MONGO_READ_PREFERENCE - primary, primaryPreferred, secondary,
+                            secondaryPreferred or nearest (default: primary)
+
+- Data files (default to the data/ directory of the checkout):
+    DATA_DIR       - where the generated data files live
+    ZIP_INDEX_FILE - zipcode => region index written by create_data.py
+    SNAPSHOT_FILE  - every region + zip map, written by crawler.py (snapshot.py)
+    FALLBACK_PICKLE_FILE - S.F data served when there is no snapshot either
+    EXPORT_DIR     - static pages + zip map for nginx (export_static.py)
+    ARCHIVE_DIR    - every page a crawl fetched, for replays (archive.py)
+
+- Cache settings:
+    REGION_CACHE_SIZE / REGION_CACHE_TTL - craigs_url => region data
+    ZIP_CACHE_SIZE / ZIP_CACHE_TTL       - zipcode => craigs_url
+    PAGE_CACHE_SIZE / PAGE_CACHE_TTL     - rendered page per region version
+    COMPRESSED_CACHE_SIZE                - compressed bodies (region, zip, encoding)
+    SEARCH_MAX_AGE - Cache-Control max-age of /search/ results, in seconds
+    API_MAX_ZIPS   - most zips one /api/v1/search call may ask for
+    WARM_UP_REGIONS - regions put in the cache (and pre-rendered) before
+                      gunicorn forks, biggest first (default: 0)
+
+- MongoDB circuit breaker:
+    BREAKER_FAILURES       - connection failures in a row before it opens
+    BREAKER_PROBE_INTERVAL - seconds between health probes while open
+
+- Crawler (crawler.py, throttle.py):
+    CRAWL_WORKERS       - threads fetching pages and threads looking up
+                          eBay prices - regions in flight (default: 8)
+    CRAWL_QUEUE_SIZE    - jobs waiting between two crawl stages before the
+                          earlier stage blocks (default: 4)
+    CRAWL_HOST_RATE     - requests per minute to one host to start with; it
+                          then adapts to how the host answers (default: 30)
+    CRAWL_HOST_MIN_RATE / CRAWL_HOST_MAX_RATE - the range it adapts in
+                          (default: 4 / 120)
+    EBAY_HOST_RATE / EBAY_HOST_MIN_RATE / EBAY_HOST_MAX_RATE - the same for
+                          www.ebay.com, which every region shares
+                          (default: 2 / 0.5 / 12)
+    CRAWL_METRICS_PORT  - serve the crawler's Prometheus metrics (host rates,
+                          MongoDB pool) on this port; 0 is off (default: 0)
+    EXTRACTOR           - how pages are parsed (extract.py): "fast" (only the
+                          tags we read, lxml if installed), "strained" (same,
+                          html.parser) or "full" (default: fast)
+    CRAWL_ARCHIVE       - 1 keeps every page fetched in ARCHIVE_DIR, so
+                          `crawler.py replay` can run the crawl again from
+                          them, offline (default: 0)
+
+- Crawler HTTP (requestwrap.py):
+    HTTP_POOL_SIZE   - keep-alive connections kept per host (default: 8)
+    HTTP_RETRIES     - retries on 429, 5xx and connection errors (default: 3)
+    HTTP_BACKOFF     - first retry waits up to this many seconds, doubling
+                       each time, full jitter (default: 2)
+    HTTP_BACKOFF_MAX - most seconds one retry waits, Retry-After included
+                       (default: 120)
+    CRAWL_REGION_DEADLINE - seconds one region's eBay lookups may take before
+                       the crawler saves what it has and moves on (default: 7200)
+
+- eBay price cache (pricecache.py), shared by every region and run:
+    PRICE_CACHE_TTL      - seconds a found price is reused (default: 7 days)
+    PRICE_CACHE_MISS_TTL - seconds a title eBay had no match for is skipped
+                           (default: 1 day)
+"""
+
+import os
+
+
+def env_str(name, default):
+    return os.environ.get(name, default)
+
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+DATA_DIR = env_str(
+    "DATA_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"),
+)
+ZIP_INDEX_FILE = env_str("ZIP_INDEX_FILE", os.path.join(DATA_DIR, "zip_index.bin"))
+SNAPSHOT_FILE = env_str("SNAPSHOT_FILE", os.path.join(DATA_DIR, "snapshot.bin"))
+FALLBACK_PICKLE_FILE = env_str(
+    "FALLBACK_PICKLE_FILE", os.path.join(DATA_DIR, "sf.pickle")
+)
+EXPORT_DIR = env_str(
+    "EXPORT_DIR",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "export"
+    ),
+)
+ARCHIVE_DIR = env_str("ARCHIVE_DIR", os.path.join(DATA_DIR, "archive"))
+
+MONGO_URI = env_str("MONGO_URI", "")
+MONGO_HOST = env_str("MONGO_HOST", "localhost")
+MONGO_PORT = env_int("MONGO_PORT", 27017)
+MONGO_MAX_POOL_SIZE = env_int("MONGO_MAX_POOL_SIZE", 10)
+MONGO_MIN_POOL_SIZE = env_int("MONGO_MIN_POOL_SIZE", 0)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 2000)
+MONGO_CONNECT_TIMEOUT_MS = env_int("MONGO_CONNECT_TIMEOUT_MS", 2000)
+MONGO_SOCKET_TIMEOUT_MS = env_int("MONGO_SOCKET_TIMEOUT_MS", 5000)
+MONGO_READ_PREFERENCE = env_str("MONGO_READ_PREFERENCE", "primary")
+
+# Per worker caches in main.py - regions are revalidated against DateCrawled
+# once REGION_CACHE_TTL seconds have passed.
+REGION_CACHE_SIZE = env_int("REGION_CACHE_SIZE", 512)
+REGION_CACHE_TTL = env_float("REGION_CACHE_TTL", 300)
+ZIP_CACHE_SIZE = env_int("ZIP_CACHE_SIZE", 8192)
+ZIP_CACHE_TTL = env_float("ZIP_CACHE_TTL", 86400)
+PAGE_CACHE_SIZE = env_int("PAGE_CACHE_SIZE", 512)
+PAGE_CACHE_TTL = env_float("PAGE_CACHE_TTL", 86400)
+COMPRESSED_CACHE_SIZE = env_int("COMPRESSED_CACHE_SIZE", 4096)
+SEARCH_MAX_AGE = env_int("SEARCH_MAX_AGE", 300)
+API_MAX_ZIPS = env_int("API_MAX_ZIPS", 5000)
+WARM_UP_REGIONS = env_int("WARM_UP_REGIONS", 0)
+
+BREAKER_FAILURES = env_int("BREAKER_FAILURES", 3)
+BREAKER_PROBE_INTERVAL = env_float("BREAKER_PROBE_INTERVAL", 5)
+
+CRAWL_WORKERS = env_int("CRAWL_WORKERS", 8)
+CRAWL_QUEUE_SIZE = env_int("CRAWL_QUEUE_SIZE", 4)
+CRAWL_HOST_RATE = env_float("CRAWL_HOST_RATE", 30)
+CRAWL_HOST_MIN_RATE = env_float("CRAWL_HOST_MIN_RATE", 4)
+CRAWL_HOST_MAX_RATE = env_float("CRAWL_HOST_MAX_RATE", 120)
+EBAY_HOST_RATE = env_float("EBAY_HOST_RATE", 2)
+EBAY_HOST_MIN_RATE = env_float("EBAY_HOST_MIN_RATE", 0.5)
+EBAY_HOST_MAX_RATE = env_float("EBAY_HOST_MAX_RATE", 12)
+CRAWL_METRICS_PORT = env_int("CRAWL_METRICS_PORT", 0)
+EXTRACTOR = env_str("EXTRACTOR", "fast")
+CRAWL_ARCHIVE = env_int("CRAWL_ARCHIVE", 0)
+
+HTTP_POOL_SIZE = env_int("HTTP_POOL_SIZE", 8)
+HTTP_RETRIES = env_int("HTTP_RETRIES", 3)
+HTTP_BACKOFF = env_float("HTTP_BACKOFF", 2)
+HTTP_BACKOFF_MAX = env_float("HTTP_BACKOFF_MAX", 120)
+CRAWL_REGION_DEADLINE = env_float("CRAWL_REGION_DEADLINE", 7200)
+
+PRICE_CACHE_TTL = env_float("PRICE_CACHE_TTL", 7 * 86400)
+PRICE_CACHE_MISS_TTL = env_float("PRICE_CACHE_MISS_TTL", 86400)
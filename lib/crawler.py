@@ -7,18 +7,83 @@
     - Crawls the page
     - Prepares a MongoDB insert_one_document
     - Sends data to  MongoDB
+    - Once all regions are done, writes the snapshot of every region that
+      the Flask app serves from when MongoDB is down (see snapshot.py)
+    - Then renders every region from that snapshot as static files for
+      nginx (see export_static.py)
+
+- Regions go through a pipeline (see pipeline.py) with a bounded queue
+  between each stage:
+
+    fetch (CRAWL_WORKERS) => parse (1) => diff (1) => ebay (CRAWL_WORKERS)
+        => assemble (1) => write (1)
+
+  so one region is parsed or written while others wait on Craigslist or
+  eBay. Politeness is per host (see throttle.py): each Craigslist region
+  is its own host, while the eBay lookups of every region share
+  www.ebay.com's rate - which is what bounds a full pass. Rates adapt to
+  how each host answers, and with CRAWL_METRICS_PORT set they are served
+  as Prometheus metrics while the crawl runs. Each region is
+  logged as it finishes, with progress, each stage's rate and queue depth,
+  and an estimate of when the pass will be done, so we can tell whether
+  every region gets its turn within old_enough days.
+
+- eBay prices are cached by title in MongoDB across regions and runs (see
+  pricecache.py); the progress lines log how many eBay lookups the
+  cache saved so far.
+
+- A region already listed is crawled incrementally (see incremental.py):
+  its fresh posts are diffed against the stored Urls by Craigslist post
+  id, posts still up keep their price and slot, only new posts go to
+  eBay, and the listing is updated slot by slot rather than rewritten.
+
+- Requests reuse keep-alive connections and retry with backoff (see
+  requestwrap.py). A region's eBay lookups stop after CRAWL_REGION_DEADLINE
+  seconds and the items found by then are saved, so one slow region cannot
+  hold an eBay worker for the rest of the pass.
+
+- With CRAWL_ARCHIVE=1 every page fetched is kept (see archive.py), and
+
+    ./crawler.py replay [run]
+
+  runs that crawl again - parsing, eBay matching, format_mongodocs and the
+  MongoDB writes - from the archived pages, with no network: the way to
+  try a parsing change on real pages. It replays the regions the run
+  fetched (the newest run by default) and skips the price cache and the
+  prices already listed, so every eBay match is made again from the
+  archived eBay pages. A lookup the run never made (a title now
+  canonicalized differently) fails like a page that did not load.
 
 -If no data matches or if MongoDB errors, S.F data will be returned
 -This script requires the mongodb and websitepuller helper modules.
 -This file is mean to be run outside of the Flask Appself.
 
+- It contains the following functions:
+    * regions_to_crawl - craigs_urls not crawled for old_enough days
+    * regions_archived - craigs_urls an archived run fetched
+    * fetch_stage ... write_stage - the pipeline's steps, one region each
+    * crawl_pipeline   - the same steps as a pipeline.Pipeline
+    * crawl_regions    - many regions through crawl_pipeline
 """
 
 import os
+import sys
+import time
 import logging
 import datetime
+import functools
 
+import config
+import archive
+import incremental
+import metrics
 import mongodb
+import pipeline
+import pricecache
+import requestwrap
+import snapshot
+import throttle
+import export_static
 import websitepuller
 from formatter import format_mongodocs
 
@@ -28,18 +93,236 @@ logname = os.path.splitext(os.path.basename(__file__))[0] + ".log"
 logging.basicConfig(
     filename=logname,
     level="INFO",
-    format="%(levelname)s %(asctime)s %(module)s %(process)d  %(message)s",
+    format="%(levelname)s %(asctime)s %(module)s %(threadName)s  %(message)s",
 )
 
 
-def url_is_old_enough_to_crawl(old_enough):
-    date_crawled = mongo_cli.lookup_crawled_date_given_craigs_url(one_craigs_url)
+def url_is_old_enough_to_crawl(mongo_cli, one_craigs_url, old_enough):
+    try:
+        date_crawled = mongo_cli.lookup_crawled_date_given_craigs_url(one_craigs_url)
+    except KeyError:
+        return True  # never crawled
     difference = datetime.datetime.utcnow() - date_crawled
     if difference.days > old_enough:
         return True
     return False
 
 
+def regions_to_crawl(mongo_cli, old_enough):
+    """
+    Return the craigs_urls last crawled more than old_enough days ago,
+    least recently crawled first.
+    """
+    due = []
+    for one_craigs_url in mongo_cli.dump_all_craigs_urls_sorted_by_date():
+        logging.info(f"==== Checking Crawl Date for {one_craigs_url} ===")
+        if url_is_old_enough_to_crawl(mongo_cli, one_craigs_url, old_enough):
+            logging.info(
+                f"== Will crawl {one_craigs_url} - Crawl date more than {old_enough} days =="
+            )
+            due.append(one_craigs_url)
+        else:
+            logging.info(
+                f"== Passing on {one_craigs_url} - crawled within {old_enough} days =="
+            )
+    return due
+
+
+def regions_archived(mongo_cli, replay):
+    """ Return the craigs_urls whose free stuff page replay (archive.Replay) has """
+    return [
+        one_craigs_url
+        for one_craigs_url in mongo_cli.dump_all_craigs_urls_sorted_by_date()
+        if websitepuller.craigs_list_free_url(one_craigs_url) in replay
+    ]
+
+
+def fetch_stage(one_craigs_url, _):
+    logging.info(f"= Connecting to {one_craigs_url} =")
+    return websitepuller.fetch_craigs_list_free_page(one_craigs_url)
+
+
+def parse_stage(one_craigs_url, html):
+    craig_raw_posts = websitepuller.parse_craigs_list_free_posts(html)
+    logging.info(f"= Picked up {len(craig_raw_posts)} items from {one_craigs_url} =")
+    for x in craig_raw_posts:
+        logging.info(f"Picked up {x.href} - {x.title}")
+    return craig_raw_posts
+
+
+def diff_stage(
+    one_craigs_url, craig_raw_posts, mongo_cli=None, howmany=15, reuse=True
+):
+    listing = mongo_cli.lookup_listed_posts(one_craigs_url) if reuse else None
+    region_diff = incremental.diff(listing, craig_raw_posts, howmany)
+    logging.info(f"= {one_craigs_url} since last crawl: {region_diff} =")
+    return region_diff
+
+
+def ebay_stage(one_craigs_url, region_diff, howmany=15, timeout=45, price_cache=None):
+    wanted = howmany - len(region_diff.kept)
+    if wanted <= 0 or not region_diff.new:
+        logging.info(f"= Nothing new to price in {one_craigs_url} =")
+        return region_diff, ([], [], [])
+    logging.info(
+        f"= Connecting to Ebay - {timeout}s timeout, {wanted} items max to retrieve ="
+    )
+    deadline = time.monotonic() + config.CRAWL_REGION_DEADLINE
+    found = websitepuller.get_ebay_data(
+        region_diff.new,
+        random="yes",
+        howmany=wanted,
+        timeout=timeout,
+        deadline=deadline,
+        price_cache=price_cache,
+    )
+    logging.info(f"= Ending Crawl of {one_craigs_url} =")
+    return region_diff, found
+
+
+def assemble_stage(one_craigs_url, diff_found, howmany=15):
+    region_diff, found = diff_found
+    if region_diff.stored is not None:
+        return incremental.update(region_diff, found, howmany)
+    craig_posts_with_data, ebay_prices, ebay_links = found
+    mongo_filter = {"craigs_url": one_craigs_url}
+    mongo_doc = format_mongodocs(
+        mongo_filter, craig_posts_with_data, ebay_prices, ebay_links, howmany=howmany
+    )
+    return mongo_doc, len(mongo_doc["$set"]["Items"])
+
+
+def write_stage(one_craigs_url, assembled, mongo_cli=None):
+    mongo_doc, saved = assembled
+    logging.info(f"= Sending Data to Mongo for {one_craigs_url} =")
+    mongo_cli.update_one_document({"craigs_url": one_craigs_url}, mongo_doc)
+    return saved
+
+
+def crawl_pipeline(
+    mongo_cli, workers=None, howmany=15, timeout=45, price_cache=None, reuse=True
+):
+    """
+    Return the crawl as a pipeline.Pipeline - jobs are (craigs_url, None).
+
+    Parameters
+    ----------
+    mongo_cli
+        mongodb.MongoCli object (thread safe - one for all the stages)
+    workers
+        int - fetch and eBay threads (default config.CRAWL_WORKERS)
+    price_cache
+        pricecache.PriceCache the eBay threads share - None to always ask eBay
+    reuse
+        bool - keep the prices of posts still listed, ask eBay only about new
+        ones (see incremental.py) - False rebuilds every listing
+    """
+    workers = workers or config.CRAWL_WORKERS
+    maxsize = config.CRAWL_QUEUE_SIZE
+    return pipeline.Pipeline(
+        [
+            pipeline.Stage("fetch", fetch_stage, workers, maxsize),
+            pipeline.Stage("parse", parse_stage, 1, maxsize),
+            pipeline.Stage(
+                "diff",
+                functools.partial(
+                    diff_stage, mongo_cli=mongo_cli, howmany=howmany, reuse=reuse
+                ),
+                1,
+                maxsize,
+            ),
+            pipeline.Stage(
+                "ebay",
+                functools.partial(
+                    ebay_stage,
+                    howmany=howmany,
+                    timeout=timeout,
+                    price_cache=price_cache,
+                ),
+                workers,
+                maxsize,
+            ),
+            pipeline.Stage(
+                "assemble",
+                functools.partial(assemble_stage, howmany=howmany),
+                1,
+                maxsize,
+            ),
+            pipeline.Stage(
+                "write", functools.partial(write_stage, mongo_cli=mongo_cli), 1, maxsize
+            ),
+        ]
+    )
+
+
+def crawl_regions(
+    mongo_cli, craigs_urls, workers=None, howmany=15, timeout=45, cached=True
+):
+    """
+    Crawl many regions through crawl_pipeline, logging each as it finishes.
+
+    A region that fails is logged and left for the next run (its DateCrawled
+    does not move); the others carry on.
+
+    Parameters
+    ----------
+    craigs_urls
+        [list] of regions, most overdue first
+    workers
+        int - fetch and eBay threads (default config.CRAWL_WORKERS)
+    cached
+        bool - reuse earlier eBay prices: the price cache, and those of posts
+        still listed (False: match every title on eBay again)
+
+    Returns
+    -------
+    {dictionary} craigs_url : items saved, or the exception it failed with
+    """
+    price_cache = pricecache.PriceCache(mongo_cli) if cached else None
+    # The progress lines report this run's reuse, not the process's
+    incremental.reused = 0
+    crawl = crawl_pipeline(
+        mongo_cli, workers, howmany, timeout, price_cache, reuse=cached
+    )
+    results = {}
+    started = time.monotonic()
+    total = len(craigs_urls)
+    logging.info(f"==== Crawling {total} regions: {crawl.describe()} ====")
+
+    jobs = ((url, None) for url in craigs_urls)
+    for done, outcome in enumerate(crawl.run(jobs), 1):
+        url = outcome.key
+        if outcome.error is not None:
+            results[url] = outcome.error
+            logging.error(
+                f"[{done}/{total}] FAILED {url} in {outcome.stage}: {outcome.error}"
+            )
+        else:
+            results[url] = outcome.value
+            logging.info(f"[{done}/{total}] {url}: {outcome.value} items")
+        elapsed = time.monotonic() - started
+        left = elapsed / done * (total - done)
+        logging.info(
+            f"Progress {done}/{total} - {elapsed / 3600:.1f}h so far, "
+            f"~{left / 3600:.1f}h to go, "
+            f"{throttle.host_throttle.waited / 3600:.1f}h waited on hosts, "
+            f"{requestwrap.retried} requests retried, eBay at "
+            f"{throttle.host_throttle.rate('www.ebay.com'):.1f}/min, "
+            f"{price_cache.saved if cached else 0} eBay lookups saved by the "
+            f"price cache, {incremental.reused} by posts still listed"
+        )
+        logging.info(f"Stages: {crawl.describe()}")
+
+    failed = [url for url, result in results.items() if isinstance(result, Exception)]
+    logging.info(
+        f"==== Crawled {total - len(failed)}/{total} regions in "
+        f"{(time.monotonic() - started) / 3600:.1f}h, {len(failed)} failed ===="
+    )
+    if cached:
+        logging.info(f"==== eBay price cache: {price_cache.stats()} ====")
+    return results
+
+
 if __name__ == "__main__":
 
     verbose = True
@@ -49,51 +332,45 @@ if __name__ == "__main__":
 
     try:
 
-        mongo_cli = mongodb.MongoCli()
-        all_craigs_urls = mongo_cli.dump_all_craigs_urls_sorted_by_date()
-
-        for one_craigs_url in all_craigs_urls:
-            
-            logging.info(f"==== Checking Crawl Date for {one_craigs_url} ===")
-
-            if url_is_old_enough_to_crawl(old_enough):
-                logging.info(
-                    f"== Crawling and Indexing {one_craigs_url} - Crawl date more than {old_enough} days =="
-                )
-            else:
-                logging.info(
-                    f"== Passing on {one_craigs_url} - crawled within {old_enough} days =="
-                )
-                continue
-
-            logging.info(f"= Connecting to {one_craigs_url} =")
-            craig_raw_posts = websitepuller.get_craigs_list_free_posts(one_craigs_url)
-            logging.info(f"= Picked up {len(craig_raw_posts)} items from Craigslist =")
-
-            for x in craig_raw_posts:
-                logging.info(f"Picked up {x.get('href')} - {x.getText()}")
+        if config.CRAWL_METRICS_PORT:
+            metrics.watch_throttle(throttle.host_throttle)
+            metrics.serve(config.CRAWL_METRICS_PORT)
 
+        mongo_cli = mongodb.MongoCli()
+        if sys.argv[1:2] == ["replay"]:
+            run = sys.argv[2] if len(sys.argv) > 2 else None
+            requestwrap.replay = archive.Replay(config.ARCHIVE_DIR, run)
+            due = regions_archived(mongo_cli, requestwrap.replay)
             logging.info(
-                f"= Connecting to Ebay - {timeout}s timeout, {howmany} items max to retrieve ="
+                f"= Replaying run {requestwrap.replay.run}: {len(due)} regions ="
             )
-            craig_posts_with_data, ebay_prices, ebay_links = websitepuller.get_ebay_data(
-                craig_raw_posts, random="yes", howmany=howmany, timeout=timeout
+            crawl_regions(
+                mongo_cli, due, howmany=howmany, timeout=timeout, cached=False
             )
-            logging.info(f"= Ending Crawl of {one_craigs_url} =")
-
-            logging.info("= Formatting Docs  =")
-            mongo_filter = {"craigs_url": one_craigs_url}
-            
-            mongo_doc = format_mongodocs(
-                mongo_filter,
-                craig_posts_with_data,
-                ebay_prices,
-                ebay_links,
-                howmany=howmany,
+            logging.info(
+                f"= Replayed {requestwrap.replay.served} pages, "
+                f"{requestwrap.replay.missing} not in the archive ="
             )
+        else:
+            if config.CRAWL_ARCHIVE:
+                requestwrap.archive = archive.Archive(config.ARCHIVE_DIR)
+                logging.info(f"= Archiving pages as run {requestwrap.archive.run} =")
+            due = regions_to_crawl(mongo_cli, old_enough)
+            crawl_regions(mongo_cli, due, howmany=howmany, timeout=timeout)
+            if requestwrap.archive is not None:
+                requestwrap.archive.close()
+                logging.info(
+                    f"= Archived {requestwrap.archive.stored} pages, "
+                    f"{requestwrap.archive.new_bytes / 2 ** 20:.1f} MiB new ="
+                )
+
+        logging.info("= Writing snapshot of all regions =")
+        version = snapshot.write_from_mongo(mongo_cli)
+        logging.info(f"= Snapshot version {version} written =")
 
-            logging.info("= Sending Data to Mongo =")
-            mongo_cli.update_one_document(mongo_filter, mongo_doc)
+        logging.info("= Exporting static region pages =")
+        build_dir = export_static.export(snapshot.Snapshot())
+        logging.info(f"= Exported to {build_dir} - nginx reloads for new zips =")
 
     except (ValueError, NameError) as e:
 
@@ -62,13 +62,24 @@ matched into one of the 400+  Mongo Documents by comparing city,state.
 If there's a match, the document will be populated with all the zip codes. We
 mark these as 'Zips' in the list as they are primary.
 
-If there's not a match, we find the closest zip code and craiglist url known
-using the mean/average zip code dictionary and populate that document with the
-zip code data. We mark these as 'ALtZips' in the list as they are not primary zips.
+If there's not a match, we find the closest craiglist url known and populate
+that document with the zip code data. We mark these as 'ALtZips' in the list as
+they are not primary zips.
+
+Closest is by real distance when the government file has coordinates: every
+region's centroid (latitude/longitude, columns 5 and 6) goes in a KD-tree (see
+geoindex.py) and each city goes to the region nearest its own centroid. The
+same tree gives every region its NEIGHBORS nearest regions ('Neighbors', next
+to its 'Centroid'), which the zip index carries to the Flask app. Without
+coordinates we fall back to the mean/average zip code dictionary.
+
+i.e
+gov_city_state_centroids = create_gov_city_state_centroid_map(zip_code_file)
 
 i.e
 master_mongo_city_state_zip_data = generate_master_documents_import_to_mongodb(
-craigs_city_links, gov_city_state_mutlizips_map, mean_zip2craigs_url)
+craigs_city_links, gov_city_state_mutlizips_map, mean_zip2craigs_url,
+gov_city_state_centroids)
 
 Once  done, there will be 400+ MongoDB documents for initial load. (There are
 ~400 total craiglist urls). Most of the 400 are populated with zip code data.
@@ -82,6 +93,16 @@ This is 'imperfect' data, but at least all of the zips in the government file wi
 have relevant data from somewhere 'somewhat' close. This also means a zip codes
 be considered 'close' to city that is a decent distance away as the crow flies.
 
+- Last, the same documents are boiled down to a dense zipcode => region
+index file (see zipindex.py) so the Flask workers can resolve a zip
+without asking MongoDB.
+
+i.e
+zipindex.save(*zipindex.build(master_mongo_city_state_zip_data))
+
+`./create_data.py index` writes that file only, without MongoDB: the AWS
+image, whose database is loaded elsewhere, runs it at build time.
+
 To avoid duplicate docs, create_data.py must be run before crawler.py runs.
 
 The latter does upserts where the former just does inserts (it is run as
@@ -91,7 +112,6 @@ entrypoint to the docker image - so should never be a problem).
 
 
 import os
-import sys
 import logging
 
 import csv
@@ -103,7 +123,14 @@ from pymongo.errors import BulkWriteError
 from pymongo.errors import OperationFailure
 
 
+try:
+    from lib import geoindex  # if called from ..main()
+except ModuleNotFoundError:
+    import geoindex  # if called from .
+
+
 URL = "http://federalgovernmentzipcodes.us/download.html"  # not used
+NEIGHBORS = 3
 my_file_name = os.path.basename(__file__)
 zip_code_file = "../data/free-zipcode-database-Primary.no.header.csv"
 craigs_links_file = "../data/craigs_links.txt"
@@ -126,16 +153,49 @@ def create_gov_city_state_mutlizips_map(zip_code_file):
         csv_reader = csv.reader(csv_fh, delimiter=",")
         for row in csv_reader:
             zipc = row[0]
-            city = row[2]
-            city = city.lower()
-            city = " ".join(city.split())  # no spaces
-            state = row[3]
-            state = " ".join(state.split())
-            state = state.upper()
-            gov_city_state_zips[f"{city},{state}"].append(zipc)
+            gov_city_state_zips[gov_city_state(row)].append(zipc)
         return gov_city_state_zips
 
 
+def gov_city_state(row):
+    """ Return the 'city,STATE' key of a row of the government zip file """
+    city = row[2]
+    city = city.lower()
+    city = " ".join(city.split())  # no spaces
+    state = row[3]
+    state = " ".join(state.split())
+    state = state.upper()
+    return f"{city},{state}"
+
+
+def create_gov_city_state_centroid_map(zip_code_file):
+    """
+    Return a dictionary with (city,state) as key and the centroid of its
+    zipcodes' latitude/longitude (columns 5 and 6) as value.
+
+    Parameters
+    ----------
+    zip_code_file : file
+        File at URL
+    Returns:
+        dictionary - {'boston,MA': (42.35, -71.06)} - rows without
+        coordinates are skipped
+    """
+    gov_city_state_latlngs = defaultdict(list)
+    with open(zip_code_file) as csv_fh:
+        csv_reader = csv.reader(csv_fh, delimiter=",")
+        for row in csv_reader:
+            try:
+                latlng = (float(row[5]), float(row[6]))
+            except (IndexError, ValueError):
+                continue
+            gov_city_state_latlngs[gov_city_state(row)].append(latlng)
+    return {
+        citystate: geoindex.centroid(latlngs)
+        for citystate, latlngs in gov_city_state_latlngs.items()
+    }
+
+
 def create_craigs_url_dict_from_local_file(craigs_links_file):
     """
     Return a dictionary (city,state => url) given  craigs_links_file file
@@ -235,8 +295,40 @@ def find_closest_craigs_url_for_other_cities(zip, mean_zip2craigs_url):
         raise ValueError(e)
 
 
+def create_region_tree(craigs_city_links, gov_city_state_centroids):
+    """ Return a KD-tree of the craigslist regions' centroids and the centroids
+
+    Parameters
+    ----------
+    craigs_city_links :
+        Craiglist url to city  map
+    gov_city_state_centroids :
+        {dictionary} city,state : (latitude, longitude)
+
+    Returns
+    -------
+    region_tree
+        geoindex.KDTree - nearest() hands back craigs_urls
+    region_centroids
+        {dictionary} craigs_url : (latitude, longitude)
+    """
+    region_centroids = {}
+    for citystate, latlng in gov_city_state_centroids.items():
+        craigs_url = craigs_city_links.get("".join(citystate.split()))
+        if craigs_url is not None and latlng is not None:
+            region_centroids[craigs_url] = latlng
+    region_tree = geoindex.KDTree(
+        list(region_centroids.values()), list(region_centroids.keys())
+    )
+    return region_tree, region_centroids
+
+
 def generate_master_documents_import_to_mongodb(
-    craigs_city_links, gov_city_state_zips, mean_zip2craigs_url, verbose=False
+    craigs_city_links,
+    gov_city_state_zips,
+    mean_zip2craigs_url,
+    gov_city_state_centroids=None,
+    verbose=False,
 ):
     """ Format MongoDB documents and return a list of 400+ of them
 
@@ -248,6 +340,8 @@ def generate_master_documents_import_to_mongodb(
         {dictionary}  above
     mean_zip2craigs_url :
         {dictionary} above
+    gov_city_state_centroids :
+        {dictionary} above - None to place cities by zip number only
 
     Returns:
         [list] - All mongodb documents will initially have this format:
@@ -259,10 +353,17 @@ def generate_master_documents_import_to_mongodb(
     'AltZips': [],
     'AltCities': []
     }
+
+    plus 'Centroid': [lat, lng] and 'Neighbors': [craigs_url, ...] for the
+    regions with coordinates
     """
 
     master_mongo_city_state_zip_data = []
     master_mongo_city_state_zip_map = {}
+    gov_city_state_centroids = gov_city_state_centroids or {}
+    region_tree, region_centroids = create_region_tree(
+        craigs_city_links, gov_city_state_centroids
+    )
 
     for url in craigs_city_links.values():
 
@@ -272,25 +373,36 @@ def generate_master_documents_import_to_mongodb(
         master_mongo_city_state_zip_map[url]["AltZips"] = []
         master_mongo_city_state_zip_map[url]["AltCities"] = []
 
-    for citystate, ziplist in gov_city_state_zips.items():
+    for original_citystate, ziplist in gov_city_state_zips.items():
 
         try:
-            citystate = "".join(citystate.split())
+            citystate = "".join(original_citystate.split())
             url = lookup_craigs_url_with_city(citystate, craigs_city_links)
             master_mongo_city_state_zip_map[url]["CityState"] = citystate
             master_mongo_city_state_zip_map[url]["Zips"] = ziplist
         except KeyError:
             # continue
-            first_zip = ziplist[0]
-            url = find_closest_craigs_url_for_other_cities(
-                first_zip, mean_zip2craigs_url
-            )
+            latlng = gov_city_state_centroids.get(original_citystate)
+            if latlng is not None and region_tree.size:
+                ((_, url),) = region_tree.nearest(*latlng)
+            else:
+                first_zip = ziplist[0]
+                url = find_closest_craigs_url_for_other_cities(
+                    first_zip, mean_zip2craigs_url
+                )
             master_mongo_city_state_zip_map[url]["AltZips"].extend(ziplist)
             master_mongo_city_state_zip_map[url]["AltCities"].append(citystate)
         except Exception as e:
             logging.exception("Caught an error")
         # If we print out  or iterate here, we see it building vs the end state
 
+    for url, latlng in region_centroids.items():
+        master_mongo_city_state_zip_map[url]["Centroid"] = list(latlng)
+        master_mongo_city_state_zip_map[url]["Neighbors"] = [
+            neighbor
+            for _, neighbor in region_tree.nearest(*latlng, k=NEIGHBORS, exclude={url})
+        ]
+
     # If we print out or iterate here,  life is good:
     for url in craigs_city_links.values():
         if verbose:
@@ -300,23 +412,39 @@ def generate_master_documents_import_to_mongodb(
     return master_mongo_city_state_zip_data
 
 
+def create_master_documents():
+    """ Return the master documents from zip_code_file and craigs_links_file """
+    craigs_city_links = create_craigs_url_dict_from_local_file(craigs_links_file)
+    gov_city_state_mutlizips_map = create_gov_city_state_mutlizips_map(zip_code_file)
+    mean_zip2craigs_url = create_mean_zipcode_2_craigs_url_map(
+        craigs_city_links, gov_city_state_mutlizips_map
+    )
+    gov_city_state_centroids = create_gov_city_state_centroid_map(zip_code_file)
+    return generate_master_documents_import_to_mongodb(
+        craigs_city_links,
+        gov_city_state_mutlizips_map,
+        mean_zip2craigs_url,
+        gov_city_state_centroids,
+    )
+
+
 if __name__ == "__main__":
 
     import sys
+    import zipindex
+
+    if sys.argv[1:2] == ["index"]:
+        # No MongoDB, and no catching: a missing file must fail the build
+        zipindex.save(*zipindex.build(create_master_documents()))
+        print("Zip index written")
+        sys.exit(0)
+
     import mongodb
 
     try:
-        craigs_city_links = create_craigs_url_dict_from_local_file(craigs_links_file)
-        gov_city_state_mutlizips_map = create_gov_city_state_mutlizips_map(
-            zip_code_file
-        )
-        mean_zip2craigs_url = create_mean_zipcode_2_craigs_url_map(
-            craigs_city_links, gov_city_state_mutlizips_map
-        )
-        master_mongo_city_state_zip_data = generate_master_documents_import_to_mongodb(
-            craigs_city_links, gov_city_state_mutlizips_map, mean_zip2craigs_url
-        )
+        master_mongo_city_state_zip_data = create_master_documents()
         print(master_mongo_city_state_zip_data)
+        zipindex.save(*zipindex.build(master_mongo_city_state_zip_data))
         mongo_cli = mongodb.MongoCli()
         mongo_cli.init_load_city_state_zip_map(master_mongo_city_state_zip_data)
     except FileNotFoundError as e:
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+""" export_static.py - pre-render every region for nginx to serve itself
+
+- The data only changes when crawler.py runs, so at the end of each crawl
+  we render, from the snapshot it just wrote (see snapshot.py):
+
+    regions/<slug>.html  - the /search/ results page, from the same page
+                           dict as the app's (main.page_from_region), with
+                           main.ZIP_TOKEN where the zip goes (nginx's
+                           sub_filter puts it in)
+    regions/<slug>.json  - the region as /api/v1/search returns it
+    zip_region.map       - "11218 newyork_brk;" for every zip, for an
+                           nginx map {} block
+
+- Each export goes into its own build-<version> directory and the
+  'current' symlink is then swapped over, so nginx never sees half an
+  export. Older builds but the last KEEP_BUILDS are removed.
+
+- nginx reads the map file at (re)load time: the web container's
+  entrypoint (Docker/nginx-docker-entrypoint.sh) watches 'current' and
+  reloads nginx when it moves, so new zips are picked up within
+  EXPORT_POLL_INTERVAL seconds (default 60). Pages and JSON changes are
+  live right away.
+
+- This file can be run on its own (from lib/) or imported by the crawler:
+
+    ./export_static.py [snapshot file] [export dir]
+
+- It contains the following functions:
+    *slug_for      - craigs_url => file name safe region name
+    *export        - write one export from a snapshot.Snapshot
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import logging
+
+import jinja2
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from lib import config  # if called from ..main()
+    from lib import mongodb
+    from lib import snapshot
+    from lib import zipindex
+except ModuleNotFoundError:
+    import config  # if called from .
+    import mongodb
+    import snapshot
+    import zipindex
+
+    # main.py builds the page dict the app renders: render the same one
+    sys.path.append(top_dir)
+import main
+
+
+KEEP_BUILDS = 2
+templates_dir = os.path.join(top_dir, "templates")
+
+
+def slug_for(craigs_url):
+    """
+    Return a file name safe name for a region
+
+    https://newyork.craigslist.org/brk/ => newyork_brk
+    https://abilene.craigslist.org      => abilene
+    """
+    host_and_path = craigs_url.split("//", 1)[-1]
+    host, _, path = host_and_path.partition("/")
+    parts = [host.split(".")[0]] + [part for part in path.split("/") if part]
+    return re.sub(r"[^a-z0-9_]", "", "_".join(parts).lower())
+
+
+def template_env():
+    """ Jinja environment that renders the Flask templates outside of Flask """
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(templates_dir),
+        autoescape=jinja2.select_autoescape(["html"]),
+    )
+    env.globals["url_for"] = lambda endpoint, filename: f"/{endpoint}/{filename}"
+    return env
+
+
+def export(snap, export_dir=None):
+    """
+    Write pages, JSON and the zip map for every crawled region in snap.
+
+    Parameters
+    ----------
+    snap
+        snapshot.Snapshot object
+    export_dir:
+        str - where the builds and the 'current' symlink live
+              (default config.EXPORT_DIR)
+
+    Returns
+    -------
+    build_dir
+        str - the directory 'current' now points at
+    """
+    export_dir = export_dir or config.EXPORT_DIR
+    build_dir = os.path.join(export_dir, f"build-{snap.version}")
+    regions_dir = os.path.join(build_dir, "regions")
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(regions_dir)
+
+    template = template_env().get_template("craig_list_local_items.html")
+    slugs = {}
+    for region_id, region in enumerate(snap.regions):
+        listing = snap.listing(region_id)
+        if listing is None:
+            continue
+        try:
+            all_data = mongodb.MongoCli.all_data_from_response(
+                listing, region["craigs_url"]
+            )
+        except (ValueError, AttributeError) as e:
+            logging.warning(f"Not exporting {region['craigs_url']} => {e}")
+            continue
+        slug = slug_for(all_data.url)
+        page = main.page_from_region(all_data)
+        body = template.render(
+            zip=main.ZIP_TOKEN,
+            city=page["city"],
+            state=page["state"],
+            all_posts=page["all_posts"],
+            len_items=len(page["all_posts"]),
+            all_links=page["all_links"],
+            all_cust=page["all_cust"],
+        )
+        with open(os.path.join(regions_dir, f"{slug}.html"), "w") as fh:
+            fh.write(body)
+        with open(os.path.join(regions_dir, f"{slug}.json"), "w") as fh:
+            json.dump(dict(all_data.to_json(), craigs_url=all_data.url), fh)
+        slugs[region_id] = slug
+
+    with open(os.path.join(build_dir, "zip_region.map"), "w") as fh:
+        for zipc in range(zipindex.SLOTS):
+            region_id = snap.region_id(f"{zipc:05}")
+            if region_id in slugs:
+                fh.write(f"{zipc:05} {slugs[region_id]};\n")
+
+    current = os.path.join(export_dir, "current")
+    tmp_link = f"{current}.{os.getpid()}.tmp"
+    os.symlink(os.path.basename(build_dir), tmp_link)
+    os.replace(tmp_link, current)
+
+    builds = sorted(
+        (name for name in os.listdir(export_dir) if name.startswith("build-")),
+        key=lambda name: int(name.split("-", 1)[1]),
+    )
+    for name in builds[:-KEEP_BUILDS]:
+        if name != os.path.basename(build_dir):
+            shutil.rmtree(os.path.join(export_dir, name), ignore_errors=True)
+    logging.info(f"Exported {len(slugs)} regions to {build_dir}")
+    return build_dir
+
+
+if __name__ == "__main__":
+
+    try:
+        snap = snapshot.Snapshot(sys.argv[1] if len(sys.argv) > 1 else None)
+        print(export(snap, sys.argv[2] if len(sys.argv) > 2 else None))
+    except (IOError, ValueError) as e:
+        print("No usable snapshot - run crawler.py first: ", e)
+    except Exception as e:
+        logging.exception(e)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+""" extract.py - pull the few tags we read out of Craigslist and eBay pages
+
+- Every page used to be parsed whole with BeautifulSoup's html.parser, to
+  read a handful of tags:
+    * free_posts  - a.result-title.hdrlnk on a free stuff search page
+    * ebay_result - the first h3.s-item__title, span.s-item__price and
+                    a.s-item__link on an eBay search page
+    * geo_meta    - meta geo.placename / geo.region on a post's page
+    * map_link    - the google maps link on a post's page
+
+- An Extractor can instead build only those tags (a SoupStrainer as
+  parse_only - the rest of the page is tokenized but never becomes
+  objects) and can use lxml's tree builder, much faster than html.parser,
+  when lxml is installed.
+
+- extract(what, html) tries config.EXTRACTOR first and falls back to the
+  full html.parser path - the one we always used - when it raises, or
+  finds nothing on a page whose text holds what it looks for (MARKERS),
+  so a page the fast path gets wrong costs time, not data. An empty free
+  page or an eBay search with no match - the common "nothing" - is
+  parsed once. fallbacks counts how often the fallback ran.
+
+- non-app/bench/bench_extract.py compares the extractors on the saved
+  pages in non-app/bench/fixtures.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * EbayResult - title, price, link of eBay's first result
+    * Extractor  - the four reads for one parser setup
+    * EXTRACTORS - full, strained (html.parser) and fast (lxml if there)
+    * extract    - the configured extractor, with the fallback
+"""
+
+import re
+import logging
+import threading
+import collections
+
+from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
+
+try:
+    import lxml  # noqa: F401 - only BeautifulSoup needs it
+except ImportError:
+    lxml = None
+
+try:
+    from lib import config  # if called from ..main()
+    from lib import posts
+except ModuleNotFoundError:
+    import config  # if called from .
+    import posts
+
+
+EbayResult = collections.namedtuple("EbayResult", ["title", "price", "link"])
+
+mapsre = re.compile("https://www.google.com/maps/preview/")
+
+FREE_POST = {"name": "a", "class_": "result-title hdrlnk"}
+EBAY_TAGS = {
+    "name": ["h3", "span", "a"],
+    "class_": ["s-item__title", "s-item__price", "s-item__link"],
+}
+GEO_META = {"name": "meta", "attrs": {"name": ["geo.placename", "geo.region"]}}
+MAP_LINK = {"name": "a", "href": mapsre}
+
+# Text a page must hold for a read to find anything: when the fast path
+# finds nothing on a page without it, there is nothing to find
+MARKERS = {
+    "free_posts": "result-title",
+    "ebay_result": "s-item__title",
+    "geo_meta": "geo.placename",
+    "map_link": "https://www.google.com/maps/preview/",
+}
+
+fallbacks = 0
+_lock = threading.Lock()
+
+
+class Extractor:
+    """
+    Parameters
+    ----------
+    name : str
+        For config.EXTRACTOR, logs and the benchmark
+    features : str
+        BeautifulSoup tree builder - "html.parser" or "lxml"
+    strain : bool
+        Build only the tags each read needs (SoupStrainer)
+    """
+
+    def __init__(self, name, features="html.parser", strain=False):
+        self.name = name
+        self.features = features
+        self.strain = strain
+
+    def soup(self, html, target):
+        only = SoupStrainer(**target) if self.strain else None
+        return BeautifulSoup(html, self.features, parse_only=only)
+
+    def free_posts(self, html):
+        """ [list] of posts.Post on a free stuff search page """
+        soup = self.soup(html, FREE_POST)
+        found = [posts.from_tag(tag) for tag in soup.find_all(**FREE_POST)]
+        # Nothing points into the tree any more: free it now, not with the region
+        soup.decompose()
+        return found
+
+    def ebay_result(self, html):
+        """ EbayResult of an eBay search page - None when eBay found nothing """
+        soup = self.soup(html, EBAY_TAGS)
+        title = soup.find("h3", {"class": "s-item__title"})
+        if title is None:
+            return None
+        price = soup.find("span", {"class": "s-item__price"})
+        link = soup.find("a", {"class": "s-item__link"})
+        return EbayResult(
+            title.get_text(separator=" "),
+            price.get_text() if price is not None else None,
+            link.get("href") if link is not None else None,
+        )
+
+    def geo_meta(self, html):
+        """ (geo.placename, geo.region) content of a post's page - or None """
+        soup = self.soup(html, GEO_META)
+        place = soup.find("meta", attrs={"name": "geo.placename"})
+        region = soup.find("meta", attrs={"name": "geo.region"})
+        if place is None or region is None:
+            return None
+        return place.get("content"), region.get("content")
+
+    def map_link(self, html):
+        """ href of the google maps link on a post's page - or None """
+        link = self.soup(html, MAP_LINK).find("a", href=mapsre)
+        return link.get("href") if link is not None else None
+
+
+full = Extractor("full")
+EXTRACTORS = {
+    "full": full,
+    "strained": Extractor("strained", strain=True),
+    "fast": Extractor("fast", "lxml" if lxml else "html.parser", strain=True),
+}
+
+
+def extract(what, html):
+    """
+    Return extractor.what(html) with config.EXTRACTOR, or with the full
+    html.parser path if that raises, or finds nothing though the page
+    holds MARKERS[what].
+
+    Parameters
+    ----------
+    what
+        str - "free_posts", "ebay_result", "geo_meta" or "map_link"
+    html
+        str - the page
+    """
+    global fallbacks
+    extractor = EXTRACTORS.get(config.EXTRACTOR, full)
+    if extractor is not full:
+        try:
+            found = getattr(extractor, what)(html)
+        except Exception as e:
+            logging.warning(f"{extractor.name} {what} failed, parsing in full: {e}")
+        else:
+            if found or MARKERS[what] not in html:
+                return found
+        with _lock:
+            fallbacks += 1
+    return getattr(full, what)(html)
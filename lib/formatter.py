@@ -5,8 +5,8 @@ def format_mongodocs(mongo_filter, craig_posts_with_data, ebay_prices, ebay_link
     
     Parameters
     ----------
-    soup_object
-        beautiful soup_object - list of all free items crawled
+    craig_posts_with_data
+        [list] of posts.Post - the free items crawled, with prices
     howmany
         number of items to return from CL page
 
@@ -43,8 +43,8 @@ def format_mongodocs(mongo_filter, craig_posts_with_data, ebay_prices, ebay_link
     }
 
     for num, each_item in enumerate(craig_posts_with_data[0:howmany], start=1):
-        each_link = each_item.attrs["href"]
-        each_text = each_item.text
+        each_link = each_item.href
+        each_text = each_item.title
         item = f"Item{num}"
         url = f"Url{num}"
         mongo_doc["$set"]["Items"][item] = each_text
@@ -58,7 +58,8 @@ def format_mongodocs(mongo_filter, craig_posts_with_data, ebay_prices, ebay_link
         link_num = f"EbayLink{num}"
         mongo_doc["$set"]["EbayLinks"][link_num] = link
 
-    mongo_doc["$set"]["DateCrawled"] = datetime.datetime.now()
+    # Naive UTC, as MongoDB returns it - should_flask sends it as Last-Modified
+    mongo_doc["$set"]["DateCrawled"] = datetime.datetime.utcnow()
 
     return mongo_doc
 
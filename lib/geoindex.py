@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+""" geoindex.py - nearest craigslist region by real distance
+
+- create_data.py used to file a city with no craigslist region of its own
+  under the region whose median zipcode is numerically closest - a linear
+  min() per city, and zip numbers are a poor stand-in for miles. Instead we
+  take each region's centroid from the latitude/longitude columns of the
+  government zip file and put them in a KD-tree.
+
+- Points are kept as (x, y, z) on the unit sphere, so plain euclidean
+  distance in the tree orders points exactly as great circle distance does:
+  no special cases for longitude wrapping or the poles.
+
+- A lookup is O(log regions), so assigning every city is near linear. The
+  k nearest regions of each region are also worked out at build time and
+  kept in the zip index (see zipindex.py), making "the next closest region"
+  a list read when serving.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    *to_xyz      - latitude, longitude => point on the unit sphere
+    *centroid    - mean position of many (latitude, longitude)
+    *KDTree      - nearest(lat, lng, k) => [(km, payload)]
+"""
+
+import math
+import heapq
+import itertools
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_xyz(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (
+        math.cos(lat) * math.cos(lng),
+        math.cos(lat) * math.sin(lng),
+        math.sin(lat),
+    )
+
+
+def centroid(latlngs):
+    """
+    Return the (latitude, longitude) in the middle of latlngs
+
+    Parameters
+    ----------
+    latlngs
+        [list] of (latitude, longitude) in degrees
+
+    Returns
+    -------
+        (latitude, longitude) - None if latlngs is empty
+    """
+    if not latlngs:
+        return None
+    x, y, z = (sum(axis) for axis in zip(*(to_xyz(lat, lng) for lat, lng in latlngs)))
+    return (
+        math.degrees(math.atan2(z, math.hypot(x, y))),
+        math.degrees(math.atan2(y, x)),
+    )
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    """
+    Static 3-d tree over (latitude, longitude) points, each with a payload
+
+    Parameters
+    ----------
+    latlngs
+        [list] of (latitude, longitude) in degrees
+    payloads
+        [list] of the same length - what nearest() hands back (craigs_url)
+    """
+
+    def __init__(self, latlngs, payloads):
+        items = [
+            (to_xyz(lat, lng), payload)
+            for (lat, lng), payload in zip(latlngs, payloads)
+        ]
+        self.size = len(items)
+        self._root = self._build(items, 0)
+
+    def _build(self, items, depth):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        mid = len(items) // 2
+        point, payload = items[mid]
+        return (
+            point,
+            payload,
+            axis,
+            self._build(items[:mid], depth + 1),
+            self._build(items[mid + 1 :], depth + 1),
+        )
+
+    def nearest(self, lat, lng, k=1, exclude=()):
+        """
+        Return the k points closest to (lat, lng), closest first
+
+        Parameters
+        ----------
+        lat, lng
+            float - degrees
+        k
+            int - how many
+        exclude
+            payloads to skip, e.g. the region asking for its neighbors
+
+        Returns
+        -------
+            [list] of (km, payload)
+        """
+        target = to_xyz(lat, lng)
+        best = []  # max heap on distance: (-squared distance, tie, payload)
+        tie = itertools.count()
+
+        def visit(node):
+            if node is None:
+                return
+            point, payload, axis, left, right = node
+            if payload not in exclude:
+                dist2 = sum((a - b) ** 2 for a, b in zip(target, point))
+                if len(best) < k:
+                    heapq.heappush(best, (-dist2, next(tie), payload))
+                elif dist2 < -best[0][0]:
+                    heapq.heapreplace(best, (-dist2, next(tie), payload))
+            diff = target[axis] - point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if len(best) < k or diff * diff < -best[0][0]:
+                visit(far)
+
+        visit(self._root)
+        return [
+            (chord_to_km(math.sqrt(-neg_dist2)), payload)
+            for neg_dist2, _, payload in sorted(best, reverse=True)
+        ]
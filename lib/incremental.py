@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+""" incremental.py - crawl a region again, asking eBay only about new posts
+
+- Every crawl used to price a region's posts from scratch and overwrite
+  its listing, though on a busy region most posts are still up from the
+  last run: eBay was asked about them again, at eBay's rate.
+
+- A listing keeps its posts in numbered slots - Item3, Url3, Price3 and
+  EbayLink3 belong together. diff() reads the Craigslist post id out of
+  each stored Url (see posts.py) and splits a fresh crawl's posts into:
+    * kept - still up and priced last time: their slot, price and link
+             are reused
+    * new  - everything else, for get_ebay_data (the price cache still
+             spares it the titles eBay had no match for)
+  Posts that were stored but are no longer up free their slot, and so
+  do slots above howmany.
+
+- update() turns a Diff and what eBay found for the new posts into a
+  MongoDB update with dotted keys: kept slots are not touched, new posts
+  $set into free slots (lowest first), slots left empty are $unset from
+  all four fields alike - so the values of Items, Urls, Prices and
+  EbayLinks stay aligned for main.py and export_static.py.
+
+- A region without a listing yet gets the whole document, as before
+  (formatter.format_mongodocs).
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * Slot   - one stored post: post_id, title, href, price, ebay_link
+    * slots  - the stored posts of a listing, by slot number
+    * Diff   - kept / new posts of one region
+    * diff   - fresh posts vs the stored listing
+    * update - the dotted $set / $unset for MongoDB
+    * reused - lookups saved so far this run (crawl_regions resets it)
+"""
+
+import datetime
+import threading
+import collections
+
+try:
+    from lib import posts  # if called from ..main()
+except ModuleNotFoundError:
+    import posts  # if called from .
+
+
+Slot = collections.namedtuple(
+    "Slot", ["post_id", "title", "href", "price", "ebay_link"]
+)
+
+FIELDS = (
+    ("Items", "Item"),
+    ("Urls", "Url"),
+    ("Prices", "Price"),
+    ("EbayLinks", "EbayLink"),
+)
+
+reused = 0
+_lock = threading.Lock()
+
+
+def slots(listing):
+    """
+    Return {slot number: Slot} of a listing (mongodb.lookup_listed_posts)
+    """
+    found = {}
+    items = listing.get("Items") or {}
+    urls = listing.get("Urls") or {}
+    prices = listing.get("Prices") or {}
+    ebay_links = listing.get("EbayLinks") or {}
+    for item, title in items.items():
+        try:
+            num = int(item[len("Item") :])
+        except ValueError:
+            continue
+        href = urls.get(f"Url{num}") or ""
+        post_id = posts.post_id_re.search(href)
+        found[num] = Slot(
+            post_id.group(1) if post_id else None,
+            title,
+            href,
+            prices.get(f"Price{num}"),
+            ebay_links.get(f"EbayLink{num}"),
+        )
+    return found
+
+
+class Diff:
+    """
+    Parameters
+    ----------
+    stored : dict
+        {slot number: Slot} of the listing, every slot - None when there is
+        no listing yet
+    kept : dict
+        {slot number: posts.Post} still up, price reused
+    new : list
+        posts.Post to ask eBay about, in Craigslist's order
+    gone : int
+        stored posts no longer up
+    """
+
+    def __init__(self, stored, kept, new, gone):
+        self.stored = stored
+        self.kept = kept
+        self.new = new
+        self.gone = gone
+
+    def __repr__(self):
+        return f"Diff({len(self.kept)} kept, {len(self.new)} new, {self.gone} gone)"
+
+
+def diff(listing, fresh, howmany):
+    """
+    Return the Diff of a region's fresh posts against its stored listing.
+
+    Parameters
+    ----------
+    listing
+        {dictionary} mongodb.lookup_listed_posts - None for a full crawl
+    fresh
+        [list] of posts.Post just parsed
+    howmany
+        int - slots in a listing
+    """
+    global reused
+    if listing is None:
+        return Diff(None, {}, list(fresh), 0)
+    stored = slots(listing)
+    # Posts in slots above howmany (howmany was bigger then) are not kept:
+    # update() unsets those slots
+    by_id = {
+        slot.post_id: num
+        for num, slot in stored.items()
+        if slot.post_id and 1 <= num <= howmany
+    }
+    kept = {}
+    new = []
+    for post in fresh:
+        num = by_id.pop(post.post_id, None) if post.post_id else None
+        if num is None:
+            new.append(post)
+        else:
+            post.price = stored[num].price
+            kept[num] = post
+    with _lock:
+        reused += len(kept)
+    return Diff(stored, kept, new, len(stored) - len(kept))
+
+
+def update(region_diff, found, howmany):
+    """
+    Return the MongoDB update of a region: {"$set": {"Items.Item4": ..}, ..}
+
+    Parameters
+    ----------
+    region_diff
+        Diff - region_diff.stored must not be None
+    found
+        (posts, prices, links) from websitepuller.get_ebay_data for the new
+        posts - at most howmany - len(region_diff.kept) of them
+
+    Returns
+    -------
+    mongo_doc
+        dictionary - and the number of posts the listing will hold
+    """
+    craig_posts_with_data, ebay_prices, ebay_links = found
+    free = [num for num in range(1, howmany + 1) if num not in region_diff.kept]
+    to_set = {"DateCrawled": datetime.datetime.utcnow()}
+    placed = zip(free, craig_posts_with_data, ebay_prices, ebay_links)
+    filled = set()
+    for num, post, price, link in placed:
+        for value, (field, name) in zip((post.title, post.href, price, link), FIELDS):
+            to_set[f"{field}.{name}{num}"] = value
+        filled.add(num)
+    to_unset = {
+        f"{field}.{name}{num}": ""
+        for num in region_diff.stored
+        if num not in region_diff.kept and num not in filled
+        for field, name in FIELDS
+    }
+    mongo_doc = {"$set": to_set}
+    # An empty $unset is an error before MongoDB 5.0
+    if to_unset:
+        mongo_doc["$unset"] = to_unset
+    return mongo_doc, len(region_diff.kept) + len(filled)
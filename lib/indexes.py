@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+""" indexes.py - every MongoDB index the app needs, and proof they are used
+
+- This script:
+    - creates the indexes below (create_index is a no-op when they exist)
+    - runs explain() on every query shape MongoCli sends and fails loudly
+      if any of them would scan the whole collection (COLLSCAN)
+
+- Run it after create_data.py, or any time to check a deployment:
+
+    ./indexes.py          # create + verify, exit 1 on a COLLSCAN
+    ./indexes.py verify   # verify only
+
+- This file can also be imported as a module and contains the following:
+    * INDEXES         - (collection, keys, options) for each index
+    * QUERY_SHAPES    - the queries MongoCli sends, with sample values
+    * ensure_indexes  - create all of INDEXES
+    * verify_query_plans - explain all of QUERY_SHAPES, raise CollScanError
+"""
+
+import sys
+import logging
+import datetime
+
+from pymongo import ASCENDING
+
+
+INDEXES = [
+    ("data", [("craigs_url", ASCENDING)], {"unique": True}),
+    ("data", [("Zips", ASCENDING)], {}),
+    ("data", [("AltZips", ASCENDING)], {}),
+    ("data", [("DateCrawled", ASCENDING)], {}),
+    ("listings", [("craigs_url", ASCENDING)], {"unique": True}),
+    # Each price carries its own Expires (hits and misses live differently)
+    ("prices", [("Expires", ASCENDING)], {"expireAfterSeconds": 0}),
+]
+
+sample_zip = "11218"
+sample_url = "https://sfbay.craigslist.org"
+sample_title = "couch"
+
+# name, collection, filter, projection, sort
+QUERY_SHAPES = [
+    (
+        "zip => craigs_url",
+        "data",
+        {"$or": [{"Zips": sample_zip}, {"AltZips": sample_zip}]},
+        {"_id": 0, "craigs_url": 1},
+        None,
+    ),
+    ("region by craigs_url", "data", {"craigs_url": sample_url}, None, None),
+    ("listing by craigs_url", "listings", {"craigs_url": sample_url}, None, None),
+    (
+        "listings by craigs_url $in",
+        "listings",
+        {"craigs_url": {"$in": [sample_url]}},
+        None,
+        None,
+    ),
+    (
+        "price by title",
+        "prices",
+        {"_id": sample_title, "Expires": {"$gt": datetime.datetime(2020, 1, 1)}},
+        {"_id": 0, "Price": 1, "EbayLink": 1},
+        None,
+    ),
+    (
+        "regions by DateCrawled",
+        "data",
+        {},
+        {"_id": 0, "craigs_url": 1},
+        [("DateCrawled", ASCENDING)],
+    ),
+]
+
+
+class CollScanError(Exception):
+    pass
+
+
+def collection(mongo_cli, name):
+    return mongo_cli.dbh.database[name]
+
+
+def ensure_indexes(mongo_cli, verbose=False):
+    """
+    Create every index in INDEXES - safe to run again and again.
+
+    Parameters
+    ----------
+    mongo_cli
+        mongodb.MongoCli object
+
+    Returns
+    -------
+    [list] of index names
+    """
+    names = []
+    for coll_name, keys, options in INDEXES:
+        name = collection(mongo_cli, coll_name).create_index(keys, **options)
+        if verbose:
+            print(f"{coll_name}: {name}")
+        names.append(name)
+    return names
+
+
+def stages(plan):
+    """ Yield every 'stage' in an explain() plan, however deeply nested """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+
+def verify_query_plans(mongo_cli, verbose=False):
+    """
+    Explain every query in QUERY_SHAPES and raise if one is a COLLSCAN.
+
+    Parameters
+    ----------
+    mongo_cli
+        mongodb.MongoCli object
+
+    Returns
+    -------
+    {dictionary} - query name : [list] of winning plan stages
+
+    Exceptions
+    ----------
+    CollScanError - names the queries that scan the collection
+    """
+    plans = {}
+    for name, coll_name, query, projection, sort in QUERY_SHAPES:
+        cursor = collection(mongo_cli, coll_name).find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        explained = cursor.explain()
+        plans[name] = list(stages(explained["queryPlanner"]["winningPlan"]))
+        if verbose:
+            print(f"{name}: {plans[name]}")
+
+    bad = [name for name, plan in plans.items() if "COLLSCAN" in plan]
+    if bad:
+        raise CollScanError(f"COLLSCAN for: {', '.join(bad)}")
+    return plans
+
+
+if __name__ == "__main__":
+
+    import mongodb
+    from pymongo.errors import ConnectionFailure
+    from pymongo.errors import OperationFailure
+
+    try:
+        mg = mongodb.MongoCli()
+        if sys.argv[1:2] != ["verify"]:
+            ensure_indexes(mg, verbose=True)
+        verify_query_plans(mg, verbose=True)
+    except CollScanError as e:
+        print("Query plan check failed: ", e)
+        sys.exit(1)
+    except ConnectionFailure as e:
+        print("MongoDB ConnectionFailure: ", e)
+        sys.exit(2)
+    except OperationFailure as e:
+        print("Permissions?", e)
+        sys.exit(2)
+    except Exception as e:
+        logging.exception(e)
+        sys.exit(2)
+    else:
+        print("All indexes in place, no COLLSCAN")
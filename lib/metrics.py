@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+""" metrics.py - Prometheus metrics for the Flask app, across all workers
+
+- gunicorn runs several worker processes, each with its own caches,
+  breaker and MongoDB pool. prometheus_client's multiprocess mode keeps
+  every worker's values in files under prometheus_multiproc_dir (set in
+  external/gunicorn/gunicorn.conf.py) and /metrics adds them all up, so
+  it does not matter which worker answers the scrape.
+
+- What is measured:
+    * shouldipickitup_stage_seconds{stage}      - histogram, see STAGES
+    * shouldipickitup_request_seconds{endpoint} - histogram, whole request
+    * shouldipickitup_cache_lookups_total{cache,result} - hit / miss
+    * shouldipickitup_cache_evictions_total{cache}
+    * shouldipickitup_cache_entries{cache}      - summed over live workers
+    * shouldipickitup_breaker_open{name}        - workers with it open
+    * shouldipickitup_breaker_trips_total{name}
+    * shouldipickitup_mongo_pool_connections    - open sockets, all workers
+    * shouldipickitup_mongo_pool_checked_out    - sockets in use right now
+    * shouldipickitup_mongo_pool_checkouts_total{result} - ok / failed
+    * shouldipickitup_crawl_host_rate{host}     - requests per minute the
+      crawler's throttle allows each host right now (crawler only)
+
+- Caches and breakers keep their own counters (cache.py, breaker.py);
+  sync() copies what changed since the last call into the metrics, at
+  most every SYNC_INTERVAL seconds per worker and on every scrape.
+  baseline() takes the counters as they are as already counted - the
+  master calls it after warming up, so no forked worker reports the
+  warm up's lookups. Nor its stages: stage() times nothing while
+  paused(), which the master warms up in.
+
+- Without prometheus_multiproc_dir (cmd line, Flask dev server) metrics
+  are kept in process and /metrics shows that one process only.
+
+- The crawler is not behind gunicorn: serve() answers /metrics for it on
+  a port of its own (CRAWL_METRICS_PORT in config.py).
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * stage         - context manager timing one stage of a request
+    * paused        - context manager, stage() times nothing in it
+    * watch_cache   - export a cache.TTLCache's counters
+    * watch_breaker - export a breaker.CircuitBreaker's state
+    * watch_throttle - export a throttle.HostThrottle's rates
+    * baseline      - count the watched counters as synced, without metrics
+    * sync          - copy the watched counters into the metrics
+    * PoolMetrics   - pymongo pool listener, registered on import
+    * exposition    - the /metrics body and its content type
+    * serve         - answer /metrics on a port, from a thread
+"""
+
+import os
+import time
+import contextlib
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import prometheus_client
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import multiprocess
+from pymongo import monitoring
+
+
+MULTIPROC_DIR = os.environ.get("prometheus_multiproc_dir") or os.environ.get(
+    "PROMETHEUS_MULTIPROC_DIR"
+)
+SYNC_INTERVAL = 1.0
+
+STAGES = ("validate", "resolve_zip", "mongo_fetch", "fallback", "render")
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+stage_seconds = Histogram(
+    "shouldipickitup_stage_seconds",
+    "Seconds spent in each stage of a search",
+    ["stage"],
+    buckets=BUCKETS,
+)
+request_seconds = Histogram(
+    "shouldipickitup_request_seconds",
+    "Seconds per request, by endpoint",
+    ["endpoint"],
+    buckets=BUCKETS,
+)
+cache_lookups = Counter(
+    "shouldipickitup_cache_lookups", "Cache lookups", ["cache", "result"]
+)
+cache_evictions = Counter(
+    "shouldipickitup_cache_evictions", "Entries evicted for room", ["cache"]
+)
+cache_entries = Gauge(
+    "shouldipickitup_cache_entries",
+    "Entries held, summed over live workers",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+breaker_open = Gauge(
+    "shouldipickitup_breaker_open",
+    "Live workers whose breaker is open",
+    ["name"],
+    multiprocess_mode="livesum",
+)
+breaker_trips = Counter(
+    "shouldipickitup_breaker_trips", "Times the breaker opened", ["name"]
+)
+pool_connections = Gauge(
+    "shouldipickitup_mongo_pool_connections",
+    "Open MongoDB connections, summed over live workers",
+    multiprocess_mode="livesum",
+)
+pool_checked_out = Gauge(
+    "shouldipickitup_mongo_pool_checked_out",
+    "MongoDB connections in use, summed over live workers",
+    multiprocess_mode="livesum",
+)
+pool_checkouts = Counter(
+    "shouldipickitup_mongo_pool_checkouts", "Connection checkouts", ["result"]
+)
+crawl_host_rate = Gauge(
+    "shouldipickitup_crawl_host_rate",
+    "Requests per minute the crawler allows a host right now",
+    ["host"],
+    multiprocess_mode="max",
+)
+
+_caches = {}
+_breakers = {}
+_throttles = []
+_synced = {}
+_last_sync = 0.0
+_sync_lock = threading.Lock()
+_paused = False
+
+
+def stage(name):
+    """ with metrics.stage("render"): ... - observe the time taken """
+    if _paused:
+        return contextlib.nullcontext()
+    return stage_seconds.labels(name).time()
+
+
+@contextlib.contextmanager
+def paused():
+    """
+    with metrics.paused(): ... - observe no stage in there.
+
+    For the gunicorn master's warm up: its observations would be counted
+    as traffic, though no request was served.
+    """
+    global _paused
+    _paused = True
+    try:
+        yield
+    finally:
+        _paused = False
+
+
+def watch_cache(name, ttl_cache):
+    _caches[name] = ttl_cache
+
+
+def watch_breaker(circuit_breaker):
+    _breakers[circuit_breaker.name] = circuit_breaker
+
+
+def watch_throttle(host_throttle):
+    _throttles.append(host_throttle)
+
+
+def _inc_by_change(key, counter, value):
+    """ Add the change in value since last time; a reset starts over """
+    delta = value - _synced.get(key, 0)
+    if delta > 0:
+        counter.inc(delta)
+    _synced[key] = value
+
+
+def baseline():
+    """
+    Take the watched caches' and breakers' counters as already counted.
+
+    For the gunicorn master after warm up: every worker forks with these
+    counters, and would otherwise each report the warm up's lookups.
+    """
+    with _sync_lock:
+        for name, ttl_cache in _caches.items():
+            stats = ttl_cache.stats()
+            for counted in ("hits", "misses", "evictions"):
+                _synced[(name, counted)] = stats[counted]
+        for name, circuit_breaker in _breakers.items():
+            _synced[(name, "trips")] = circuit_breaker.trips
+
+
+def sync(force=False):
+    """ Copy the watched caches', breakers' and throttles' state into the metrics """
+    global _last_sync
+    now = time.monotonic()
+    if not force and now - _last_sync < SYNC_INTERVAL:
+        return
+    with _sync_lock:
+        _last_sync = now
+        for name, ttl_cache in _caches.items():
+            stats = ttl_cache.stats()
+            _inc_by_change(
+                (name, "hits"), cache_lookups.labels(name, "hit"), stats["hits"]
+            )
+            _inc_by_change(
+                (name, "misses"), cache_lookups.labels(name, "miss"), stats["misses"]
+            )
+            _inc_by_change(
+                (name, "evictions"), cache_evictions.labels(name), stats["evictions"]
+            )
+            cache_entries.labels(name).set(stats["size"])
+        for name, circuit_breaker in _breakers.items():
+            breaker_open.labels(name).set(0 if circuit_breaker.allow() else 1)
+            _inc_by_change(
+                (name, "trips"), breaker_trips.labels(name), circuit_breaker.trips
+            )
+        for host_throttle in _throttles:
+            for host, rate in host_throttle.rates().items():
+                crawl_host_rate.labels(host).set(rate)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """ Count the sockets of every MongoClient created after import """
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pool_connections.inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pool_connections.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pool_checkouts.labels("failed").inc()
+
+    def connection_checked_out(self, event):
+        pool_checked_out.inc()
+        pool_checkouts.labels("ok").inc()
+
+    def connection_checked_in(self, event):
+        pool_checked_out.dec()
+
+
+# MongoClients are created lazily (mongodb.get_client), after this import
+monitoring.register(PoolMetrics())
+
+
+def exposition():
+    """
+    Return the /metrics body and content type - every worker's metrics
+    in multiprocess mode, this process's otherwise.
+    """
+    sync(force=True)
+    if MULTIPROC_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    body = prometheus_client.generate_latest(registry)
+    return body, prometheus_client.CONTENT_TYPE_LATEST
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body, content_type = exposition()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """ Answer GET (any path) with exposition() on port, from a daemon thread """
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True
+    ).start()
+    return server
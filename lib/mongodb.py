@@ -11,30 +11,138 @@
     - is intended as a loadable module only.
     - contains the following methods:
 
+     get_client
+        Return the one MongoClient of this process (created lazily)
+     set_client
+        Use another client (e.g. mongomock) - benchmarks and tests
      ConnectToMongo
-        Connect to MongoDB and return DB handle
+        Return the collection handle off the shared client
      lookup_craigs_url_citystate_and_items_given_zip
         Return all the goodies: items, urls , city , state from MongoDB
+     lookup_all_data_given_craigs_url
+        Same goodies once the craigs_url is known (cache revalidation)
+     lookup_all_data_given_craigs_urls
+        Same goodies for many craigs_urls in one $in query (batch API)
      lookup_city_state_given_zip
         Given a zip, return city, state from MongoDB
+     dump_all_craigs_urls_sorted_by_date
+        All craigs_urls, oldest crawl first - for the crawler
      lookup_craigs_posts
         Only return the free items text
+     lookup_listing
+        Return the listing of a craigs_url, only the fields asked for
+     lookup_listed_posts
+        The Items, Urls, Prices and EbayLinks of a listing - for the crawler
      update_one_document
-        Update one doc to mongodb regardless if exists
+        Update one listing to mongodb regardless if exists
      insert_one_document
         Insert one doc to mongodb
      init_load_city_state_zip_map
         Write all the key/values to mongodb
-
-TBD: Reuse the MongoDB handles once per app vs per instance.
+     lookup_price
+        The cached eBay price of a normalized title, unless it expired
+     save_price
+        Cache the eBay price of a normalized title - or that there was none
+
+- Three collections:
+    data     - one document per craigs_url with the zip membership arrays
+               (Zips, AltZips, AltCities), CityState and DateCrawled
+    listings - the slim document we serve: CityState, Items, Urls, Prices,
+               EbayLinks and DateCrawled, written by update_one_document
+    prices   - the crawler's eBay lookups by normalized title (_id): Price
+               and EbayLink, or None for no match, and when it Expires -
+               a TTL index removes it then (see pricecache.py, indexes.py)
+  Every read asks only for the fields it needs (projections), so a page
+  view never drags the zip arrays of a big metro over the wire.
+
+- The MongoClient is created once per process, on first use, so each
+  gunicorn worker builds its own pool after fork and every MongoCli()
+  shares it. Settings come from the environment - see config.py.
 """
 
+import os
+import logging
+import datetime
+import threading
+
+from pymongo import ASCENDING
 from pymongo import MongoClient
 from pymongo.errors import BulkWriteError
 from pymongo.errors import ConnectionFailure
 from pymongo.errors import ServerSelectionTimeoutError
 
-import logging
+try:
+    from lib import config  # if called from ..main()
+    from lib import indexes
+except ModuleNotFoundError:
+    import config  # if called from .
+    import indexes
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the MongoClient for this process, creating it on first use.
+
+    The pid is remembered so that a client inherited over fork() (gunicorn
+    preload) is never reused - the child builds a fresh pool instead.
+    MongoClient is thread safe, so one per process is all we need.
+
+    Returns
+    -------
+        client :  pymongo MongoClient object
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            if config.MONGO_URI:
+                where = {"host": config.MONGO_URI}
+            else:
+                where = {"host": config.MONGO_HOST, "port": config.MONGO_PORT}
+            _client = MongoClient(
+                **where,
+                maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                minPoolSize=config.MONGO_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=config.MONGO_SOCKET_TIMEOUT_MS,
+                readPreference=config.MONGO_READ_PREFERENCE,
+                connect=False,
+            )
+            _client_pid = pid
+    return _client
+
+
+def set_client(client):
+    """
+    Make client the MongoClient of this process, in place of the configured
+    server - e.g. a mongomock.MongoClient for benchmarks. None drops it, and
+    the next get_client() connects to the configured server again.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        _client = client
+        _client_pid = os.getpid() if client is not None else None
+
+
+ZIP_QUERY_FIELDS = {"_id": 0, "craigs_url": 1}
+LISTING_FIELDS = {
+    "_id": 0,
+    "craigs_url": 1,
+    "CityState": 1,
+    "Items": 1,
+    "Urls": 1,
+    "Prices": 1,
+    "EbayLinks": 1,
+    "DateCrawled": 1,
+}
 
 
 class AllData:
@@ -48,20 +156,46 @@ class AllData:
         self.Urls = {}
         self.Prices = {}
         self.EBlinks = {}
+        self.date_crawled = None
+
+    def to_json(self):
+        """ Return the region as plain JSON types - API and static export """
+        items = zip(
+            self.Items.values(),
+            self.Urls.values(),
+            self.Prices.values(),
+            self.EBlinks.values(),
+        )
+        return {
+            "city": self.city.capitalize(),
+            "state": self.state.capitalize(),
+            "date_crawled": self.date_crawled.isoformat() if self.date_crawled else None,
+            "items": [
+                {"title": title, "url": url, "price": price, "ebay_url": ebay_url}
+                for title, url, price, ebay_url in items
+            ],
+        }
 
 
 class MongoCli:
 
     database_name = "shouldipickitup"
     collection_name = "data"
+    listings_name = "listings"
+    prices_name = "prices"
 
     def __init__(self):
         self.dbh = self.ConnectToMongo()
-        
+        self.listings = self.ConnectToMongo(collection_name=self.listings_name)
+        self.prices = self.ConnectToMongo(collection_name=self.prices_name)
+
     def ConnectToMongo(self, database_name="shouldipickitup", collection_name="data"):
         """
         Return a database_handle to the caller
 
+        No round trip is made here - connection errors surface as
+        ServerSelectionTimeoutError (a ConnectionFailure) on the first query.
+
         Parameters
         ----------
         database_name : str
@@ -73,15 +207,10 @@ class MongoCli:
         -------
             collection_handle :  pymongo connect object
         """
-        try:
-            client = MONGOCLIENTLINE
-            client.server_info()
-            database_handle = client[database_name]
-            collection_handle = database_handle[collection_name]
-        except ConnectionFailure:
-            return None
-        else:
-            return collection_handle
+        client = get_client()
+        database_handle = client[database_name]
+        collection_handle = database_handle[collection_name]
+        return collection_handle
 
     def lookup_all_data_given_zip(self, zip):
         """
@@ -105,25 +234,105 @@ class MongoCli:
         state
             [str] - the state associated with the zip (for display only)
       """
-        response = self.dbh.find_one({"$or": [{"Zips": zip}, {"AltZips": zip}]})
+        craigs_url = self.lookup_craigs_url_given_zip(zip)
+        return self.lookup_all_data_given_craigs_url(craigs_url)
+
+    def lookup_all_data_given_craigs_url(self, craigs_url):
+        """
+        Same as lookup_all_data_given_zip, for a craigs_url already resolved
+
+        Parameters
+        ----------
+        craigs_url : str
+            The local craigslist url
+
+        Returns
+        -------
+        all_data
+            AllData object
+        """
+        response = self.lookup_listing(craigs_url, LISTING_FIELDS)
         if response is None:
-            raise ValueError("No data in MongoDB for " + str(zip))
+            raise ValueError("No data in MongoDB for " + str(craigs_url))
         else:
-            try:
-                all_data = AllData()
-                all_data.citytext = response["CityState"]
-                all_data.city, all_data.state = response["CityState"].split(",")
-                all_data.url = response["craigs_url"]
-                all_data.Items = response["Items"]
-                all_data.Urls = response["Urls"]
-                all_data.Prices = response["Prices"]
-                all_data.EBlinks = response["EbayLinks"]
-            except KeyError:
-                raise ValueError("No details in MongoDB:" + str(zip))
-            except Exception:
-                raise
-            else:
-                return all_data
+            return self.all_data_from_response(response, craigs_url)
+
+    def lookup_all_data_given_craigs_urls(self, craigs_urls):
+        """
+        Return the AllData of many regions with one $in query.
+
+        Parameters
+        ----------
+        craigs_urls : list
+            local craigslist urls
+
+        Returns
+        -------
+        {dictionary} craigs_url : AllData object - regions without data
+        (never crawled, or unknown) are left out
+        """
+        found = {}
+        wanted = list(set(craigs_urls))
+        for handle in (self.listings, self.dbh):
+            if not wanted:
+                break
+            query = {"craigs_url": {"$in": wanted}}
+            for response in handle.find(query, LISTING_FIELDS):
+                try:
+                    all_data = self.all_data_from_response(
+                        response, response["craigs_url"]
+                    )
+                except (ValueError, AttributeError):
+                    continue
+                found[all_data.url] = all_data
+            # Regions not crawled since the listings split are still in data
+            wanted = [url for url in wanted if url not in found]
+        return found
+
+    def lookup_listing(self, craigs_url, fields):
+        """
+        Return the listing document of a craigs_url, only with fields.
+
+        Regions not crawled since the listings split still carry their items
+        in the data collection, so we look there when there is no listing.
+        """
+        response = self.listings.find_one({"craigs_url": craigs_url}, fields)
+        if response is None:
+            response = self.dbh.find_one({"craigs_url": craigs_url}, fields)
+        return response
+
+    def lookup_listed_posts(self, craigs_url):
+        """
+        Return the Items, Urls, Prices and EbayLinks of a craigs_url's listing,
+        None if it has none.
+
+        Only the listings collection: items still in the data collection from
+        before the listings split are not worth updating in place.
+        """
+        return self.listings.find_one(
+            {"craigs_url": craigs_url},
+            {"_id": 0, "Items": 1, "Urls": 1, "Prices": 1, "EbayLinks": 1},
+        )
+
+    @staticmethod
+    def all_data_from_response(response, what):
+        """ Turn one MongoDB region document into an AllData object """
+        try:
+            all_data = AllData()
+            all_data.citytext = response["CityState"]
+            all_data.city, all_data.state = response["CityState"].split(",")
+            all_data.url = response["craigs_url"]
+            all_data.Items = response["Items"]
+            all_data.Urls = response["Urls"]
+            all_data.Prices = response["Prices"]
+            all_data.EBlinks = response["EbayLinks"]
+            all_data.date_crawled = response.get("DateCrawled")
+        except KeyError:
+            raise ValueError("No details in MongoDB:" + str(what))
+        except Exception:
+            raise
+        else:
+            return all_data
 
     def lookup_city_state_given_zip(self, zip):
         """
@@ -141,7 +350,9 @@ class MongoCli:
         state
             [str] - the state associated with the zip (for display only)
         """
-        response = self.dbh.find_one({"$or": [{"Zips": zip}, {"AltZips": zip}]})
+        response = self.dbh.find_one(
+            {"$or": [{"Zips": zip}, {"AltZips": zip}]}, {"_id": 0, "CityState": 1}
+        )
         if response is None:
             raise ValueError("No data in MongoCli for " + str(zip))
         else:
@@ -149,27 +360,42 @@ class MongoCli:
             return (city, state)
 
     def lookup_craigs_url_given_zip(self, zip):
-        response = self.dbh.find_one({"$or": [{"Zips": zip}, {"AltZips": zip}]})
+        response = self.dbh.find_one(
+            {"$or": [{"Zips": zip}, {"AltZips": zip}]}, ZIP_QUERY_FIELDS
+        )
         if response is None:
             raise ValueError("No data in MongoCli for " + str(zip))
         else:
             return response["craigs_url"]
 
     def lookup_zips_given_craigs_url(self, craigs_url):
-        response = self.dbh.find_one({"craigs_url": craigs_url})
+        response = self.dbh.find_one(
+            {"craigs_url": craigs_url}, {"_id": 0, "Zips": 1, "AltZips": 1}
+        )
         if response is None:
             raise ValueError("No data in MongoCli for " + str(craigs_url))
         else:
             return (response["Zips"], response["AltZips"])
 
-
     def lookup_crawled_date_given_craigs_url(self, craigs_url):
-        response = self.dbh.find_one({"craigs_url": craigs_url})
+        response = self.dbh.find_one(
+            {"craigs_url": craigs_url}, {"_id": 0, "DateCrawled": 1}
+        )
         if response is None:
             raise ValueError("No data in MongoCli for " + str(craigs_url))
         else:
             return response["DateCrawled"]
 
+    def dump_all_craigs_urls_sorted_by_date(self):
+        """
+        Return every craigs_url, least recently crawled first (never crawled
+        regions have no DateCrawled and come first). Uses the DateCrawled
+        index - see indexes.py.
+        """
+        cursor = self.dbh.find({}, {"_id": 0, "craigs_url": 1}).sort(
+            "DateCrawled", ASCENDING
+        )
+        return [doc["craigs_url"] for doc in cursor]
 
     def lookup_craigs_posts(self, zip):
         """
@@ -185,7 +411,8 @@ class MongoCli:
         Items
             {dictionary} of all the local posts in the free section
         """
-        response = self.dbh.find_one({"$or": [{"Zips": zip}, {"AltZips": zip}]})
+        craigs_url = self.lookup_craigs_url_given_zip(zip)
+        response = self.lookup_listing(craigs_url, {"_id": 0, "Items": 1})
         if response is None:
             raise ValueError
         else:
@@ -193,20 +420,37 @@ class MongoCli:
 
     def update_one_document(self, mongo_filter, mongo_doc, verbose=False):
         """
-        Update only one document in MongoDB, create it if it does not exist.
+        Update only one listing in MongoDB, create it if it does not exist.
+
+        The listing gets the crawled data plus CityState from the region
+        document; the region document only gets DateCrawled (and loses any
+        items written there before the listings split).
+
         Parameters
         ----------
         mongo_filter
-            - hash to specify mongo restriction
+            - hash to specify mongo restriction - {"craigs_url": url}
         mongo_doc
-            - key : value pairs making up the document
+            - key : value pairs making up the document - {"$set": {...}}
 
         Returns
         -------
         Items
             {MongoCli object}  of all the local posts in the free section
         """
-        new_result = self.dbh.update_one(mongo_filter, mongo_doc, upsert=True)
+        region = self.dbh.find_one(mongo_filter, {"_id": 0, "CityState": 1})
+        listing_doc = dict(mongo_doc)
+        listing_doc["$set"] = dict(mongo_doc.get("$set", {}))
+        if region is not None:
+            listing_doc["$set"]["CityState"] = region.get("CityState")
+        new_result = self.listings.update_one(mongo_filter, listing_doc, upsert=True)
+
+        region_doc = {
+            "$unset": {"Items": "", "Urls": "", "Prices": "", "EbayLinks": ""}
+        }
+        if "DateCrawled" in listing_doc["$set"]:
+            region_doc["$set"] = {"DateCrawled": listing_doc["$set"]["DateCrawled"]}
+        self.dbh.update_one(mongo_filter, region_doc, upsert=True)
         if verbose:
             print(new_result.raw_result)
         return new_result
@@ -252,8 +496,8 @@ class MongoCli:
         Invalid Docs return BulkWriteError
         """
         try:
-            # Create Index now at initial load time...
-            new_result = self.dbh.create_index("craigs_url", unique=True)
+            # Create Indexes now at initial load time... see indexes.py
+            indexes.ensure_indexes(self)
             new_result = self.dbh.insert_many(master_mongo_city_state_zip_data)
         except BulkWriteError as bwe:
             print(bwe.details)
@@ -265,6 +509,39 @@ class MongoCli:
                 print("Multiple posts: {0}".format(new_result.inserted_ids))
             return new_result
 
+    def lookup_price(self, title):
+        """
+        Return the cached {"Price": .., "EbayLink": ..} of a normalized title,
+        None if it is not cached. Price is None when eBay had no match.
+
+        The TTL monitor only runs every minute, so expired documents it has
+        not removed yet are skipped here.
+        """
+        return self.prices.find_one(
+            {"_id": title, "Expires": {"$gt": datetime.datetime.utcnow()}},
+            {"_id": 0, "Price": 1, "EbayLink": 1},
+        )
+
+    def save_price(self, title, price, ebay_link, ttl):
+        """
+        Cache the eBay price and link of a normalized title for ttl seconds.
+
+        Parameters
+        ----------
+        title
+            str - normalized title, the _id
+        price, ebay_link
+            str - None for both when eBay had no match
+        ttl
+            float - seconds until the TTL index removes it
+        """
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        return self.prices.replace_one(
+            {"_id": title},
+            {"Price": price, "EbayLink": ebay_link, "Expires": expires},
+            upsert=True,
+        )
+
     def drop_db(self):
         """
         Drop all documents (testing/etc.)
@@ -282,6 +559,8 @@ class MongoCli:
         Failure/Connection
         """
 
+        self.listings.drop()
+        self.prices.drop()
         new_result = self.dbh.drop()
         return new_result
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+""" pipeline.py - stages joined by bounded queues, each with its own threads
+
+- The crawler's steps wait on very different things: Craigslist, the
+  parser (CPU), eBay, MongoDB. Run one region at a time and only one of
+  them is ever busy. As a pipeline, region A can be parsed and written
+  while region B's eBay lookups are still in flight.
+
+- Every stage reads (key, value) jobs from its inbox, calls
+  func(key, value) on one of its worker threads and puts (key, result) in
+  the next stage's inbox. Inboxes are bounded: a fast stage blocks once the
+  next one is maxsize jobs behind (back-pressure) instead of piling up
+  pages in memory.
+
+- A job whose func raises leaves the pipeline there and comes out of run()
+  with the error and the stage it failed in; the other jobs carry on.
+
+- Each stage counts what it did (see Stage.stats): jobs done and failed,
+  throughput, busy time and how many jobs wait in its inbox.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * Outcome  - what run() yields per job: key, value, error, stage
+    * Stage    - one step: func, worker threads, inbox, counters
+    * Pipeline - stages in order; run(jobs) yields Outcomes as jobs finish
+"""
+
+import time
+import queue
+import threading
+import collections
+
+
+Outcome = collections.namedtuple("Outcome", ["key", "value", "error", "stage"])
+
+_DONE = object()
+
+
+class Stage:
+    """
+    Parameters
+    ----------
+    name : str
+        For logs and stats
+    func : callable
+        func(key, value) => value for the next stage
+    workers : int
+        Threads running func
+    maxsize : int
+        Jobs the inbox holds before whoever feeds it blocks
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=8):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = queue.Queue(maxsize=maxsize)
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.started = None
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """ Return the counters as a dict - for logging or metrics """
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        with self._lock:
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "done": self.done,
+                "failed": self.failed,
+                "per_minute": 60 * self.done / elapsed if elapsed else 0.0,
+                "busy": self.busy / (elapsed * self.workers) if elapsed else 0.0,
+                "queued": self.inbox.qsize(),
+            }
+
+
+class Pipeline:
+    """
+    Parameters
+    ----------
+    stages : list
+        Stage objects, in the order jobs go through them
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self._outcomes = queue.Queue()
+
+    def _work(self, index):
+        stage = self.stages[index]
+        last = index == len(self.stages) - 1
+        while True:
+            job = stage.inbox.get()
+            if job is _DONE:
+                with stage._lock:
+                    stage._running -= 1
+                    finished = stage._running == 0
+                if finished:
+                    # Only once every worker is done may the next stage stop
+                    if last:
+                        self._outcomes.put(_DONE)
+                    else:
+                        for _ in range(self.stages[index + 1].workers):
+                            self.stages[index + 1].inbox.put(_DONE)
+                return
+            key, value = job
+            start = time.monotonic()
+            try:
+                value = stage.func(key, value)
+            except Exception as e:
+                with stage._lock:
+                    stage.failed += 1
+                    stage.busy += time.monotonic() - start
+                self._outcomes.put(Outcome(key, None, e, stage.name))
+                continue
+            with stage._lock:
+                stage.done += 1
+                stage.busy += time.monotonic() - start
+            if last:
+                self._outcomes.put(Outcome(key, value, None, stage.name))
+            else:
+                self.stages[index + 1].inbox.put((key, value))
+
+    def _feed(self, jobs):
+        first = self.stages[0]
+        for job in jobs:
+            first.inbox.put(job)
+        for _ in range(first.workers):
+            first.inbox.put(_DONE)
+
+    def run(self, jobs):
+        """
+        Push jobs through every stage; yield an Outcome as each one leaves.
+
+        Parameters
+        ----------
+        jobs
+            iterable of (key, value) - value is what the first stage gets
+        """
+        now = time.monotonic()
+        for index, stage in enumerate(self.stages):
+            stage.started = now
+            for num in range(stage.workers):
+                threading.Thread(
+                    target=self._work,
+                    args=(index,),
+                    name=f"{stage.name}-{num}",
+                    daemon=True,
+                ).start()
+        threading.Thread(
+            target=self._feed, args=(jobs,), name="feed", daemon=True
+        ).start()
+
+        while True:
+            outcome = self._outcomes.get()
+            if outcome is _DONE:
+                return
+            yield outcome
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def describe(self):
+        """ One line per pipeline for the logs: rate, queue depth, busy % """
+        return " | ".join(
+            f"{s['stage']} {s['done']} done {s['per_minute']:.1f}/min "
+            f"q={s['queued']} busy={s['busy']:.0%}"
+            for s in self.stats()
+        )
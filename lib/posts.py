@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+""" posts.py - one Craigslist post, as little as the crawler needs of it
+
+- Parsing used to hand BeautifulSoup Tags to every later step. A Tag
+  keeps its parent, and so the whole parsed page, alive: each region in
+  flight held its tree until the region was written, and the more (or the
+  bigger) the pages in the pipeline, the bigger the crawler grew.
+
+- Post copies the few fields out as plain strs (a NavigableString would
+  keep the tree alive too) in __slots__ - no per object __dict__ - so the
+  soup can be decomposed right after parsing (see
+  extract.Extractor.free_posts). non-app/bench/bench_memory.py measures
+  the difference.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * Post     - post_id, title, href; lat, lng and price once known
+    * from_tag - a Post from a search result's title link
+"""
+
+import re
+
+
+post_id_re = re.compile(r"/(\d+)\.html")
+
+
+class Post:
+    """
+    Parameters
+    ----------
+    post_id : str
+        Craigslist's id of the post - None if the link has none
+    title : str
+        What the poster called it
+    href : str
+        Link to the post
+    """
+
+    __slots__ = ("post_id", "title", "href", "lat", "lng", "price")
+
+    def __init__(self, post_id, title, href, lat=None, lng=None, price=None):
+        self.post_id = post_id
+        self.title = title
+        self.href = href
+        self.lat = lat
+        self.lng = lng
+        self.price = price
+
+    def __repr__(self):
+        return f"Post({self.post_id!r}, {self.title!r}, {self.href!r})"
+
+
+def from_tag(tag):
+    """ Return a Post for the <a class="result-title hdrlnk"> of a result """
+    href = str(tag.get("href") or "")
+    post_id = tag.get("data-id")
+    if post_id is None:
+        found = post_id_re.search(href)
+        post_id = found.group(1) if found else None
+    return Post(
+        str(post_id) if post_id is not None else None, str(tag.get_text()), href
+    )
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+""" pricecache.py - eBay prices by title, shared by every region and run
+
+- The same titles - couch, desk, tv - turn up in hundreds of regions in
+  one crawl, and each used to cost an eBay lookup: the slowest, most rate
+  limited request we make. Titles eBay has no match for were looked up
+  again on every crawl.
+
+- Prices are kept in MongoDB's prices collection (see mongodb.py) by
+  titles.key(title) - so near-duplicate titles share one - found ones for
+  PRICE_CACHE_TTL seconds and misses for PRICE_CACHE_MISS_TTL (see
+  config.py). A TTL index on Expires (see indexes.py) removes them after
+  that.
+
+- Within a run every answer is also kept in memory: a title asked again
+  by another region is answered without going to MongoDB.
+
+- Only answers are cached: a lookup that failed on the network is not a
+  miss, and is tried again next time.
+
+- The cache is an optimization - if MongoDB errors, lookup() says unknown
+  and remember() drops the price, and the crawl goes on.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * PriceCache - lookup / remember, with counters of the lookups saved
+"""
+
+import logging
+import threading
+
+from pymongo.errors import PyMongoError
+
+try:
+    from lib import config  # if called from ..main()
+    from lib import titles
+except ModuleNotFoundError:
+    import config  # if called from .
+    import titles
+
+
+class PriceCache:
+    """
+    Parameters
+    ----------
+    mongo_cli
+        mongodb.MongoCli object
+    ttl, miss_ttl : float
+        Seconds to keep a price, and a title with no match on eBay
+    """
+
+    def __init__(self, mongo_cli, ttl=None, miss_ttl=None):
+        self.mongo_cli = mongo_cli
+        self.ttl = config.PRICE_CACHE_TTL if ttl is None else ttl
+        self.miss_ttl = config.PRICE_CACHE_MISS_TTL if miss_ttl is None else miss_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def lookup(self, title):
+        """
+        Return (price, ebay_link) cached for title - (None, None) if eBay had
+        no match - or None when eBay has to be asked.
+        """
+        key = titles.key(title)
+        if not key:
+            return None
+        with self._lock:
+            seen = self._seen.get(key)
+        if seen is not None:
+            self._count("hits" if seen[0] is not None else "negative_hits")
+            return seen
+        try:
+            cached = self.mongo_cli.lookup_price(key)
+        except PyMongoError as e:
+            logging.warning(f"Price cache lookup of {key!r} failed: {e}")
+            self._count("errors")
+            return None
+        if cached is None:
+            self._count("misses")
+            return None
+        self._count("hits" if cached["Price"] is not None else "negative_hits")
+        with self._lock:
+            seen = self._seen[key] = (cached["Price"], cached["EbayLink"])
+        return seen
+
+    def remember(self, title, price, ebay_link):
+        """ Cache what eBay said for title - price None for no match """
+        key = titles.key(title)
+        if not key:
+            return
+        with self._lock:
+            self._seen[key] = (price, ebay_link)
+        ttl = self.ttl if price is not None else self.miss_ttl
+        try:
+            self.mongo_cli.save_price(key, price, ebay_link, ttl)
+        except PyMongoError as e:
+            logging.warning(f"Price cache save of {key!r} failed: {e}")
+            self._count("errors")
+
+    @property
+    def saved(self):
+        """ eBay lookups the cache answered instead """
+        return self.hits + self.negative_hits
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "errors": self.errors,
+                "saved": self.hits + self.negative_hits,
+            }
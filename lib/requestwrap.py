@@ -10,15 +10,113 @@
 
 -This file is meant to be imported as a module.
 
-- It contains the following functions:
-    * err_web- the main function of the script wrapping requests
+- Every request first waits its turn for the host (see throttle.py), so
+  the crawler's threads stay polite to each site however many there are,
+  and then tells the throttle how the host answered - its status and how
+  long it took - so the host's rate can adapt.
+
+- Each host gets one requests.Session, shared by every thread, with up to
+  HTTP_POOL_SIZE keep-alive connections (see config.py): a region's
+  Craigslist page and every eBay lookup reuse an open TCP+TLS connection
+  instead of opening a new one per request.
+
+- 429, 5xx and connection errors / timeouts are retried HTTP_RETRIES times,
+  waiting a random time up to HTTP_BACKOFF * 2**attempt (full jitter, so
+  threads that failed together do not come back together). A Retry-After
+  header is honoured instead, and holds the host for every thread.
+
+- deadline (a time.monotonic() value) bounds a request and its retries:
+  no request starts, and no backoff sleeps, past it - DeadlineExceeded is
+  raised instead. The crawler gives each region one.
+
+- archive / replay (see archive.py): with an Archive set, every body
+  fetched is kept on disk; with a Replay set, requests are answered from
+  a past run's bodies and never reach the network or the throttle.
+
+- It contains the following:
+    * DeadlineExceeded - the deadline came first (a RequestException)
+    * session_for      - the pooled requests.Session for a url's host
+    * retry_after      - seconds a Retry-After header asks for
+    * err_web          - the main function of the script wrapping requests
+    * archive, replay  - where bodies go to, or come from (None: the web)
 
 """
 
-import requests
+import time
+import email.utils
 import random
+import logging
+import datetime
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from lib import config  # if called from ..main()
+    from lib import throttle
+except ModuleNotFoundError:
+    import config  # if called from .
+    import throttle
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+_sessions = {}
+_lock = threading.Lock()
+retried = 0
+
+# Set by the crawler: an archive.Archive keeps every body fetched, an
+# archive.Replay answers every request from one instead of the network
+archive = None
+replay = None
+
 
-def err_web(url, timeout=15):
+class DeadlineExceeded(requests.exceptions.RequestException):
+    pass
+
+
+def session_for(url):
+    """ Return the requests.Session kept for url's host - made on first use """
+    host = urlsplit(url).hostname or ""
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=config.HTTP_POOL_SIZE
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def retry_after(response):
+    """
+    Return the seconds a Retry-After header asks us to wait - None if there
+    is no such header or it is neither a number nor an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+def err_web(url, timeout=15, polite=True, deadline=None):
     """
     Catch the Errors from the Web Requests
     All or nothing here: If not 200 OK - exit the program
@@ -27,11 +125,19 @@ def err_web(url, timeout=15):
     ----------
     url : str
         The URL to crawl
+    polite : bool
+        Wait for the host's turn (throttle.host_throttle) before asking
+    deadline : float
+        time.monotonic() by which to give up, retries included
 
     Returns
     -------
     httprequest :  A  Beautiful Soup object
 
+    Exceptions
+        requests.exceptions.RequestException - once the retries are spent
+        DeadlineExceeded - the deadline would pass first
+
     Rotate the UserAgent to attempt to blend the requests in.
     see  https://deviceatlas.com/blog/list-of-user-agent-strings#desktop
 
@@ -64,13 +170,59 @@ def err_web(url, timeout=15):
         },
     ]
 
-    try:
-        httprequest = requests.get(
-            url, timeout=timeout, allow_redirects=True, headers=random.choice(user_agents)
+    global retried
+    if replay is not None:
+        return replay.response(url)
+    session = session_for(url)
+    attempt = 0
+    while True:
+        if polite and throttle.host_throttle.wait(url, deadline) is None:
+            raise DeadlineExceeded(f"No turn for {url} before the deadline")
+        request_timeout = timeout
+        if deadline is not None:
+            request_timeout = min(timeout, deadline - time.monotonic())
+            if request_timeout <= 0:
+                raise DeadlineExceeded(f"No time left for {url}")
+        start = time.monotonic()
+        try:
+            httprequest = session.get(
+                url,
+                timeout=request_timeout,
+                allow_redirects=True,
+                headers=random.choice(user_agents),
+            )
+        except RETRY_ERRORS as e:
+            throttle.host_throttle.record(url, time.monotonic() - start)
+            error, wait = e, None
+        else:
+            throttle.host_throttle.record(
+                url, time.monotonic() - start, httprequest.status_code
+            )
+            if httprequest.status_code not in RETRY_STATUSES:
+                # raise_for_status() never execs if get has connect error/timeouts
+                httprequest.raise_for_status()
+                if archive is not None:
+                    archive.store(url, httprequest)
+                return httprequest
+            error, wait = None, retry_after(httprequest)
+            if wait is not None:
+                wait = min(wait, config.HTTP_BACKOFF_MAX)
+                throttle.host_throttle.hold(url, wait)
+
+        if attempt == config.HTTP_RETRIES:
+            if error is not None:
+                raise error
+            httprequest.raise_for_status()
+        if wait is None:
+            backoff = config.HTTP_BACKOFF * 2 ** attempt
+            wait = random.uniform(0, min(backoff, config.HTTP_BACKOFF_MAX))
+        if deadline is not None and time.monotonic() + wait >= deadline:
+            raise DeadlineExceeded(f"Retrying {url} would pass the deadline")
+        attempt += 1
+        with _lock:
+            retried += 1
+        logging.warning(
+            f"Retry {attempt}/{config.HTTP_RETRIES} of {url} in {wait:.1f}s - "
+            f"{error or httprequest.status_code}"
         )
-        # raise_for_status() never execs if requests.get above has connect error/timeouts
-        httprequest.raise_for_status()
-    except Exception:
-        raise
-    else:
-        return httprequest
+        time.sleep(wait)
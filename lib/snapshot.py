@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+""" snapshot.py - every region's listing plus the zip map, in one file
+
+- The crawler writes this after each run (write_from_mongo); the Flask
+  workers open it when MongoDB is down or the breaker is open, and can
+  answer *any* zipcode from it - not just San Francisco.
+
+- No pickle: the file is a JSON header, the dense zip slots from
+  zipindex.py and one JSON blob per region. Opening it is an mmap() plus
+  parsing the header; a region's blob is only decoded when asked for.
+
+- File layout (little endian):
+
+    MAGIC | uint32 header length | header (JSON) | pad to 8 |
+    zip slots (uint16 x zipindex.SLOTS) | region blobs (JSON)
+
+  header = {"format": 1, "version": <epoch seconds written>,
+            "zip_slots_offset": int,
+            "regions": [{"craigs_url", "CityState", "offset", "length"}]}
+
+- The file is written next to its final name and os.replace()d into
+  place, so readers see the old snapshot or the new one, never half.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    *write            - write a snapshot from region docs and listings
+    *write_from_mongo - same, reading both from MongoDB
+    *Snapshot         - mmap a snapshot, lookup(zip) => listing document,
+                        zip_counts() => how many zips each region serves
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import datetime
+from array import array
+
+try:
+    from lib import config  # if called from ..main()
+    from lib import zipindex
+except ModuleNotFoundError:
+    import config  # if called from .
+    import zipindex
+
+
+MAGIC = b"SIPUSNAP"
+FORMAT = 1
+LISTING_KEYS = ("CityState", "Items", "Urls", "Prices", "EbayLinks", "DateCrawled")
+
+
+def to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"Can not snapshot {type(value)}")
+
+
+def write(region_docs, listings, file=None):
+    """
+    Write a snapshot of all regions to file, atomically.
+
+    Parameters
+    ----------
+    region_docs
+        [list] of region documents with craigs_url, CityState, Zips, AltZips
+    listings
+        {dictionary} craigs_url : listing document (Items, Urls, ...)
+    file:
+        str - name of local file (default config.SNAPSHOT_FILE)
+
+    Returns
+    -------
+    version
+        int - the version (epoch seconds) written into the header
+    """
+    file = file or config.SNAPSHOT_FILE
+    regions, slots = zipindex.build(region_docs)
+    if sys.byteorder == "big":
+        slots = array("H", slots)
+        slots.byteswap()
+
+    blobs = []
+    for region in regions:
+        listing = listings.get(region["craigs_url"])
+        if listing is None:
+            blobs.append(b"")
+            continue
+        doc = {key: listing[key] for key in LISTING_KEYS if key in listing}
+        doc.setdefault("CityState", region["CityState"])
+        blobs.append(json.dumps(doc, default=to_json, separators=(",", ":")).encode())
+
+    version = int(time.time())
+
+    # Offsets depend on the header length, which depends on the offsets:
+    # size the header with placeholder offsets first, then fill them in.
+    def header_bytes(slots_offset, blob_offsets):
+        header = {
+            "format": FORMAT,
+            "version": version,
+            "zip_slots_offset": slots_offset,
+            "regions": [
+                dict(region, offset=offset, length=len(blob))
+                for region, blob, offset in zip(regions, blobs, blob_offsets)
+            ],
+        }
+        return json.dumps(header, separators=(",", ":")).encode()
+
+    big = 2 ** 53
+    placeholder = header_bytes(big, [big] * len(blobs))
+    slots_offset = len(MAGIC) + 4 + len(placeholder)
+    slots_offset += -slots_offset % 8
+    offset = slots_offset + len(slots) * slots.itemsize
+    blob_offsets = []
+    for blob in blobs:
+        blob_offsets.append(offset)
+        offset += len(blob)
+    header = header_bytes(slots_offset, blob_offsets)
+    header += b" " * (len(placeholder) - len(header))
+
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<I", len(header)))
+        fh.write(header)
+        fh.write(b"\0" * (slots_offset - fh.tell()))
+        fh.write(slots.tobytes())
+        for blob in blobs:
+            fh.write(blob)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, file)
+    return version
+
+
+def write_from_mongo(mongo_cli, file=None):
+    """
+    Write a snapshot of every region and listing currently in MongoDB -
+    listings from the data collection for regions with none in listings.
+
+    Parameters
+    ----------
+    mongo_cli
+        mongodb.MongoCli object
+    file:
+        str - name of local file (default config.SNAPSHOT_FILE)
+    """
+    region_fields = dict.fromkeys(
+        ("craigs_url", "CityState", "Zips", "AltZips", "Neighbors"), 1
+    )
+    region_fields.update(dict.fromkeys(LISTING_KEYS, 1))
+    region_fields["_id"] = 0
+    region_docs = list(mongo_cli.dbh.find({}, region_fields))
+    # Regions not crawled since the listings split still carry their items
+    # in the data collection - mongodb.lookup_listing falls back there too
+    listings = {
+        doc["craigs_url"]: doc
+        for doc in region_docs
+        if doc.get("Items") is not None
+    }
+    listing_fields = dict.fromkeys(LISTING_KEYS, 1)
+    listing_fields.update({"_id": 0, "craigs_url": 1})
+    for doc in mongo_cli.listings.find({}, listing_fields):
+        listings[doc["craigs_url"]] = doc
+    return write(region_docs, listings, file)
+
+
+class Snapshot:
+    """
+    Read only view of a snapshot file
+
+    Parameters
+    ----------
+    file:
+        str - name of local file (default config.SNAPSHOT_FILE)
+
+    Exceptions
+    ----------
+    IOError - no snapshot file
+    ValueError - not a snapshot file, or an unknown format
+    """
+
+    def __init__(self, file=None):
+        file = file or config.SNAPSHOT_FILE
+        with open(file, "rb") as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a snapshot: {file}")
+        (header_len,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._mm[start : start + header_len].decode())
+        if header["format"] != FORMAT:
+            raise ValueError(f"Unknown snapshot format {header['format']}: {file}")
+        self.version = header["version"]
+        self.regions = header["regions"]
+        self._slots_offset = header["zip_slots_offset"]
+        self._decoded = {}
+
+    def region_id(self, zipcode):
+        zipcode = str(zipcode)
+        if len(zipcode) != 5 or not (zipcode.isascii() and zipcode.isdigit()):
+            raise ValueError(f"Not a 5 digit zip: {zipcode}")
+        (region_id,) = struct.unpack_from(
+            "<H", self._mm, self._slots_offset + 2 * int(zipcode)
+        )
+        return None if region_id == zipindex.NO_REGION else region_id
+
+    def listing(self, region_id):
+        """ Return the listing document of a region id, or None if never crawled """
+        doc = self._decoded.get(region_id)
+        if doc is None:
+            region = self.regions[region_id]
+            if not region["length"]:
+                return None
+            start = region["offset"]
+            doc = json.loads(self._mm[start : start + region["length"]].decode())
+            doc["craigs_url"] = region["craigs_url"]
+            if "DateCrawled" in doc:
+                doc["DateCrawled"] = datetime.datetime.fromisoformat(doc["DateCrawled"])
+            self._decoded[region_id] = doc
+        return doc
+
+    def lookup(self, zipcode):
+        """ Return the listing document for a zipcode, or None """
+        region_id = self.region_id(zipcode)
+        return None if region_id is None else self.listing(region_id)
+
+    def zip_counts(self):
+        """ Return the number of zips of each region id, in region id order """
+        slots = array("H")
+        start = self._slots_offset
+        slots.frombytes(self._mm[start : start + zipindex.SLOTS * slots.itemsize])
+        if sys.byteorder == "big":
+            slots.byteswap()
+        counts = [0] * len(self.regions)
+        for region_id in slots:
+            if region_id != zipindex.NO_REGION:
+                counts[region_id] += 1
+        return counts
+
+    def close(self):
+        self._mm.close()
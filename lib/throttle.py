@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+""" throttle.py - politeness per host for the crawler's many threads
+
+- The crawler used to sleep 15-45s after every eBay lookup, in one thread,
+  so the sleeps were also the only thing keeping Craigslist happy. With
+  regions crawled in parallel the limit has to be per host instead: every
+  Craigslist region is its own host and can go at its own pace, while
+  www.ebay.com is one host shared by all of them.
+
+- Each host has a token bucket refilled at its current rate. wait(url)
+  takes the next token - or reserves one that is yet to come and sleeps
+  until then - so threads asking for the same host line up one token
+  apart instead of all firing at once.
+
+- The rate adapts to how the host answers (record, called by
+  requestwrap.py after every request), additive increase / multiplicative
+  decrease, between the host's min and max rate:
+    * an answer as fast as usual         - rate + (max - min) / STEPS
+    * slow answers (latency average over
+      SLOW_FACTOR times the best seen)   - rate * SLOW_BACKOFF
+    * 5xx or connection error            - rate * ERROR_BACKOFF
+    * 429 or 503 (slow down)             - rate * LIMIT_BACKOFF
+  A healthy host is soon asked at its max rate; one that struggles or
+  pushes back gets half the requests within a couple of answers.
+
+- hold(url, seconds) stops a host's tokens for a while, for every thread at
+  once - what requestwrap.py does when a host sends Retry-After.
+
+- rates() is what the crawler logs and exports (see metrics.py).
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * HostThrottle   - adaptive token bucket per host
+    * host_throttle  - the one the crawler uses, from config.py settings
+"""
+
+import time
+import threading
+from urllib.parse import urlsplit
+
+try:
+    from lib import config  # if called from ..main()
+except ModuleNotFoundError:
+    import config  # if called from .
+
+
+STEPS = 20
+SLOW_FACTOR = 2.0
+SLOW_BACKOFF = 0.9
+ERROR_BACKOFF = 0.75
+LIMIT_BACKOFF = 0.5
+LIMIT_STATUSES = {429, 503}
+LATENCY_WEIGHT = 0.2
+
+
+class _Bucket:
+    def __init__(self, rate, min_rate, max_rate, now):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.stamp = now
+        self.held_until = now
+        self.latency = None
+        self.best = None
+
+    def refill(self, now):
+        self.tokens = min(1.0, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def scale(self, factor):
+        self.rate = max(self.min_rate, min(self.max_rate, self.rate * factor))
+
+    def step_up(self):
+        step = (self.max_rate - self.min_rate) / STEPS
+        self.rate = min(self.max_rate, self.rate + step)
+
+
+class HostThrottle:
+    """
+    Parameters
+    ----------
+    rate, min_rate, max_rate : float
+        Requests per minute to one host: to start with, and the range the
+        rate adapts in
+    hosts : dict
+        host : (rate, min_rate, max_rate) for hosts that need their own
+    """
+
+    def __init__(self, rate=30.0, min_rate=4.0, max_rate=120.0, hosts=None):
+        self.limits = (rate, min_rate, max_rate)
+        self.hosts = dict(hosts or {})
+        self.waited = 0.0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host, now):
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            rate, min_rate, max_rate = self.hosts.get(host, self.limits)
+            bucket = self._buckets[host] = _Bucket(
+                rate / 60, min_rate / 60, max_rate / 60, now
+            )
+        return bucket
+
+    def wait(self, url, deadline=None):
+        """
+        Sleep until url's host may be asked again; return seconds slept.
+
+        With a deadline (time.monotonic()) that comes before the host's next
+        token, return None at once and leave the token to someone else.
+        """
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(host, now)
+            bucket.refill(now)
+            slot = max(now, bucket.held_until)
+            if bucket.tokens < 1:
+                slot = max(slot, now + (1 - bucket.tokens) / bucket.rate)
+            if deadline is not None and slot >= deadline:
+                return None
+            bucket.tokens -= 1
+            self.waited += slot - now
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def record(self, url, latency, status=None):
+        """
+        Adapt url's host's rate to one answer.
+
+        Parameters
+        ----------
+        latency : float
+            Seconds the request took
+        status : int
+            HTTP status - None for a connection error or timeout
+        """
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(host, now)
+            bucket.refill(now)  # tokens so far at the old rate
+            if status in LIMIT_STATUSES:
+                bucket.scale(LIMIT_BACKOFF)
+            elif status is None or status >= 500:
+                bucket.scale(ERROR_BACKOFF)
+            else:
+                if bucket.latency is None:
+                    bucket.latency = latency
+                else:
+                    bucket.latency += LATENCY_WEIGHT * (latency - bucket.latency)
+                if bucket.best is None or bucket.latency < bucket.best:
+                    bucket.best = bucket.latency
+                if bucket.latency > SLOW_FACTOR * bucket.best:
+                    bucket.scale(SLOW_BACKOFF)
+                else:
+                    bucket.step_up()
+
+    def hold(self, url, seconds):
+        """ Ask url's host nothing for the next seconds, from any thread """
+        host = urlsplit(url).hostname or ""
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(host, now)
+            bucket.held_until = max(bucket.held_until, now + seconds)
+
+    def rate(self, url_or_host):
+        """ Current requests per minute to a host - its start rate if unseen """
+        host = urlsplit(url_or_host).hostname or url_or_host
+        with self._lock:
+            return self._bucket(host, time.monotonic()).rate * 60
+
+    def rates(self):
+        """ {host: current requests per minute} for every host asked so far """
+        with self._lock:
+            return {host: b.rate * 60 for host, b in self._buckets.items()}
+
+
+host_throttle = HostThrottle(
+    rate=config.CRAWL_HOST_RATE,
+    min_rate=config.CRAWL_HOST_MIN_RATE,
+    max_rate=config.CRAWL_HOST_MAX_RATE,
+    hosts={
+        "www.ebay.com": (
+            config.EBAY_HOST_RATE,
+            config.EBAY_HOST_MIN_RATE,
+            config.EBAY_HOST_MAX_RATE,
+        )
+    },
+)
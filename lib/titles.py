@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+""" titles.py - Craigslist post titles => what to ask eBay for
+
+- Titles are written to catch an eye on Craigslist, not to search eBay:
+  "FREE!! Curb alert - couch (Oakland) 🛋️ must go". Sent as they are,
+  the boilerplate and the place drown out the one word that matters and
+  eBay finds nothing. Reposts of the same thing then cost a lookup each.
+
+- canonical(title) keeps the words that describe the item:
+    * drops parts in (), [] or {} - almost always a place or a note
+    * drops cross streets ("@ 5th & Main"), zipcodes and a trailing
+      "in/near Some Place" - the capitalized words after it
+    * drops BOILERPLATE phrases and words ("curb alert", "must go", "free")
+    * folds accents, drops emoji and punctuation, lowercases
+  and falls back to the plain words when nothing would be left.
+
+- key(title) is what near-duplicates have in common: canonical words,
+  plurals made singular, sorted and without repeats - so "Brown leather
+  couches!" and "FREE leather couch, brown" share one. It keys the price
+  cache (see pricecache.py) and group().
+
+- group(posts) buckets a region's posts by key, first seen first, so the
+  crawler asks eBay once per bucket and fans the price out to every post
+  in it (see websitepuller.get_ebay_data). Titles without words have no
+  key (None): each such post is a bucket of its own, looked up alone.
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    * canonical - the eBay query for a title
+    * key       - the dedupe / cache key for a title
+    * group     - posts bucketed by key
+"""
+
+import re
+import unicodedata
+
+
+BOILERPLATE_PHRASES = [
+    r"curb\s*side\s+alert",
+    r"curb\s+alert",
+    r"first\s+come,?\s+first\s+serve[ds]?",
+    r"free\s+to\s+(a\s+)?good\s+home",
+    r"must\s+go(\s+today|\s+asap|\s+now)?",
+    r"(porch|curb|curbside)\s+pick\s*-?\s*up",
+    r"pick\s*-?\s*up\s+only",
+    r"(for|is)\s+free",
+    r"come\s+get\s+(it|them|me)",
+    r"still\s+available",
+    r"take\s+(it|them|all)",
+    r"give\s*away",
+    r"giving\s+away",
+]
+# Only listing noise: a word that could describe the item ("moving boxes",
+# "great room rug", "today show mug") stays, or unrelated items share a key
+BOILERPLATE_WORDS = {
+    "free",
+    "freebie",
+    "freebies",
+    "curb",
+    "curbside",
+    "alert",
+    "pickup",
+    "asap",
+    "fcfs",
+    "obo",
+    "please",
+    "pls",
+    "the",
+    "a",
+    "an",
+}
+
+phrases = re.compile(r"\b(" + "|".join(BOILERPLATE_PHRASES) + r")\b", re.IGNORECASE)
+brackets = re.compile(r"\([^)]*\)|\[[^\]]*\]|\{[^}]*\}")
+cross_streets = re.compile(r"@.*$")
+zipcodes = re.compile(r"\b\d{5}(-\d{4})?\b")
+# Each word of the place starts after whitespace and can not hold any, so
+# it matches one way only: an optional \s* in the repeated group let a run
+# of capitals split every which way, exponential time before the $ failed
+trailing_place = re.compile(r"\s+(?:in|near|at)(?:\s+[A-Z][\w.'-]*)+$")
+words = re.compile(r"[a-z0-9]+")
+
+
+def _ascii_words(text):
+    text = unicodedata.normalize("NFKD", text)
+    text = text.encode("ascii", "ignore").decode("ascii")
+    return words.findall(text.lower())
+
+
+def canonical(title):
+    """ "FREE!! Curb alert - couch (Oakland) must go" => "couch" """
+    text = brackets.sub(" ", title)
+    text = cross_streets.sub(" ", text)
+    text = trailing_place.sub(" ", text.rstrip(" !.?*~-"))
+    text = zipcodes.sub(" ", text)
+    text = phrases.sub(" ", text)
+    kept = [word for word in _ascii_words(text) if word not in BOILERPLATE_WORDS]
+    return " ".join(kept) or " ".join(_ascii_words(title))
+
+
+def _singular(word):
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def key(title):
+    """ Return what near-duplicate titles have in common - None for no words """
+    words = sorted({_singular(word) for word in canonical(title).split()})
+    return " ".join(words) if words else None
+
+
+def group(posts, title=lambda post: post.title):
+    """
+    Return [list] of buckets of posts sharing a key, in order of their first
+    post. A post whose title has no words (emoji, punctuation) has no key:
+    it is a bucket of its own, nothing says it is the same thing as another.
+
+    Parameters
+    ----------
+    posts
+        [list] of Craigslist posts (posts.Post)
+    title
+        post => its title
+    """
+    buckets = []
+    by_key = {}
+    for post in posts:
+        post_key = key(title(post))
+        if post_key is None:
+            buckets.append([post])
+        elif post_key in by_key:
+            by_key[post_key].append(post)
+        else:
+            by_key[post_key] = [post]
+            buckets.append(by_key[post_key])
+    return buckets
@@ -5,38 +5,48 @@
 - This script is a library for lookup on Ebay, CraigList and Lyft
 - This script requires the requests BeautifulSoup module and geopy
 - This file is meant to be imported as a module.
+- eBay is asked once per distinct title (titles.key) in a region, with
+  the title stripped down to the item (titles.canonical); the price goes
+  to every post with that title.
+- Fetching and parsing the Craigslist free page are separate steps
+  (fetch_craigs_list_free_page, parse_craigs_list_free_posts) so the
+  crawler can run them in different stages - see pipeline.py.
+- Parsing returns posts.Post records and frees the page's soup at once.
+- Pages are parsed by extract.py: only the tags we read, lxml when it is
+  installed, and the full html.parser path when that finds nothing.
 """
 
-import re
 import json
 import logging
-import time
-from random import randrange
+from urllib.parse import quote_plus
 
 import requests.exceptions
-from bs4 import BeautifulSoup
 from geopy.distance import geodesic
 
 try:
-    from lib import requestwrap  # if called from ..main()
+    from lib import extract  # if called from ..main()
+    from lib import requestwrap
+    from lib import titles
 except ModuleNotFoundError:
-    import requestwrap  # if called from .
+    import extract  # if called from .
+    import requestwrap
+    import titles
 
 
 class HTTPError(Exception):
     pass
 
 
-
-mapsre = re.compile("https://www.google.com/maps/preview/")
+class UnhandledError(Exception):
+    """ An eBay page or error we did not expect - not a "no match" to cache """
 
 
 def lookup_miles_from_user(each_item, start_lat, start_lng):
     """
     Parameters
     ----------
-    each_item : BeautifulSoup object
-        Pointer to each free item
+    each_item : posts.Post
+        Each free item - its lat and lng are set here too
 
     Returns
     -------
@@ -50,19 +60,19 @@ def lookup_miles_from_user(each_item, start_lat, start_lng):
     Exceptions
         AttributeError - a post without any text
     """
-    item_url = each_item.attrs["href"]
+    item_url = each_item.href
     craigs_resp = requestwrap.err_web(item_url)
-    craigs_soup = BeautifulSoup(craigs_resp.text, "html.parser")
-    googurl = craigs_soup.find("a", href=mapsre)
+    googurl = extract.extract("map_link", craigs_resp.text)
 
     try:
-        end_lat, end_lng, _ = (
-            googurl.attrs["href"].split("@")[1].split("z")[0].split(",")
-        )
+        if googurl is None:
+            raise AttributeError(f"No map on {item_url}")
+        end_lat, end_lng, _ = googurl.split("@")[1].split("z")[0].split(",")
         miles = geodesic((start_lat, start_lng), (end_lat, end_lng)).mi
+        each_item.lat, each_item.lng = float(end_lat), float(end_lng)
         return end_lat, end_lng, miles
     except AttributeError:
-        print(f"{each_item.text} was likely deleted")
+        print(f"{each_item.title} was likely deleted")
         raise
 
 
@@ -92,19 +102,13 @@ def lookup_cost_lyft(start_lat, start_lng, end_lat, end_lng):
 
 def lookup_city_from_cl_url(craiglisturl):
     craigs_first_free = requestwrap.err_web(craiglisturl)
-    craigs_first_free_soup = BeautifulSoup(craigs_first_free.text, "html.parser")
+    geo = extract.extract("geo_meta", craigs_first_free.text)
     try:
-        metacity = (
-            craigs_first_free_soup.find("meta", attrs={"name": "geo.placename"})
-            .get("content")
-            .lower()
-        )
-        metacity = "".join(metacity.split())
-        _, metastate = (
-            craigs_first_free_soup.find("meta", attrs={"name": "geo.region"})
-            .get("content")
-            .split("-")
-        )
+        if geo is None:
+            raise AttributeError(f"No geo meta tags on {craiglisturl}")
+        placename, region = geo
+        metacity = "".join(placename.lower().split())
+        _, metastate = region.split("-")
     except AttributeError as e:
         print(e)
         return None
@@ -113,8 +117,8 @@ def lookup_city_from_cl_url(craiglisturl):
 
 
 def get_city_from_first_free_cl_item(craigs_list_url):
-    first_item_soup = get_craigs_list_free_posts(craigs_list_url)[0]
-    url = first_item_soup.attrs["href"]
+    first_item = get_craigs_list_free_posts(craigs_list_url)[0]
+    url = first_item.href
     city = lookup_city_from_cl_url(url)
     if city is not None:
         return city
@@ -134,11 +138,13 @@ def get_craigs_list_free_posts(craigs_list_url):
     Returns
     -------
     craigs_free_posts
-        beautiful soup_object - list of all free items
-        
-        craig_posts_with_data, ebay_prices, ebay_links
-        
+        [list] of posts.Post - all free items
     """
+    return parse_craigs_list_free_posts(fetch_craigs_list_free_page(craigs_list_url))
+
+
+def craigs_list_free_url(craigs_list_url):
+    """ Return the free stuff search page of a Craigs List region """
 
     if "newyork" in craigs_list_url:
 
@@ -155,22 +161,43 @@ def get_craigs_list_free_posts(craigs_list_url):
     else:
         craigs_free_url = craigs_list_url + "/d/free-stuff/search/zip"
 
+    return craigs_free_url
+
+
+def fetch_craigs_list_free_page(craigs_list_url):
+    """ Return the HTML of a region's free stuff page - network only """
+    craigs_free_url = craigs_list_free_url(craigs_list_url)
     logging.info(f"Scraping {craigs_free_url}")
     craigs_response = requestwrap.err_web(craigs_free_url)
-    craigs_soup = BeautifulSoup(craigs_response.text, "html.parser")
-    craigs_free_posts = craigs_soup.find_all("a", class_="result-title hdrlnk")
-    return craigs_free_posts
+    return craigs_response.text
+
 
+def parse_craigs_list_free_posts(html):
+    """ Return the free posts (posts.Post) in a free stuff page - CPU only """
+    return extract.extract("free_posts", html)
 
-def get_ebay_data(craig_raw_posts, random="yes", howmany=12, timeout=30):
+
+def get_ebay_data(
+    craig_raw_posts,
+    random="yes",
+    howmany=12,
+    timeout=30,
+    deadline=None,
+    price_cache=None,
+):
 
     """
     Parameters
     ----------
-    craig_raw_posts: BeautifulSoup objects collected from free posts
-    random: string - whether to randomize sleeping crawling Ebay
+    craig_raw_posts: posts.Post objects collected from free posts
+    random: string - "yes" to wait for Ebay's turn between lookups (shared
+            by every crawler thread - see throttle.py), anything else not to
     howmany: int - how many items with prices to collect
     timeout: int - Ebay Crawl Timout
+    deadline: float - time.monotonic() by which to stop looking up and
+              return the items found so far (see requestwrap.py)
+    price_cache: pricecache.PriceCache - asked before eBay, told what eBay
+                 said (prices and no matches, not network errors)
         
     Returns
     -------
@@ -179,26 +206,52 @@ def get_ebay_data(craig_raw_posts, random="yes", howmany=12, timeout=30):
     ebay_links  - list of those links
     """
 
-    if random == "yes":
-        sleep = randrange(15, 45)
-    else:
-        sleep = 0
+    polite = random == "yes"
     ebay_prices = []
     ebay_links = []
     craig_posts_with_data=[]
     
     count=0
-    
+
+    # Reposts and near-duplicates share a key: one lookup, every post priced
+    # Titles without words are not alike: each is a bucket, looked up alone
+    buckets = titles.group(craig_raw_posts)
+    logging.info(f"{len(craig_raw_posts)} posts, {len(buckets)} distinct titles")
+
     #Log each time start from 1 in the logs
-    for num, each_post in enumerate(craig_raw_posts, 1):
+    for num, same_posts in enumerate(buckets, 1):
            
             logging.info(f"Count of items with price and link: {count}")
-        
+
+            each_post = same_posts[0]
+            cached = None
+            if price_cache is not None:
+                cached = price_cache.lookup(each_post.title)
             try:
-                price, eb_link = lookup_price_on_ebay(num, each_post,timeout=timeout)
+                if cached is not None:
+                    price, eb_link = cached
+                    logging.info(f"{num} - Cached price {price} for {each_post.title}")
+                    if price is None:
+                        raise ValueError(f"{num} - No match on Ebay (cached)")
+                else:
+                    price, eb_link = lookup_price_on_ebay(
+                        num,
+                        each_post,
+                        timeout=timeout,
+                        polite=polite,
+                        deadline=deadline,
+                    )
+                    if price_cache is not None:
+                        price_cache.remember(each_post.title, price, eb_link)
+            except requestwrap.DeadlineExceeded as e:
+                logging.warning(f"{e} - keeping the {count} items found")
+                break
             except ValueError:
+                # eBay had no match, or no price: worth remembering
+                if price_cache is not None and cached is None:
+                    price_cache.remember(each_post.title, None, None)
                 continue
-            except HTTPError:
+            except (HTTPError, UnhandledError):
                 continue
             else:
                 try:
@@ -207,74 +260,93 @@ def get_ebay_data(craig_raw_posts, random="yes", howmany=12, timeout=30):
                 except ValueError:
                     continue
                 else:
-                    ebay_prices.append(price)
-                    ebay_links.append(eb_link)
-                    craig_posts_with_data.append(each_post)
-                    count+=1
+                    for same_post in same_posts[: howmany - count]:
+                        same_post.price = price
+                        ebay_prices.append(price)
+                        ebay_links.append(eb_link)
+                        craig_posts_with_data.append(same_post)
+                        count+=1
                     if count == howmany:
                         logging.info(f"{howmany} items achieved Stopping Crawl")
                         break
-            logging.info(f"Sleeping {sleep} seconds")        
-            time.sleep(sleep)
-            
+
     return craig_posts_with_data, ebay_prices, ebay_links
 
-def lookup_price_on_ebay(num, each_post, timeout=30):
+def lookup_price_on_ebay(
+    num, each_post, timeout=30, polite=True, deadline=None, query=None
+):
     """
     Parameters
     ----------
-    each_post : BeautifulSoup object - bs4.element.Tag
-        Pointer to each free item
+    each_post : posts.Post
+        Each free item
 
     num: Index from enumerate()
+
+    polite: wait for Ebay's turn first - see throttle.py
+
+    deadline: time.monotonic() to give up by, retries included
+
+    query: what to search eBay for - titles.canonical of the post's title
+           by default (see titles.py)
     
     Returns
     -------
     price - string
         Price as per Ebay
     Exceptions
-        ValueError- a post without price and link info
+        ValueError- eBay found no match, or no price for it
+        HTTPError - eBay could not be reached
+        UnhandledError - an unexpected page or error - a price and no link,
+                         a bug; not cached as a no match
+        requestwrap.DeadlineExceeded - no time left for this lookup
     """
 
+    if query is None:
+        # An emoji only title has no words left: search for it as it is
+        query = titles.canonical(each_post.title) or each_post.title
+    query = quote_plus(query)
+
     try:
         ebay_url = "https://www.ebay.com/sch/i.html?_from=R40&_trksid=m570.l1313&_nkw="
-        ebay_path = (
-            f"{each_post.text}&_sacat=0&LH_TitleDesc=0&_osacat=0&_odkw={each_post.text}"
-        )
+        ebay_path = f"{query}&_sacat=0&LH_TitleDesc=0&_osacat=0&_odkw={query}"
         ebay_query_url = ebay_url + ebay_path
         logging.info(f"{num} - Querying {ebay_query_url}")
-        ebay_resp = requestwrap.err_web(ebay_query_url, timeout=timeout)
-        ebay_soup = BeautifulSoup(ebay_resp.text, "html.parser")
-        ebay_item_text = ebay_soup.find("h3", {"class": "s-item__title"}).get_text(separator=" ")
+        ebay_resp = requestwrap.err_web(
+            ebay_query_url, timeout=timeout, polite=polite, deadline=deadline
+        )
+        ebay_result = extract.extract("ebay_result", ebay_resp.text)
+        if ebay_result is None:
+            raise AttributeError("no s-item__title")
+        ebay_item_text = ebay_result.title
     except AttributeError:
         msg = f"{num} - No match on Ebay"
-        logging.warning(f"{msg} for {each_post.text}")
-        raise ValueError("{msg}")
+        logging.warning(f"{msg} for {each_post.title}")
+        raise ValueError(msg)
+    except requestwrap.DeadlineExceeded:
+        raise
     except requests.exceptions.RequestException as e:
-        logging.error(f"{num} - {e} - {each_post.text}")
+        logging.error(f"{num} - {e} - {each_post.title}")
         raise HTTPError
     except Exception as e:
         msg = "Unhandled"
-        logging.error(f"{msg} - {num} - {e} - {each_post.text}")
-        raise ValueError("{msg}")
+        logging.error(f"{msg} - {num} - {e} - {each_post.title}")
+        raise UnhandledError(msg)
     else:
         logging.info(f"{num} - Crawled Ebay OK - search returned: {ebay_item_text}")
         # Keep only items with price and links
-        try:
-            price = ebay_soup.find("span", {"class": "s-item__price"}).get_text()
-        except AttributeError:
+        price = ebay_result.price
+        if price is None:
             msg = f"{num} - No price on Ebay"
             logging.warning(f"{msg}  for {ebay_item_text}")
-            raise ValueError("{msg}")
+            raise ValueError(msg)
         else:
             try:
-                eb_link = ebay_soup.find("a", {"class": "s-item__link"})
-                eb_link = eb_link.attrs["href"]
-                eb_link = eb_link.partition("?")[0]
+                eb_link = ebay_result.link.partition("?")[0]
             except AttributeError:
                 msg = "Price, but no link on on Ebay?"
                 logging.warning(f"{msg} for  {ebay_item_text}")
-                raise ValueError("{msg}")
+                raise UnhandledError(msg)
             else:
                 logging.info(f"{num} - Retrieved price of {price} at {eb_link}")
             return (price, eb_link)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+""" zipindex.py - dense zipcode => craigslist region index
+
+- create_data.py builds this once from the same documents it loads into
+  MongoDB; main.py loads it once per worker so resolving a zipcode is an
+  array read instead of a query against the Zips/AltZips arrays.
+
+- Every 5 digit zip has one slot in a 100,000 entry array of unsigned
+  shorts holding a small region id (or NO_REGION). The region id is the
+  position in the region table: [{"craigs_url": ..., "CityState": ...}, ...]
+
+- Each region also lists the region ids of its nearest regions, closest
+  first ("Neighbors", worked out by create_data.py - see geoindex.py), so
+  "what else is close by" needs no distance maths when serving.
+
+- File layout (little endian):
+
+    MAGIC | uint32 length of region table | region table (JSON) | slots
+
+- This file is meant to be imported as a module.
+
+- It contains the following:
+    *build    - region table and slots from the master MongoDB documents
+    *save     - write both to file, atomically
+    *ZipIndex - read the file back, lookup(zip) => region,
+                neighbors(craigs_url) => nearest other craigs_urls
+"""
+
+import os
+import sys
+import json
+import struct
+from array import array
+
+try:
+    from lib import config  # if called from ..main()
+except ModuleNotFoundError:
+    import config  # if called from .
+
+
+MAGIC = b"ZIPIDX1\n"
+SLOTS = 100000
+NO_REGION = 0xFFFF
+
+
+def build(master_mongo_city_state_zip_data):
+    """
+    Return the region table and zip slots for the master documents.
+
+    Primary 'Zips' win over 'AltZips' when a zip shows up in both.
+
+    Parameters
+    ----------
+    master_mongo_city_state_zip_data
+        [list] of region documents as made by create_data.py
+
+    Returns
+    -------
+    regions
+        [list] of {"craigs_url": str, "CityState": str, "Neighbors": [ids]}
+    slots
+        array('H') of SLOTS region ids
+    """
+    regions = []
+    slots = array("H", [NO_REGION]) * SLOTS
+    region_ids = {
+        doc["craigs_url"]: region_id
+        for region_id, doc in enumerate(master_mongo_city_state_zip_data)
+    }
+    for region_id, doc in enumerate(master_mongo_city_state_zip_data):
+        regions.append(
+            {
+                "craigs_url": doc["craigs_url"],
+                "CityState": doc["CityState"],
+                "Neighbors": [
+                    region_ids[url]
+                    for url in doc.get("Neighbors", [])
+                    if url in region_ids
+                ],
+            }
+        )
+        for zipc in doc.get("Zips", []):
+            slots[int(zipc)] = region_id
+    for region_id, doc in enumerate(master_mongo_city_state_zip_data):
+        for zipc in doc.get("AltZips", []):
+            if slots[int(zipc)] == NO_REGION:
+                slots[int(zipc)] = region_id
+    return regions, slots
+
+
+def save(regions, slots, file=None):
+    """
+    Write the index to file; readers never see a half written file.
+
+    Parameters
+    ----------
+    regions, slots
+        as returned by build()
+    file:
+        str - name of local file (default config.ZIP_INDEX_FILE)
+    """
+    file = file or config.ZIP_INDEX_FILE
+    table = json.dumps(regions, separators=(",", ":")).encode("utf-8")
+    if sys.byteorder == "big":
+        slots = array("H", slots)
+        slots.byteswap()
+    tmp = f"{file}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<I", len(table)))
+        fh.write(table)
+        fh.write(slots.tobytes())
+    os.replace(tmp, file)
+
+
+class ZipIndex:
+    """
+    Read only zipcode => region lookups, loaded from file once
+
+    Parameters
+    ----------
+    file:
+        str - name of local file (default config.ZIP_INDEX_FILE)
+
+    Exceptions
+    ----------
+    IOError - no index file
+    ValueError - not an index file
+    """
+
+    def __init__(self, file=None):
+        file = file or config.ZIP_INDEX_FILE
+        with open(file, "rb") as fh:
+            raw = fh.read()
+        if not raw.startswith(MAGIC):
+            raise ValueError(f"Not a zip index: {file}")
+        offset = len(MAGIC)
+        (table_len,) = struct.unpack_from("<I", raw, offset)
+        offset += 4
+        self.regions = json.loads(raw[offset : offset + table_len].decode("utf-8"))
+        offset += table_len
+        self.slots = array("H")
+        self.slots.frombytes(raw[offset : offset + SLOTS * 2])
+        if sys.byteorder == "big":
+            self.slots.byteswap()
+        if len(self.slots) != SLOTS:
+            raise ValueError(f"Truncated zip index: {file}")
+        self._region_ids = {
+            region["craigs_url"]: region_id
+            for region_id, region in enumerate(self.regions)
+        }
+
+    def region_id(self, zipcode):
+        """ Return the region id for a zipcode, or None """
+        zipcode = str(zipcode)
+        if len(zipcode) != 5 or not (zipcode.isascii() and zipcode.isdigit()):
+            raise ValueError(f"Not a 5 digit zip: {zipcode}")
+        region_id = self.slots[int(zipcode)]
+        return None if region_id == NO_REGION else region_id
+
+    def lookup(self, zipcode):
+        """ Return {"craigs_url": ..., "CityState": ...} for a zipcode, or None """
+        region_id = self.region_id(zipcode)
+        return None if region_id is None else self.regions[region_id]
+
+    def craigs_url(self, zipcode):
+        region = self.lookup(zipcode)
+        return None if region is None else region["craigs_url"]
+
+    def neighbors(self, craigs_url):
+        """ Return the craigs_urls of the regions nearest craigs_url, closest first """
+        region_id = self._region_ids.get(craigs_url)
+        if region_id is None:
+            return []
+        return [
+            self.regions[neighbor]["craigs_url"]
+            for neighbor in self.regions[region_id].get("Neighbors", [])
+        ]
@@ -11,31 +11,324 @@ It then returns the free items (see below) associated with that MongoDB doc.
 - If there is no data for the zipcode entered, S.F data will be returned
 - If MongoDB is down S.F data will be returned (if data was crawled and loaded)
 
+- Calls to MongoDB go through a circuit breaker (see breaker.py). After
+  BREAKER_FAILURES connection failures in a row we stop calling MongoDB and
+  answer from memory until a background probe sees MongoDB healthy again:
+  the cached region, else the region from the crawler's snapshot of every
+  region (see snapshot.py), else the S.F pickle. Both files are read once
+  per worker, not once per request - the snapshot again when the crawler
+  writes a new one.
+
 -This script requires the mongodb helper module.
 
+- The zip => craigs_url step is an array read in the index built by
+  create_data.py (see zipindex.py), loaded once per worker. Without that
+  file we fall back to querying 'Zips'/'AltZips' and caching the answer.
+
+- Region data is cached per worker (see cache.py): craigs_url => region
+  data, so all the zips of one region share one entry. Stale entries are
+  revalidated by comparing DateCrawled.
+
+- Each step is timed (resolve_zip, mongo_fetch, fallback) into the
+  histograms served on /metrics (see metrics.py).
+
 -This file can also be imported as a module and contains the following
 functions:
 
     * main - the main function of the script
-
-TBD: If MondoDB is down don't load a file every time ...
+    * lookup_page - what main returns, as a dict, plus craigs_url and
+      date_crawled so callers can cache per region version
+    * lookup_region - cached zipcode => region data
+    * get_zip_index - the zipcode => region index, loaded once
+    * find_region - lookup_region through the circuit breaker
+    * lookup_many - many zipcodes at once, each region fetched once
+    * nearby_regions - the regions closest to a region, from the zip index
+    * get_snapshot - the all regions snapshot, opened again when it changes
+    * fallback_to_pickle - S.F data, loaded once
+    * page_from_region - lookup_page's dict for a region
+    * ZIP_TOKEN - stands for the zip in a page rendered for a whole region
+    * warm_up - load all of the above before gunicorn forks
 
 """
 
+import os
 import logging
 
-# logger = logging.getLogger(__name__)
-
-import pymongo
 from pymongo.errors import ConnectionFailure
 
+from lib import breaker
+from lib import cache
+from lib import config
+from lib import metrics
 from lib import mongodb
 from lib import pickledata
+from lib import snapshot
+from lib import zipindex
+
+
+logger = logging.getLogger(__name__)
+
+# Where the zip goes in a rendered results page: pages are rendered once
+# per region and the zip put in per request (should_flask.py), or by
+# nginx's sub_filter for the static pages (export_static.py)
+ZIP_TOKEN = "__SHOULDIPICKITUP_ZIP__"
+
+zip_to_url = cache.TTLCache(maxsize=config.ZIP_CACHE_SIZE, ttl=config.ZIP_CACHE_TTL)
+region_cache = cache.TTLCache(
+    maxsize=config.REGION_CACHE_SIZE, ttl=config.REGION_CACHE_TTL
+)
+
+_zip_index = None
+_zip_index_loaded = False
+
+_snapshot = None
+_snapshot_loaded = False
+_snapshot_file_id = None
+
+_fallback_doc = None
+_fallback_loaded = False
+
+
+def ping_mongo():
+    mongodb.get_client().admin.command("ping")
+
+
+mongo_breaker = breaker.CircuitBreaker(
+    "mongodb",
+    probe=ping_mongo,
+    failure_threshold=config.BREAKER_FAILURES,
+    probe_interval=config.BREAKER_PROBE_INTERVAL,
+)
+
+
+def get_zip_index():
+    """Return the zipcode => region index, or None if there is no index file.
+
+    The file is read once per process; a missing file is not retried.
+    """
+    global _zip_index, _zip_index_loaded
+    if not _zip_index_loaded:
+        try:
+            _zip_index = zipindex.ZipIndex()
+        except (IOError, ValueError) as e:
+            # Not fatal, but every zip now costs a MongoDB query: say so loudly
+            logger.error(
+                f"NO ZIP INDEX ({config.ZIP_INDEX_FILE}) - every zip lookup "
+                f"queries MongoDB, run lib/create_data.py index => {str(e)}"
+            )
+            _zip_index = None
+        _zip_index_loaded = True
+    return _zip_index
+
+
+def get_snapshot():
+    """Return the snapshot of all regions, or None if there is no snapshot.
+
+    The file is mapped once per version: the crawler os.replace()s it after
+    each run, so each call stats it and maps it again when its inode or
+    mtime changed - or when it shows up after the worker started without
+    one. A worker keeps the last good snapshot if the file goes away.
+    """
+    global _snapshot, _snapshot_loaded, _snapshot_file_id
+    try:
+        stat = os.stat(config.SNAPSHOT_FILE)
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+    except OSError:
+        file_id = None
+    if file_id is not None and file_id != _snapshot_file_id:
+        try:
+            # The old map is closed once the requests still reading it are done
+            _snapshot = snapshot.Snapshot()
+            logger.info(f"Snapshot version {_snapshot.version} mapped")
+        except (IOError, ValueError) as e:
+            logger.warning(f"Unusable snapshot, keeping the one we have => {e}")
+        _snapshot_file_id = file_id
+        _snapshot_loaded = True
+    elif not _snapshot_loaded:
+        logger.warning("No snapshot, S.F data only when MongoDB is down")
+        _snapshot_loaded = True
+    return _snapshot
+
+
+def lookup_region(zipcode, use_mongo=True):
+    """Return the region data for a zipcode, from the cache when possible.
+
+    Parameters
+    ----------
+    zipcode : str
+        5 digit zipcode
+    use_mongo : bool
+        False when MongoDB is unavailable: answer from the cache (stale or
+        not) or the snapshot, or raise CircuitOpen
+
+    Returns
+    -------
+    all_data
+        mongodb.AllData object
+
+    Exceptions
+    ----------
+    ValueError - no data for that zipcode
+    ConnectionFailure - MongoDB down
+    CircuitOpen - use_mongo is False and the region is in neither
+    """
+    with metrics.stage("resolve_zip"):
+        zip_index = get_zip_index()
+        if zip_index is not None:
+            craigs_url = zip_index.craigs_url(zipcode)
+            if craigs_url is None:
+                raise ValueError("No region in zip index for " + str(zipcode))
+        elif use_mongo:
+            craigs_url = zip_to_url.get(zipcode)
+        else:
+            craigs_url = zip_to_url.peek(zipcode)
+
+    if not use_mongo:
+        with metrics.stage("fallback"):
+            all_data = region_cache.peek(craigs_url) if craigs_url else None
+            if all_data is None:
+                snap = get_snapshot()
+                listing = snap.lookup(zipcode) if snap is not None else None
+                if listing is None:
+                    msg = "MongoDB unavailable, no data for "
+                    raise breaker.CircuitOpen(msg + zipcode)
+                all_data = mongodb.MongoCli.all_data_from_response(listing, zipcode)
+        return all_data
+
+    all_data = region_cache.get(craigs_url) if craigs_url else None
+    if all_data is not None:
+        return all_data
+
+    with metrics.stage("mongo_fetch"):
+        mongocli = mongodb.MongoCli()
+        if craigs_url is None:
+            all_data = mongocli.lookup_all_data_given_zip(zipcode)
+            zip_to_url.put(zipcode, all_data.url)
+            region_cache.put(all_data.url, all_data)
+            return all_data
+
+        stale = region_cache.peek(craigs_url)
+        if stale is not None:
+            date_crawled = mongocli.lookup_crawled_date_given_craigs_url(craigs_url)
+            if date_crawled == stale.date_crawled:
+                region_cache.touch(craigs_url)
+                return stale
+
+        all_data = mongocli.lookup_all_data_given_craigs_url(craigs_url)
+        region_cache.put(craigs_url, all_data)
+        return all_data
+
+
+def find_region(zipcode):
+    """Return lookup_region(zipcode), minding the MongoDB circuit breaker.
+
+    A connection failure counts against the breaker and the request is
+    answered from memory (cache, then snapshot) instead.
+    """
+    if not mongo_breaker.allow():
+        return lookup_region(zipcode, use_mongo=False)
+    try:
+        all_data = lookup_region(zipcode)
+    except ConnectionFailure as e:
+        msg = "MongoDB Connection Errors - DB down? "
+        logger.error(f"{msg} => {str(e)}")
+        mongo_breaker.record_failure()
+        return lookup_region(zipcode, use_mongo=False)
+    else:
+        mongo_breaker.record_success()
+        return all_data
+
+
+def resolve_craigs_url(zipcode, mongocli):
+    """Return the craigs_url of a zipcode (index, cache, then MongoDB) or None"""
+    zip_index = get_zip_index()
+    if zip_index is not None:
+        return zip_index.craigs_url(zipcode)
+    craigs_url = zip_to_url.get(zipcode)
+    if craigs_url is None:
+        try:
+            craigs_url = mongocli.lookup_craigs_url_given_zip(zipcode)
+        except ValueError:
+            return None
+        zip_to_url.put(zipcode, craigs_url)
+    return craigs_url
+
+
+def lookup_many(zipcodes):
+    """Return the region data for many zipcodes, fetching each region once.
+
+    Zipcodes are grouped by region first; regions not fresh in the cache
+    are fetched together with a single $in query. With MongoDB down (or the
+    breaker open) regions come from the cache or the snapshot instead.
+
+    Parameters
+    ----------
+    zipcodes : list
+        5 digit zipcodes, already validated
+
+    Returns
+    -------
+    regions
+        {dictionary} craigs_url : mongodb.AllData
+    zip_to_region
+        {dictionary} zipcode : craigs_url, or None when there is no data
+    """
+    regions, zip_to_region = {}, {}
+    if mongo_breaker.allow():
+        try:
+            mongocli = mongodb.MongoCli()
+            for zipcode in zipcodes:
+                zip_to_region[zipcode] = resolve_craigs_url(zipcode, mongocli)
+            missing = []
+            for craigs_url in set(zip_to_region.values()) - {None}:
+                all_data = region_cache.get(craigs_url)
+                if all_data is None:
+                    missing.append(craigs_url)
+                else:
+                    regions[craigs_url] = all_data
+            if missing:
+                fetched = mongocli.lookup_all_data_given_craigs_urls(missing)
+                for craigs_url, all_data in fetched.items():
+                    region_cache.put(craigs_url, all_data)
+                regions.update(fetched)
+        except ConnectionFailure as e:
+            msg = "MongoDB Connection Errors - DB down? "
+            logger.error(f"{msg} => {str(e)}")
+            mongo_breaker.record_failure()
+        else:
+            mongo_breaker.record_success()
+            for zipcode, craigs_url in zip_to_region.items():
+                if craigs_url not in regions:
+                    zip_to_region[zipcode] = None
+            return regions, zip_to_region
+
+    regions, zip_to_region = {}, {}
+    for zipcode in zipcodes:
+        try:
+            all_data = lookup_region(zipcode, use_mongo=False)
+        except (ValueError, breaker.CircuitOpen):
+            zip_to_region[zipcode] = None
+        else:
+            regions[all_data.url] = all_data
+            zip_to_region[zipcode] = all_data.url
+    return regions, zip_to_region
+
+
+def nearby_regions(craigs_url):
+    """Return the craigs_urls nearest craigs_url, closest first (see geoindex.py)
+
+    Worked out by create_data.py and kept in the zip index, so this is a
+    list read; [] without a zip index or for an unknown craigs_url.
+    """
+    zip_index = get_zip_index()
+    return [] if zip_index is None else zip_index.neighbors(craigs_url)
 
 
 def main(zipcode):
     """Send data to flask template for display after querying MongoDB.
 
+    See lookup_page - this returns its values as a tuple.
+
     Parameters
     ----------
     zipcode : str
@@ -55,6 +348,32 @@ def main(zipcode):
     start_lat
     start_lng    to be used to calculate distance (disabled for now)
 
+    """
+    page = lookup_page(zipcode)
+    return (
+        page["all_posts"],
+        page["all_links"],
+        page["all_cust"],
+        page["city"],
+        page["state"],
+    )
+
+
+def lookup_page(zipcode):
+    """Return everything the results page shows for a zipcode.
+
+    Parameters
+    ----------
+    zipcode : str
+        zipcode code the user entered - inbound from Flask or from cmd line.
+
+    Returns
+    -------
+    {dictionary} with
+        all_posts, all_links, all_cust, city, state - as for main()
+        craigs_url - the region the data came from ("" for the fallbacks)
+        date_crawled - DateCrawled of that region (None for the fallbacks);
+            together with craigs_url it names one version of the page
     """
     start_lat = "40.6490763"
     start_lng = "-73.9762069"
@@ -71,30 +390,29 @@ def main(zipcode):
         f"Sorry didn't find data for {zipcode} " f"here's items for San Francisco",
         "CA",
     )
+    craigs_url, date_crawled = ("", None)
     try:
 
         """ Given a zipcode, find the Craigslist Url """
-        mongocli = mongodb.MongoCli()
-        all_data = mongocli.lookup_all_data_given_zip(zipcode)
-        city = all_data.city.capitalize()
-        state = all_data.state.capitalize()
-        all_posts = list(all_data.Items.values())
-        all_links = list(all_data.Urls.values())
-        all_prices = list(all_data.Prices.values())
-        all_eblnks = list(all_data.EBlinks.values())
-        all_cust = list(zip(all_eblnks, all_prices))
+        all_data = find_region(zipcode)
+        page = page_from_region(all_data)
+        city, state = (page["city"], page["state"])
+        all_posts, all_links = (page["all_posts"], page["all_links"])
+        all_cust = page["all_cust"]
+        craigs_url, date_crawled = (page["craigs_url"], page["date_crawled"])
 
     except (ValueError, KeyError) as e:
 
         msg = f"Going to retrieve pickle data"
-        all_posts, all_links = fallback_to_pickle()
+        with metrics.stage("fallback"):
+            all_posts, all_links = fallback_to_pickle() or (all_posts, all_links)
         logger.error(f"{msg} => {str(e)}")
 
-    except ConnectionFailure as e:
+    except breaker.CircuitOpen as e:
 
-        msg = "MongoDB Connection Errors - DB down? "
-        all_posts, all_links = fallback_to_pickle()
-        logger.error(f"{msg} => {str(e)}")
+        with metrics.stage("fallback"):
+            all_posts, all_links = fallback_to_pickle() or (all_posts, all_links)
+        logger.debug(str(e))
 
     except Exception as e:
 
@@ -103,10 +421,18 @@ def main(zipcode):
 
     else:
 
-        print("Match:", craigs_list_url, city, state, items)
+        logger.debug(f"Match: {all_data.url} {city} {state}")
 
     finally:
-        return all_posts, all_links, all_cust, city, state
+        return {
+            "all_posts": all_posts,
+            "all_links": all_links,
+            "all_cust": all_cust,
+            "city": city,
+            "state": state,
+            "craigs_url": craigs_url,
+            "date_crawled": date_crawled,
+        }
 
         """ Given the free items, see:                      """
         """ 1) How far away?                                """
@@ -114,8 +440,73 @@ def main(zipcode):
         """ 3) How much for a Lyft                          """
 
 
+def page_from_region(all_data):
+    """Return the lookup_page dict for a region's mongodb.AllData
+
+    Also what export_static.py renders the static pages from, so the page
+    nginx serves and the one gunicorn serves are built the same way.
+    """
+    return {
+        "all_posts": list(all_data.Items.values()),
+        "all_links": list(all_data.Urls.values()),
+        "all_cust": list(zip(all_data.EBlinks.values(), all_data.Prices.values())),
+        "city": all_data.city.capitalize(),
+        "state": all_data.state.capitalize(),
+        "craigs_url": all_data.url,
+        "date_crawled": all_data.date_crawled,
+    }
+
+
+def warm_up(top_regions=None):
+    """Load the zip index, snapshot and S.F data, and optionally cache regions.
+
+    Meant for the gunicorn master (preload_app - see should_flask.warm_up):
+    the workers forked from it then share all of it copy-on-write instead
+    of each reading the files on its first requests. MongoDB is not used.
+
+    Parameters
+    ----------
+    top_regions : int
+        Put this many regions from the snapshot in the region cache, those
+        serving the most zips first (default config.WARM_UP_REGIONS)
+
+    Returns
+    -------
+    [list] of the mongodb.AllData put in the region cache
+    """
+    if top_regions is None:
+        top_regions = config.WARM_UP_REGIONS
+    get_zip_index()
+    snap = get_snapshot()
+    fallback_to_pickle()
+
+    warmed = []
+    if snap is not None and top_regions > 0:
+        counts = snap.zip_counts()
+        biggest = sorted(range(len(counts)), key=counts.__getitem__, reverse=True)
+        for region_id in biggest[:top_regions]:
+            listing = snap.listing(region_id)
+            if listing is None or not counts[region_id]:
+                continue
+            try:
+                all_data = mongodb.MongoCli.all_data_from_response(
+                    listing, listing["craigs_url"]
+                )
+            except (ValueError, AttributeError) as e:
+                logger.warning(f"Not warming {listing['craigs_url']} => {str(e)}")
+                continue
+            region_cache.put(all_data.url, all_data)
+            warmed.append(all_data)
+    logger.info(f"Warmed up: {len(warmed)} regions cached")
+    return warmed
+
+
 def fallback_to_pickle():
     """ Return SF data from local if Mongdb is down/server Timeout.
+
+    The pickle is read on first use only and then kept in memory; if it
+    can not be read we say so once and return None from then on.
+
     Parameters
     ----------
     none
@@ -127,15 +518,21 @@ def fallback_to_pickle():
     all_links
         A [list] of all the local posts in the free sections
     """
-    try:
-        pickled = pickledata.loadit(file="data/sf.pickle")
-        all_posts = list(pickled["$set"]["Items"].values())
-        all_links = list(pickled["$set"]["Urls"].values())
-        return all_posts, all_links
-    except (IOError, KeyError, TypeError) as e:
-        msg = "Even the file is erroring!: "
-        logger.error(f"{msg} => {str(e)}")
-        # Sms/page out
+    global _fallback_doc, _fallback_loaded
+    if not _fallback_loaded:
+        try:
+            pickled = pickledata.loadit(file=config.FALLBACK_PICKLE_FILE)
+            _fallback_doc = (
+                list(pickled["$set"]["Items"].values()),
+                list(pickled["$set"]["Urls"].values()),
+            )
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            msg = "Even the file is erroring!: "
+            logger.error(f"{msg} => {str(e)}")
+            # Sms/page out
+            _fallback_doc = None
+        _fallback_loaded = True
+    return _fallback_doc
 
 
 if __name__ == "__main__":
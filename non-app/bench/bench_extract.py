@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+""" bench_extract.py - parse time and allocations per page, per extractor
+
+- Runs every lib/extract.py extractor over the saved pages in fixtures/:
+
+    craigslist_free.html - a free stuff search page, 120 posts (free_posts)
+    craigslist_post.html - one post's page (geo_meta, map_link)
+    ebay_search.html     - an eBay search with 50 results (ebay_result)
+    ebay_no_match.html   - an eBay search that found nothing (ebay_result)
+
+  The pages are cut down copies in the shape of the real ones: the tags
+  we read, in their real surroundings, and the scripts, styles, menus and
+  filters around them.
+
+- For each page and extractor it reports:
+    ms_median / ms_min - time per parse, over repeat runs
+    peak_kb            - most memory held during one parse (tracemalloc)
+    same_as_full       - found exactly what the full html.parser path finds
+
+- The fast extractor only uses lxml if it is installed (see "lxml" in the
+  output). Needs bs4. Prints JSON, so runs can be compared across commits:
+
+    ./bench_extract.py [repeat]
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(os.path.dirname(here))
+sys.path.append(os.path.join(top, "lib"))
+
+import extract
+
+
+PAGES = {
+    "craigslist_free.html": ["free_posts"],
+    "craigslist_post.html": ["geo_meta", "map_link"],
+    "ebay_search.html": ["ebay_result"],
+    "ebay_no_match.html": ["ebay_result"],
+}
+
+
+def comparable(found):
+    """ Posts have no __eq__ - compare their fields """
+    if isinstance(found, list):
+        return [(post.post_id, post.title, post.href) for post in found]
+    return found
+
+
+def one(extractor, what, html, repeat):
+    read = getattr(extractor, what)
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        read(html)
+        runs.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    found = read(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    expected = getattr(extract.full, what)(html)
+    return {
+        "ms_median": round(statistics.median(runs), 3),
+        "ms_min": round(min(runs), 3),
+        "peak_kb": round(peak / 1024),
+        "same_as_full": comparable(found) == comparable(expected),
+    }
+
+
+if __name__ == "__main__":
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    results = {"lxml": extract.lxml is not None, "repeat": repeat}
+    for page, reads in PAGES.items():
+        with open(os.path.join(here, "fixtures", page)) as fh:
+            html = fh.read()
+        for what in reads:
+            results[f"{page} {what}"] = {
+                name: one(extractor, what, html, repeat)
+                for name, extractor in extract.EXTRACTORS.items()
+            }
+
+    print(json.dumps(results, indent=2))
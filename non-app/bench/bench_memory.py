@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+""" bench_memory.py - what parsed free stuff pages keep alive: Tags vs Posts
+
+- The crawler holds the parsed posts of every region in flight until the
+  region is written (see lib/pipeline.py). This keeps `regions` pages'
+  worth of posts alive at once, parsed two ways:
+
+    tags  - BeautifulSoup Tags, as parse_craigs_list_free_posts used to
+            return (each one keeps its whole page's tree alive)
+    posts - websitepuller.parse_craigs_list_free_posts: posts.Post records,
+            soup decomposed after parsing
+
+  for more and more regions in flight, and for plain and for heavy pages
+  (the same posts with more markup around each one).
+
+- Each case runs in a fresh process and reports:
+    retained_kb - tracemalloc, what the kept posts still hold
+    peak_kb     - tracemalloc, the most held while parsing
+    rss_kb      - ru_maxrss of the process, less what it was before parsing
+
+- Needs bs4 (requirements.txt). Prints JSON, so runs can be compared:
+
+    ./bench_memory.py [posts_per_page]
+"""
+
+import os
+import sys
+import gc
+import json
+import resource
+import subprocess
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(os.path.dirname(here))
+sys.path.append(os.path.join(top, "lib"))
+
+from bs4 import BeautifulSoup
+
+import websitepuller
+
+
+REGIONS = (1, 8, 32)
+FILLER_WORDS = {"plain": 0, "heavy": 200}
+
+ROW = """
+<li class="result-row" data-pid="{pid}" data-repost-of="{repost}">
+  <a href="https://sfbay.craigslist.org/eby/zip/d/oakland-thing/{pid}.html"
+     class="result-image gallery" data-ids="3:00k0k_{pid},3:00a0a_{pid}">
+  </a>
+  <div class="result-info">
+    <span class="icon icon-star" role="button">
+      <span class="screen-reader-text">favorite this post</span>
+    </span>
+    <time class="result-date" datetime="2020-04-01 12:00" title="Wed 01 Apr 12:00">
+      Apr  1
+    </time>
+    <h3 class="result-heading">
+      <a href="https://sfbay.craigslist.org/eby/zip/d/oakland-thing/{pid}.html"
+         data-id="{pid}" class="result-title hdrlnk" id="postid_{pid}">{title}</a>
+    </h3>
+    <span class="result-meta">
+      <span class="result-hood"> (oakland)</span>
+      <span class="result-tags"><span class="pictag">pic</span></span>
+      <span class="banish icon icon-trash" role="button"></span>
+      <span class="unbanish icon icon-trash red" role="button"></span>
+      <span class="result-blurb">{filler}</span>
+    </span>
+  </div>
+</li>"""
+
+TITLES = ["free couch", "desk - must go", "curb alert: tv", "box of books", "lamp"]
+
+
+def make_page(region, posts_per_page, filler_words):
+    rows = []
+    for num in range(posts_per_page):
+        pid = 7000000000 + region * 10000 + num
+        rows.append(
+            ROW.format(
+                pid=pid,
+                repost=pid - 1,
+                title=f"{TITLES[num % len(TITLES)]} #{num}",
+                filler=" ".join(f"word{w}" for w in range(filler_words)),
+            )
+        )
+    return (
+        "<html><head><title>free stuff</title></head><body>"
+        '<ul class="rows">' + "".join(rows) + "</ul></body></html>"
+    )
+
+
+def parse_tags(html):
+    craigs_soup = BeautifulSoup(html, "html.parser")
+    return craigs_soup.find_all("a", class_="result-title hdrlnk")
+
+
+PARSERS = {"tags": parse_tags, "posts": websitepuller.parse_craigs_list_free_posts}
+
+
+def one(parser, regions, posts_per_page, filler_words):
+    """ Parse regions pages, keep what parser returns; measure memory """
+    pages = [make_page(r, posts_per_page, filler_words) for r in range(regions)]
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    kept = [PARSERS[parser](html) for html in pages]
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "posts": sum(len(found) for found in kept),
+        "retained_kb": round(retained / 1024),
+        "peak_kb": round(peak / 1024),
+        "rss_kb": rss_after - rss_before,
+    }
+
+
+def in_fresh_process(*args):
+    out = subprocess.run(
+        [sys.executable, __file__, "--one", *map(str, args)],
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    return json.loads(out)
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ["--one"]:
+        parser, *sizes = sys.argv[2:6]
+        print(json.dumps(one(parser, *map(int, sizes))))
+        sys.exit(0)
+
+    posts_per_page = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    results = {"posts_per_page": posts_per_page}
+    for page, filler_words in FILLER_WORDS.items():
+        for parser in PARSERS:
+            results[f"{parser}_{page}"] = {
+                f"regions_{regions}": in_fresh_process(
+                    parser, regions, posts_per_page, filler_words
+                )
+                for regions in REGIONS
+            }
+
+    print(json.dumps(results, indent=2))
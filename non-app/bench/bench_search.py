@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+""" bench_search.py - benchmark the search path against an in-memory MongoDB
+
+- Needs mongomock (pip install mongomock) on top of requirements.txt. No
+  MongoDB server is used: mongodb.set_client() swaps in a mongomock client
+  seeded with create_data.py's documents for every region in
+  data/craigs_links.txt, plus 15 made up items per region.
+
+  Zips come from data/free-zipcode-database-Primary.no.header.csv when it
+  is there; otherwise each city gets a made up block of zips, and a few
+  made up towns per region are left out of craigs_links so create_data.py
+  files them under AltZips, as it does with the real file.
+
+- The zip index and the snapshot are written to a temporary DATA_DIR, as
+  create_data.py and crawler.py would.
+
+- warm_up: should_flask.warm_up(), as the gunicorn master runs it before
+  forking, timed. It is not traffic: fails (exit status 1) if it left any
+  stage observation or cache lookup in the metrics.
+
+- Micro benchmarks (one thread, per call):
+    lookup_all_data_given_zip - MongoCli only
+    main_cold                 - main.main() with the caches cleared
+    main_warm                 - main.main() with the caches warm (an
+                                untimed pass fills them first; every
+                                timed call must hit the region cache)
+
+- Load (/search/ through Flask's test client, from THREADS threads):
+    cold       - caches cleared, then one zip of each region
+    warm       - REQUESTS random zips, every region already cached
+    mongo_down - MongoDB unreachable: breaker, then cache/snapshot
+
+- Prints JSON, so runs can be compared across commits:
+
+    ./bench_search.py [requests] [threads]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, top)
+
+# config.py reads the environment on import
+tmp_dir = tempfile.TemporaryDirectory()
+os.environ["DATA_DIR"] = tmp_dir.name
+os.environ.setdefault("BREAKER_PROBE_INTERVAL", "3600")
+os.environ.setdefault("WARM_UP_REGIONS", "50")
+
+import mongomock
+import prometheus_client
+from pymongo import MongoClient
+
+from lib import create_data
+from lib import metrics
+from lib import mongodb
+from lib import snapshot
+from lib import zipindex
+
+import main
+import should_flask
+
+
+HOWMANY = 15
+ZIPS_PER_CITY = 150
+ALT_TOWNS_PER_REGION = 2
+ALT_ZIPS_PER_TOWN = 25
+gov_zip_file = os.path.join(top, "data", "free-zipcode-database-Primary.no.header.csv")
+craigs_links_file = os.path.join(top, "data", "craigs_links.txt")
+
+
+def made_up_gov_zips(craigs_city_links):
+    """ city,STATE => zips, in the shape of create_gov_city_state_mutlizips_map """
+    gov_city_state_zips = {}
+    next_zip = 1000
+    for num, citystate in enumerate(craigs_city_links):
+        state = citystate.split(",")[-1]
+        gov_city_state_zips[citystate] = [
+            f"{z:05}" for z in range(next_zip, next_zip + ZIPS_PER_CITY)
+        ]
+        next_zip += ZIPS_PER_CITY
+        for town in range(ALT_TOWNS_PER_REGION):
+            gov_city_state_zips[f"benchtown{num}x{town},{state}"] = [
+                f"{z:05}" for z in range(next_zip, next_zip + ALT_ZIPS_PER_TOWN)
+            ]
+            next_zip += ALT_ZIPS_PER_TOWN
+    return gov_city_state_zips
+
+
+def made_up_listing(url):
+    nums = range(1, HOWMANY + 1)
+    return {
+        "Items": {f"Item{i}": f"free thing number {i}" for i in nums},
+        "Urls": {f"Url{i}": f"{url}/zip/d/thing/{7000000000 + i}.html" for i in nums},
+        "Prices": {f"Price{i}": f"{i}.99" for i in nums},
+        "EbayLinks": {f"EbayLink{i}": f"https://www.ebay.com/itm/{i}" for i in nums},
+        "DateCrawled": datetime.datetime(2020, 4, 1, 12, 0, 0),
+    }
+
+
+def seed():
+    """
+    Load create_data.py's documents and a listing per region into mongomock,
+    write the zip index and snapshot, and return {craigs_url: [zips]}.
+    """
+    craigs_city_links = create_data.create_craigs_url_dict_from_local_file(
+        craigs_links_file
+    )
+    if os.path.exists(gov_zip_file):
+        gov_city_state_zips = create_data.create_gov_city_state_mutlizips_map(
+            gov_zip_file
+        )
+    else:
+        gov_city_state_zips = made_up_gov_zips(craigs_city_links)
+    mean_zip2craigs_url = create_data.create_mean_zipcode_2_craigs_url_map(
+        craigs_city_links, gov_city_state_zips
+    )
+    master_docs = create_data.generate_master_documents_import_to_mongodb(
+        craigs_city_links, gov_city_state_zips, mean_zip2craigs_url
+    )
+    master_docs = [doc for doc in master_docs if doc["CityState"]]
+    zipindex.save(*zipindex.build(master_docs))
+
+    mongodb.set_client(mongomock.MongoClient())
+    mongo_cli = mongodb.MongoCli()
+    mongo_cli.drop_db()
+    mongo_cli.init_load_city_state_zip_map([dict(doc) for doc in master_docs])
+    for doc in master_docs:
+        mongo_cli.update_one_document(
+            {"craigs_url": doc["craigs_url"]},
+            {"$set": made_up_listing(doc["craigs_url"])},
+        )
+    snapshot.write_from_mongo(mongo_cli)
+
+    return {
+        doc["craigs_url"]: doc["Zips"] + doc["AltZips"]
+        for doc in master_docs
+        if doc["Zips"] or doc["AltZips"]
+    }
+
+
+def clear_caches():
+    for ttl_cache in (
+        main.zip_to_url,
+        main.region_cache,
+        should_flask.rendered_pages,
+        should_flask.compressed_pages,
+    ):
+        ttl_cache.clear()
+
+
+def counted_samples():
+    """ {sample: value} of the stage and cache lookup metrics counted so far """
+    counted = {}
+    for metric in prometheus_client.REGISTRY.collect():
+        if metric.name not in (
+            "shouldipickitup_stage_seconds",
+            "shouldipickitup_cache_lookups",
+        ):
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith(("_count", "_total")) and sample.value:
+                labels = ",".join(f"{k}={v}" for k, v in sorted(sample.labels.items()))
+                counted[f"{sample.name}{{{labels}}}"] = sample.value
+    return counted
+
+
+def percentiles(runs_ms):
+    """ Nearest rank p50/p95/p99 (statistics.quantiles is 3.8+) """
+    runs_ms = sorted(runs_ms)
+
+    def rank(pct):
+        return round(runs_ms[max(0, math.ceil(pct / 100 * len(runs_ms)) - 1)], 3)
+
+    return {
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": round(runs_ms[-1], 3),
+    }
+
+
+def micro(func, args, before=None):
+    """ Time func(arg) for each arg, one at a time """
+    runs = []
+    for arg in args:
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        func(arg)
+        runs.append((time.perf_counter() - start) * 1000)
+    return dict(calls=len(runs), **percentiles(runs))
+
+
+def load(zips, threads):
+    """ GET /search/?zip= for every zip, from threads threads at once """
+    local = threading.local()
+    statuses = {}
+    status_lock = threading.Lock()
+
+    def one(zipcode):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = should_flask.app.test_client()
+        start = time.perf_counter()
+        response = client.get(
+            f"/search/?zip={zipcode}", headers={"Accept-Encoding": "gzip"}
+        )
+        elapsed = (time.perf_counter() - start) * 1000
+        with status_lock:
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        return elapsed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        runs = list(pool.map(one, zips))
+    wall = time.perf_counter() - start
+    return dict(
+        requests=len(runs),
+        threads=threads,
+        throughput_rps=round(len(runs) / wall, 1),
+        statuses={str(code): count for code, count in sorted(statuses.items())},
+        **percentiles(runs),
+    )
+
+
+if __name__ == "__main__":
+
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rng = random.Random(42)
+
+    region_zips = seed()
+    one_zip_per_region = [rng.choice(zips) for zips in region_zips.values()]
+    all_zips = [z for zips in region_zips.values() for z in zips]
+    mixed = [rng.choice(all_zips) for _ in range(requests)]
+    micro_zips = one_zip_per_region[: min(200, len(one_zip_per_region))]
+
+    start = time.perf_counter()
+    should_flask.warm_up()
+    warm_up_s = time.perf_counter() - start
+    metrics.sync(force=True)
+    warm_up_counted = counted_samples()
+    assert not warm_up_counted, f"warm_up counted as traffic: {warm_up_counted}"
+    warm_up_pages = should_flask.rendered_pages.stats()["size"]
+    assert warm_up_pages, "warm_up rendered no pages: nothing was checked"
+
+    mongo_cli = mongodb.MongoCli()
+    results = {
+        "regions": len(region_zips),
+        "zips": len(all_zips),
+        "warm_up": {"seconds": round(warm_up_s, 3), "pages": warm_up_pages},
+        "micro": {
+            "lookup_all_data_given_zip": micro(
+                mongo_cli.lookup_all_data_given_zip, micro_zips
+            ),
+            "main_cold": micro(main.main, micro_zips, before=clear_caches),
+        },
+        "load": {},
+    }
+    # main_cold leaves the caches empty: fill them first, or "warm" is cold
+    for zipcode in micro_zips:
+        main.main(zipcode)
+    hits = main.region_cache.stats()["hits"]
+    results["micro"]["main_warm"] = micro(main.main, micro_zips)
+    warm_hits = main.region_cache.stats()["hits"] - hits
+    assert warm_hits == len(micro_zips), (
+        f"main_warm: {warm_hits} region cache hits for {len(micro_zips)} calls"
+    )
+    results["micro"]["main_warm"]["region_cache_hits"] = warm_hits
+
+    clear_caches()
+    results["load"]["cold"] = load(one_zip_per_region, threads)
+    results["load"]["warm"] = load(mixed, threads)
+
+    # Nothing listens on port 1: every query fails fast, as a dead server
+    clear_caches()
+    mongodb.set_client(
+        MongoClient("localhost", 1, serverSelectionTimeoutMS=50, connect=False)
+    )
+    results["load"]["mongo_down"] = load(mixed, threads)
+    results["load"]["mongo_down"]["breaker_trips"] = main.mongo_breaker.trips
+
+    print(json.dumps(results, indent=2))
+    tmp_dir.cleanup()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+""" bench_snapshot.py - time the fallback data load: pickle vs snapshot
+
+- Builds every region in data/craigs_links.txt with 15 made up items and
+  a made up block of zips, then times:
+
+    sf_pickle          - pickledata.loadit() of data/sf.pickle (today)
+    all_pickle         - pickle of every region's listing + zip map
+    snapshot_open      - snapshot.Snapshot() of the same data
+    snapshot_open_lookup - open plus answering one zip
+
+- Prints JSON, so runs can be compared across commits:
+
+    ./bench_snapshot.py [repeat]
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import tempfile
+import statistics
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(os.path.dirname(here))
+sys.path.append(os.path.join(top, "lib"))
+
+import pickledata
+import snapshot
+
+
+def make_regions(howmany=15, zips_per_region=200):
+    region_docs, listings = [], {}
+    with open(os.path.join(top, "data", "craigs_links.txt")) as fh:
+        for num, line in enumerate(fh):
+            citystate, url = line.strip().split("=")
+            first = 1000 + num * zips_per_region
+            region_docs.append(
+                {
+                    "craigs_url": url,
+                    "CityState": citystate,
+                    "Zips": [f"{z:05}" for z in range(first, first + zips_per_region)],
+                    "AltZips": [],
+                }
+            )
+            nums = range(1, howmany + 1)
+            listings[url] = {
+                "craigs_url": url,
+                "Items": {f"Item{i}": f"free thing number {i}" for i in nums},
+                "Urls": {f"Url{i}": f"{url}/zip/d/thing/{7000000000 + i}.html" for i in nums},
+                "Prices": {f"Price{i}": f"{i}.99" for i in nums},
+                "EbayLinks": {f"EbayLink{i}": f"https://www.ebay.com/itm/{i}" for i in nums},
+                "DateCrawled": datetime.datetime(2020, 4, 1, 12, 0, 0),
+            }
+    return region_docs, listings
+
+
+def timed(func, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": min(runs), "median_ms": statistics.median(runs)}
+
+
+if __name__ == "__main__":
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    region_docs, listings = make_regions()
+    probe_zip = region_docs[len(region_docs) // 2]["Zips"][0]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        all_pickle = os.path.join(tmp, "all.pickle")
+        pickledata.save({"regions": region_docs, "listings": listings}, file=all_pickle)
+        snap_file = os.path.join(tmp, "snapshot.bin")
+        snapshot.write(region_docs, listings, snap_file)
+
+        def open_lookup():
+            snap = snapshot.Snapshot(snap_file)
+            assert snap.lookup(probe_zip) is not None
+            snap.close()
+
+        results = {
+            "regions": len(region_docs),
+            "repeat": repeat,
+            "bytes": {
+                "all_pickle": os.path.getsize(all_pickle),
+                "snapshot": os.path.getsize(snap_file),
+            },
+            "sf_pickle": timed(
+                lambda: pickledata.loadit(file=os.path.join(top, "data", "sf.pickle")),
+                repeat,
+            ),
+            "all_pickle": timed(lambda: pickledata.loadit(file=all_pickle), repeat),
+            "snapshot_open": timed(lambda: snapshot.Snapshot(snap_file).close(), repeat),
+            "snapshot_open_lookup": timed(open_lookup, repeat),
+        }
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+""" bench_titles.py - time lib/titles.py canonical() and key() per title
+
+- Runs canonical() and key() over titles in the shape of real ones, and
+  over the shapes that once made a regex backtrack for seconds (an all caps
+  place name after "near" that is not the end of the title), holding the
+  GIL and so every crawler thread:
+
+    "free desk near SOUTHEAST PORTLAND NEIGHBORHOOD, text me"
+
+- For each title it reports ms_max / ms_median over repeat runs and fails
+  (exit status 1) if any title takes more than LIMIT_MS - titles are a few
+  dozen characters, anything near that is a regex gone wrong.
+
+- Prints JSON, so runs can be compared across commits:
+
+    ./bench_titles.py [repeat]
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(os.path.dirname(here))
+sys.path.append(os.path.join(top, "lib"))
+
+import titles
+
+
+LIMIT_MS = 50
+
+TITLES = [
+    "FREE!! Curb alert - couch (Oakland) 🛋️ must go",
+    "Brown leather couches!",
+    "moving boxes @ 5th & Main 94110",
+    "Dresser near Lake Merritt",
+    "free desk near SOUTHEAST PORTLAND NEIGHBORHOOD, text me",
+    "free desk near SOUTHEAST PORTLAND NEIGHBORHOOD",
+    "lamp in NORTH BEACH TELEGRAPH HILL RUSSIAN HILL NOB HILL, pm me",
+    "chair at " + "ABCDEFGHIJKLMNOP " * 8 + "- pick up",
+    "🎁🎁🎁",
+]
+
+
+def timed(title, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        titles.key(title)
+        runs.append((time.perf_counter() - start) * 1000)
+    return {
+        "key": titles.key(title),
+        "ms_median": round(statistics.median(runs), 4),
+        "ms_max": round(max(runs), 4),
+    }
+
+
+if __name__ == "__main__":
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    results = {title: timed(title, repeat) for title in TITLES}
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    slow = [title for title, result in results.items() if result["ms_max"] > LIMIT_MS]
+    assert not slow, f"Titles over {LIMIT_MS}ms: {slow}"
@@ -11,12 +11,54 @@ app.py - Main Flask application file
 - It expects to be passed:
     - zip # from nginx html form
 
+- /api/v1/search is the same data as JSON, for up to API_MAX_ZIPS zips in
+  one call: ?zip=11218,94110 (or repeated zip=), or a POSTed JSON body
+  {"zips": ["11218", "94110"]}. Each region is sent once, with the zips
+  pointing at it:
+
+    {"zips": {"11218": "https://newyork.craigslist.org/brk/", ...},
+     "regions": {"https://newyork.craigslist.org/brk/": {
+         "city": ..., "state": ..., "date_crawled": ...,
+         "items": [{"title": ..., "url": ..., "price": ..., "ebay_url": ...}]}},
+     "nearby": {"https://newyork.craigslist.org/brk/": [<closest craigs_urls>]},
+     "invalid": ["1121"]}
+
 - It sends all returnables to return flask's render_template
 
+- gunicorn imports this in its master (preload_app) and calls warm_up()
+  before forking, so the zip index, snapshot, templates and the biggest
+  regions' pages are built once and shared by every worker.
+
+- /metrics is Prometheus text: per-stage timings, cache hit rates, breaker
+  state and MongoDB pool use, summed over all workers (see metrics.py).
+
+- The results page only differs per zip in the zip itself, so each
+  region's page is rendered once per crawl (craigs_url, DateCrawled) with
+  a placeholder for the zip, kept per worker, and the zip is put in with
+  a string replace on the way out.
+
+- Results carry an ETag and Last-Modified taken from the region's
+  DateCrawled, and a matching If-None-Match/If-Modified-Since gets a 304.
+  Bodies are gzip (or brotli, if installed) compressed once per region
+  version and zip - the zip is in the page, so each zip of a region pays
+  one compression on its first visit, at a cheap level (COMPRESS_LEVEL)
+  rather than the smallest output - then served from memory. Cache-Control
+  lets the nginx in front cache them too (see external/nginx/nginx.conf).
+
 """
 
+import gc
 import sys
+import gzip
+import time
+import hashlib
 import logging
+import calendar
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import flask
 from flask import Flask
@@ -24,10 +66,166 @@ from flask import request
 from flask import render_template
 
 import main
+from lib import cache
+from lib import config
+from lib import metrics
 
 
 app = Flask(__name__)
 
+# gzip level / brotli quality on the request path: 5 is within a few % of
+# the smallest body at a fraction of the time of 9 (gzip) or 11 (brotli)
+COMPRESS_LEVEL = 5
+
+rendered_pages = cache.TTLCache(
+    maxsize=config.PAGE_CACHE_SIZE, ttl=config.PAGE_CACHE_TTL
+)
+compressed_pages = cache.TTLCache(
+    maxsize=config.COMPRESSED_CACHE_SIZE, ttl=config.PAGE_CACHE_TTL
+)
+
+metrics.watch_cache("zip_to_url", main.zip_to_url)
+metrics.watch_cache("region", main.region_cache)
+metrics.watch_cache("rendered_pages", rendered_pages)
+metrics.watch_cache("compressed_pages", compressed_pages)
+metrics.watch_breaker(main.mongo_breaker)
+
+
+@app.before_request
+def start_timer():
+    flask.g.started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """ Time every request but the scrapes, and keep the metrics in sync """
+    started = flask.g.pop("started", None)
+    if started is not None and request.endpoint != "metrics_endpoint":
+        metrics.request_seconds.labels(request.endpoint or "unmatched").observe(
+            time.perf_counter() - started
+        )
+    metrics.sync()
+    return response
+
+
+def render_region_page(page):
+    """
+    Return the results page of a region with main.ZIP_TOKEN where the zip
+    goes, rendering it only if this version of the region is not cached yet.
+    """
+    key = (page["craigs_url"], page["date_crawled"])
+    cacheable = page["date_crawled"] is not None
+    body = rendered_pages.get(key) if cacheable else None
+    if body is None:
+        with metrics.stage("render"):
+            body = render_template(
+                "craig_list_local_items.html",
+                zip=main.ZIP_TOKEN,
+                city=page["city"],
+                state=page["state"],
+                all_posts=page["all_posts"],
+                len_items=len(page["all_posts"]),
+                all_links=page["all_links"],
+                all_cust=page["all_cust"],
+            )
+        if cacheable:
+            rendered_pages.put(key, body)
+    return body
+
+
+def warm_up():
+    """
+    Build what each worker would otherwise build on its first requests -
+    see main.warm_up - plus the compiled templates and the warmed regions'
+    pages, then move it all out of the garbage collector's way (gc.freeze)
+    so collections in the workers do not touch, and so copy, those pages.
+    """
+    # Not traffic: no stage is timed, and the workers fork with the warm
+    # up's cache counters taken as counted
+    with metrics.paused():
+        warmed = main.warm_up()
+        for template in ("craig_list_local_items.html", "nota5digitzip.html"):
+            app.jinja_env.get_template(template)
+        with app.test_request_context():
+            for all_data in warmed:
+                render_region_page(main.page_from_region(all_data))
+    metrics.baseline()
+    gc.freeze()
+    logging.info(f"Warm up done: {len(rendered_pages)} pages rendered")
+
+
+def pick_encoding():
+    """ br if the client takes it and brotli is installed, else gzip, else none """
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return "identity"
+
+
+def compressed_body(page, zip, encoding):
+    """ Return the page for zip in encoding, compressing it only once per zip """
+    key = (page["craigs_url"], page["date_crawled"], zip, encoding)
+    body = compressed_pages.get(key)
+    if body is None:
+        body = render_region_page(page).replace(main.ZIP_TOKEN, zip)
+        body = body.encode("utf-8")
+        if encoding == "br":
+            body = brotli.compress(
+                body, mode=brotli.MODE_TEXT, quality=COMPRESS_LEVEL
+            )
+        elif encoding == "gzip":
+            body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+        compressed_pages.put(key, body)
+    return body
+
+
+def timestamp(when):
+    """ Seconds since the epoch; naive datetimes (MongoDB's) are UTC """
+    return calendar.timegm(when.utctimetuple())
+
+
+def not_modified(etag, last_modified):
+    """ True if the client's validators say it already has this version """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and timestamp(last_modified) <= timestamp(since)
+
+
+def results_response(zip):
+    """
+    Return the results response for a (validated) zip - a 304 if the
+    client has this version, else the (compressed) page with validators.
+    """
+    page = main.lookup_page(zip)
+    if page["date_crawled"] is None:
+        # Fallback data - nothing to validate against, do not cache it
+        body = render_region_page(page).replace(main.ZIP_TOKEN, zip)
+        response = flask.make_response(body)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    last_modified = page["date_crawled"]
+    version = f"{page['craigs_url']}|{last_modified.isoformat()}"
+    etag = hashlib.sha1(version.encode("utf-8")).hexdigest()[:20]
+
+    if not_modified(etag, last_modified):
+        response = flask.Response(status=304)
+    else:
+        encoding = pick_encoding()
+        response = flask.Response(
+            compressed_body(page, zip, encoding), mimetype="text/html"
+        )
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = f"public, max-age={config.SEARCH_MAX_AGE}"
+    response.vary.add("Accept-Encoding")
+    return response
+
 
 @app.route("/search/", methods=["POST", "GET"])
 def get_data():
@@ -46,37 +244,68 @@ def get_data():
             logger.setLevel(logging.DEBUG)
         else:
             logger.setLevel(logging.INFO)
-        try:
-            querystring = request.args
-            logger.debug(f"querystring: {querystring}")
-            zip = querystring.get("zip")
-            if len(str(zip)) != 5:
-                raise ValueError
-            elif zip[0] == 0:
-                int(zip[1:])
-            else:
-                int(zip)
-        except (TypeError, ValueError):  # Not Numeric/Didn't send "zip="
-            logging.error(f"Invalid data: querystring: {querystring} : nota5digitzip")
-            return render_template("nota5digitzip.html")
+        with metrics.stage("validate"):
+            try:
+                querystring = request.args
+                logger.debug(f"querystring: {querystring}")
+                zip = querystring.get("zip")
+                if len(str(zip)) != 5:
+                    raise ValueError
+                elif zip[0] == 0:
+                    int(zip[1:])
+                else:
+                    int(zip)
+            except (TypeError, ValueError):  # Not Numeric/Didn't send "zip="
+                msg = f"Invalid data: querystring: {querystring} : nota5digitzip"
+                logging.error(msg)
+                return render_template("nota5digitzip.html")
     except Exception as e:
         msg = f"Bug: querystring:{querystring}, Error: {str(e)}"
         logging.exception(msg)
         flask.abort(500)
     else:
         zip = str(zip)
-        all_posts, all_links, all_cust, city, state = main.main(zip)
-        len_items = len(all_posts)
-        return render_template(
-            "craig_list_local_items.html",
-            zip=zip,
-            city=city,
-            state=state,
-            all_posts=all_posts,
-            len_items=len_items,
-            all_links=all_links,
-            all_cust=all_cust,
-        )
+        return results_response(zip)
+
+
+def is_5digit_zip(zip):
+    return isinstance(zip, str) and len(zip) == 5 and zip.isascii() and zip.isdigit()
+
+
+@app.route("/api/v1/search", methods=["POST", "GET"])
+def api_search():
+    """
+    Return the items of many zips as JSON, fetching each region only once.
+    """
+    body = request.get_json(silent=True) or {}
+    zips = body.get("zips") if isinstance(body, dict) else None
+    if not isinstance(zips, list):
+        zips = [z for arg in request.args.getlist("zip") for z in arg.split(",")]
+    if not zips:
+        return flask.jsonify(error="Send zip=11218,94110 or {\"zips\": [...]}"), 400
+    if len(zips) > config.API_MAX_ZIPS:
+        return flask.jsonify(error=f"At most {config.API_MAX_ZIPS} zips per call"), 400
+
+    valid = list(dict.fromkeys(z for z in zips if is_5digit_zip(z)))
+    invalid = [z for z in zips if not is_5digit_zip(z)]
+    try:
+        regions, zip_to_region = main.lookup_many(valid)
+    except Exception as e:
+        logging.exception(f"Bug: api zips:{len(valid)}, Error: {str(e)}")
+        flask.abort(500)
+    return flask.jsonify(
+        zips=zip_to_region,
+        regions={url: all_data.to_json() for url, all_data in regions.items()},
+        nearby={url: main.nearby_regions(url) for url in regions},
+        invalid=invalid,
+    )
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """ Prometheus text format, summed over all gunicorn workers """
+    body, content_type = metrics.exposition()
+    return flask.Response(body, content_type=content_type)
 
 
 if __name__ == "__main__":